@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from import_rsc_functions import *
-import matplotlib.pyplot as plt
+from scale_array import scale_array, scale_image
+from mask import mask
+from imcolor import imcolor
 
 
 def add_box(img, vx, vy, box_size, color=257, line_width=2, flag_scale_image=1, flag_display_image=1):
@@ -60,6 +61,7 @@ def add_box(img, vx, vy, box_size, color=257, line_width=2, flag_scale_image=1,
         img = mask(img, np.array([vx[i], vy[i]]), box_mul_0, box_add_0 * color)
 
     if flag_display_image:
+        import matplotlib.pyplot as plt  # only when images are displayed
         imcolor(img)
         plt.show()
 
@@ -68,6 +70,7 @@ def add_box(img, vx, vy, box_size, color=257, line_width=2, flag_scale_image=1,
 
 if __name__ == '__main__':
     import scipy.io
+    from read_box_e_m import read_box_e_m
 
     x, y, wx, wy, __ = read_box_e_m(
         'data/18jun07c_em6b_00002gr_00010sq_v01_00002hl_v01_00005en.framescor2x_DW_dmBIN01.mrc_resub44_screen.txt')
@@ -4,7 +4,6 @@ import numpy as np
 from disc import disc
 from mask import mask
 from scale_array import scale_array, scale_image
-import matplotlib.pyplot as plt
 from imcolor import imcolor
 
 
@@ -66,6 +65,7 @@ def add_circle(img, vx, vy, vr, color=257, line_width=2, flag_scale_image=1, fla
                 img = mask(img, cpoint, box_mul0, box_add0 * color)    
     
     if flag_display_image:
+        import matplotlib.pyplot as plt  # only when images are displayed
         imcolor(img)
         plt.show()
 
@@ -5,7 +5,6 @@ import numpy as np
 
 from mask import mask
 from scale_array import scale_array, scale_image
-import matplotlib.pyplot as plt
 from imcolor import imcolor
 
 
@@ -48,6 +47,7 @@ def add_cross(img, vx, vy, cross_length=20, color=257, line_width=2, flag_scale_
         img = mask(img, np.array((round(vx[i]), round(vy[i]))), mul, marker)
 
     if flag_display_image:
+        import matplotlib.pyplot as plt  # only when images are displayed
         imcolor(img)
         plt.show()
 
@@ -2,6 +2,8 @@
 
 import numpy as np
 import debug
+from real_fft import as_half_plane, filter_real
+import fft_backend
 
 
 def apply_filter(data, q, mode=0):
@@ -12,7 +14,7 @@ def apply_filter(data, q, mode=0):
 
     args:
         data: a 2D array to be filltered
-        q: the filter ot the same size as data
+        q: the filter ot the same size as data, or its half_plane (see real_fft) if it is not centered
         mode: 1 means the filter is centered
 
     returns:
@@ -25,9 +27,12 @@ def apply_filter(data, q, mode=0):
 
     if mode:
         q = np.fft.fftshift(q)
-    fq = q * np.fft.fftn(data)
+    if np.iscomplexobj(q) or np.iscomplexobj(data):
+        fq = q * fft_backend.fftn(data)
+        return np.real(fft_backend.ifftn(fq))
 
-    return np.real(np.fft.ifftn(fq))
+    # A real filter of real data is applied with the half spectrum
+    return filter_real(data, as_half_plane(q, data.shape))
 
 
 if __name__ == "__main__":
@@ -2,9 +2,16 @@
 
 import numpy as np
 import os
-from import_rsc_functions import *
-import matplotlib.pyplot as plt
+import concurrent.futures
+from import_rsc_functions import get_files_having_pattern, get_base_filename, get_yes_no, get_num_from_screen, \
+    num2strn, remove_array_elements, pad_pic, read_mrc, MRCFile, write_mrc, ctf, read_box_e_m, write_ves_file
 from subtract_vesicles_popc_ect_2019 import subtract_vesicles_popc_ect_2019
+from ctf_bank import default_ctf_bank
+from projected_profile_cache import projected_profile_cache
+from io_pipeline import Prefetcher, WriteBehind
+from run_config import ask_if_missing
+from run_manifest import RunManifest, replace_atomic
+from work_sharing import shard_files, WorkClaims, RecordAll
 # import time
 
 
@@ -15,7 +22,10 @@ class Struct(object):  # Used to create an empty structure/class
 def batch_refit_subtract_new_withPOPC_in_folder_parfor_2019(
         file_pattern, pixelsize, model_type,
         ves_filename_after_base, ctf_filename_after_base, scaling_of_mp_if_skip_refit_xy=0,
-        flag_mask_part_for_ves_fit=0, flag_display_image=0, star_filename_after_base=None):
+        flag_mask_part_for_ves_fit=0, flag_display_image=0, star_filename_after_base=None, n_jobs=1,
+        n_ves_workers=1, profile_cache_file=None, fitter='fmin', fit_options=None, io_queue_depth=0,
+        n_to_delete_from_end_tobasename=None, flag_mask_edge=None, nx0=None, ny0=None,
+        manifest_file=None, shard=None, claim_dir=None, claim_timeout=3600):
     """
     This is used to resubtract vesicles using different models.
     All files in the same folder!!
@@ -32,11 +42,44 @@ def batch_refit_subtract_new_withPOPC_in_folder_parfor_2019(
         flag_mask_part_for_ves_fit: don't subtract particle region. This is not implemented yet. 
         flag_printlay_image: a boolean  
         star_filename_after_base: used to read ctf from Relion files
+        n_jobs: number of micrographs processed at the same time in a process pool.
+            1: serial run. Images are not displayed when n_jobs > 1.
+        n_ves_workers: number of vesicles refitted at the same time in a micrograph.
+            See subtract_vesicles_popc_ect_2019.
+        profile_cache_file: a npz file of projected vesicle profiles (see ProjectedProfileCache).
+            If given, the profiles are loaded from it at the start and saved to it at the end,
+            so the next run starts with them. With n_jobs > 1, only the profiles of the first
+            micrograph are saved.
+        fitter: 'fmin' (Nelder-Mead), 'lm' (Levenberg-Marquardt) or 'pyramid' (coarse to fine) to refit
+            the vesicles
+        fit_options: None or a dictionary of keyword arguments of the fitter. See subtract_vesicles_popc_ect_2019.
+        io_queue_depth: >0 to read up to io_queue_depth micrographs (with their ctf and vesicle files) ahead
+            in a thread while one is fitted, and to write the outputs in another thread with at most
+            io_queue_depth waiting. This caps the memory to about 2 * io_queue_depth + 2 micrographs.
+            Only used when n_jobs = 1. 0: read and write in the main thread.
+        n_to_delete_from_end_tobasename: number of characters deleted from the end of a micrograph filename
+            to get its base filename
+        flag_mask_edge: 1 if there are blank edges from the padding of the images (e.g. K2 images)
+        nx0, ny0: image size before padding, if flag_mask_edge
+            The user is asked for the last four in a terminal if they are None.
+            Without a terminal (e.g. a scheduled job), they must be given.
+        manifest_file: a JSON-lines file (see RunManifest) recording the status of each micrograph.
+            The micrographs done in an earlier run with the same input and existing outputs are skipped,
+            and the failed ones are tried again. A failed micrograph does not stop the run.
+        shard: 'i/N' (0 <= i < N) to process only every N-th micrograph from i, in sorted order (see shard_files)
+        claim_dir: a folder shared by the nodes processing the same micrographs. Each micrograph is claimed
+            there with a lock file before it is processed, so it is processed by only one node (see WorkClaims).
+        claim_timeout: seconds after which a claim of a node that died is taken over
          
     returns:
         a vesicle subtracted file is generated.
         a vesicle information file is generated.
     
+    note:
+        bad_vesicle_amplitude_threshold is calibrated on the first micrograph and the calibrated
+        value is used for all other micrographs, so serial and parallel runs behave the same.
+        The threshold is only used to count bad vesicles. It does not change the output files.
+
     To dos:
         Use different ctf from Relion star file for different vesicles. 
     """
@@ -49,12 +92,6 @@ def batch_refit_subtract_new_withPOPC_in_folder_parfor_2019(
     else:
         flag_use_local_ctf_from_particle_star_file = 1
 
-    # Check whether skip fitting but scale the saved amplitudes
-    if scaling_of_mp_if_skip_refit_xy > 0:
-        flag_skip_refit_xy = 1
-    else:
-        flag_skip_refit_xy = 0
-
     # get a list of image file names in current folder
     files = get_files_having_pattern(file_pattern)
     print('CTF file pattern is: ' + ctf_filename_after_base)
@@ -62,170 +99,463 @@ def batch_refit_subtract_new_withPOPC_in_folder_parfor_2019(
 
     # get_base_filename needs to be implemented
     print('... get file basename...')
-    n_to_delete_from_end_tobasename = get_base_filename(files[0], 11)
+    n_to_delete_from_end_tobasename = int(ask_if_missing(n_to_delete_from_end_tobasename,
+                                                         'n_to_delete_from_end_tobasename',
+                                                         get_base_filename, files[0], 11))
+    print(f'-- Base filename of {files[0]} is {files[0][0: -n_to_delete_from_end_tobasename]}')
 
     # To generate the mask for blank strips due to padding of images.
-    flag_mask_edge = get_yes_no('Are there blank edges in the image (e.g. K2 image)?', 1)
+    flag_mask_edge = ask_if_missing(flag_mask_edge, 'flag_mask_edge', get_yes_no,
+                                    'Are there blank edges in the image (e.g. K2 image)?', 1)
     if flag_mask_edge:
-        im, __, __, __ = read_mrc(files[0])
-        nx, ny = np.shape(im)
+        with MRCFile(files[0]) as f:  # only the header is read
+            nx, ny = f.nx, f.ny
         print(f'Current image size is {nx} x {ny}.')
         print("If there are two strips from the padding of images, we can correct it here.")
-        nx0 = get_num_from_screen("What is the image size in X before padding?", 3710)
-        ny0 = get_num_from_screen("What is the image size in Y before padding?", 3838)
+        nx0 = int(ask_if_missing(nx0, 'nx0', get_num_from_screen, "What is the image size in X before padding?",
+                                 3710))
+        ny0 = int(ask_if_missing(ny0, 'ny0', get_num_from_screen, "What is the image size in Y before padding?",
+                                 3838))
 
         # The blank strips will be set to zero while image region is set to 1.
         mask_k2_edge_setto_0 = pad_pic(np.ones([nx0, ny0]), nx, ny, 0)
+    else:
+        mask_k2_edge_setto_0 = None
+
+    # Parameters shared by all micrographs
+    args_micrograph = (n_to_delete_from_end_tobasename, pixelsize, model_type,
+                       ves_filename_after_base, ctf_filename_after_base, scaling_of_mp_if_skip_refit_xy,
+                       flag_use_local_ctf_from_particle_star_file, mask_k2_edge_setto_0, n_ves_workers,
+                       profile_cache_file, fitter, fit_options)
+
+    if n_jobs > 1 and flag_display_image:
+        print('*** Images are not displayed when micrographs are processed in parallel.')
+        flag_display_image = 0
 
-    # Loop over each image
+    # The micrographs of this node
+    if shard is not None:
+        files = shard_files(files, shard)
+        print(f'*** Shard {shard}: {len(files)} micrographs.')
+
+    # Skip the micrographs done in an earlier run
     bad_vesicle_amplitude_threshold_saved = 0.1
-    for i in range(len(files)):
-        print('----------------------------------------')
-        print(f'........ ii= {i} ............')
-
-        # ===================================================
-        # Read image, ctf, and vesicle information
-        infilename = files[i]
-        ves_file = infilename[0: -n_to_delete_from_end_tobasename] + ves_filename_after_base
-        ctf_file = infilename[0: -n_to_delete_from_end_tobasename] + ctf_filename_after_base
-
-        print(f'CTF file is {ctf_file}')
-        print(f'vesicle file is {ves_file}')
-
-        # check ctf and vesicle files
-        if not os.path.isfile(ctf_file):
-            print(f'*** ctf file does not exist: {ctf_file}')
-            continue
-        if not os.path.isfile(ves_file):
-            print(f'*** ctf file does not exist: {ves_file}')
-            continue
-
-        print('*** Reading image file ', infilename)
-        im, __, __, __ = read_mrc(infilename)
+    flag_calibrated = False
+    manifest = None
+    if manifest_file is not None:
+        manifest = RunManifest(manifest_file)
+        files_done = [infilename for infilename in files if manifest.is_done(infilename)]
+        for infilename in files_done:
+            threshold = manifest.record(infilename).get('bad_vesicle_amplitude_threshold')
+            if threshold is not None:
+                bad_vesicle_amplitude_threshold_saved = threshold
+                flag_calibrated = True
+                break
+        files = [infilename for infilename in files if infilename not in files_done]
+        print(f'*** {len(files_done)} micrographs are done in {manifest_file} and skipped. '
+              f'{len(files)} micrographs to process.')
+
+    # Share the micrographs with other nodes
+    claims = None
+    if claim_dir is not None:
+        claims = WorkClaims(claim_dir, claim_timeout)
+        files = [infilename for infilename in files if not claims.is_done(infilename)]
+        print(f'*** {len(files)} micrographs are not done by any node in {claim_dir}.')
+
+    # Record the start and the end of each micrograph
+    if manifest is None and claims is None:
+        tracker = None
+    else:
+        tracker = RecordAll([manifest, claims])
+
+    # In a serial run, the next micrographs are read in a thread while one is fitted,
+    # and the outputs are written in another thread.
+    prefetched = None
+    write_behind = None
+    if io_queue_depth > 0:
+        if n_jobs > 1:
+            print('*** Prefetching is only used when micrographs are processed one by one (n_jobs = 1).')
+        else:
+            prefetcher = Prefetcher(read_micrograph_inputs,
+                                    [(infilename, n_to_delete_from_end_tobasename, ves_filename_after_base,
+                                      ctf_filename_after_base) for infilename in files], io_queue_depth)
+            prefetched = iter(prefetcher)
+            # With a manifest or claims, a failed write is recorded there and does not stop the run
+            write_behind = WriteBehind(io_queue_depth, flag_raise=tracker is None)
+
+    def run_serial(i, bad_vesicle_amplitude_threshold_saved):
+        inputs = None
+        if prefetched is not None:
+            inputs, err = next(prefetched)
+            if err is not None:
+                inputs = err  # raised below if this node claims the micrograph
+        if claims is not None and not claims.claim(files[i]):
+            print(f'*** {files[i]} is done or being processed by another node.')
+            return None
+        if tracker is not None:
+            tracker.start(files[i])
+        try:
+            if isinstance(inputs, Exception):
+                raise inputs
+            if prefetched is None:
+                res = refit_subtract_micrograph(i, files[i], *args_micrograph, bad_vesicle_amplitude_threshold_saved,
+                                                flag_display_image, None, None, tracker)
+            elif inputs is None:
+                res = None
+            else:
+                res = refit_subtract_micrograph(i, files[i], *args_micrograph, bad_vesicle_amplitude_threshold_saved,
+                                                flag_display_image, inputs, write_behind, tracker)
+        except Exception as err:
+            if tracker is None:
+                raise
+            print(f'*** Failed: {files[i]}: {err!r}')
+            tracker.fail(files[i], repr(err))
+            return None
+        if res is None and tracker is not None:
+            tracker.fail(files[i], 'ctf or vesicle file does not exist')
+        return res
+
+    def record_result(i, future):
+        if tracker is None:
+            future.result()  # re-raise errors from the worker processes
+            return
+        try:
+            res = future.result()
+        except Exception as err:
+            print(f'*** Failed: {files[i]}: {err!r}')
+            tracker.fail(files[i], repr(err))
+            return
+        if res is None:
+            tracker.fail(files[i], 'ctf or vesicle file does not exist')
+        else:
+            tracker.finish(files[i], res.outputs, bad_vesicle_amplitude_threshold=res.bad_vesicle_amplitude_threshold)
+
+    try:
+        # Loop over each image
+        # The first micrograph is processed here to calibrate bad_vesicle_amplitude_threshold.
+        i_first = 0
+        while i_first < len(files) and not flag_calibrated:
+            res = run_serial(i_first, bad_vesicle_amplitude_threshold_saved)
+            i_first += 1
+            if res is not None:
+                bad_vesicle_amplitude_threshold_saved = res.bad_vesicle_amplitude_threshold
+                if flag_display_image:
+                    display_subtracted_micrograph(res, pixelsize)
+                break
+
+        if n_jobs > 1:
+            print(f'*** Processing {len(files) - i_first} micrographs with {n_jobs} processes.')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                running = {}
+                for i in range(i_first, len(files)):
+                    if claims is not None and not claims.claim(files[i]):
+                        continue
+                    if tracker is not None:
+                        tracker.start(files[i])
+                    running[executor.submit(refit_subtract_micrograph, i, files[i], *args_micrograph,
+                                            bad_vesicle_amplitude_threshold_saved, 0)] = i
+                    if claims is not None and len(running) >= n_jobs:
+                        # Claim the next micrograph only when a process is free, so other nodes can take it
+                        finished, __ = concurrent.futures.wait(running,
+                                                               return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            record_result(running.pop(future), future)
+                for future in list(running):
+                    record_result(running.pop(future), future)
+        else:
+            for i in range(i_first, len(files)):
+                res = run_serial(i, bad_vesicle_amplitude_threshold_saved)
+                if res is not None and flag_display_image:
+                    display_subtracted_micrograph(res, pixelsize)
+    finally:
+        if prefetched is not None:
+            prefetcher.close()
+            write_behind.close()  # wait for the outputs
+
+    if manifest is not None:
+        print(f'*** Micrographs in {manifest_file}: {manifest.summary()}')
+
+    if profile_cache_file is not None:
+        profile_cache = projected_profile_cache(model_type, pixelsize)
+        profile_cache.save(profile_cache_file)
+        print(f'*** {profile_cache.n_profile} projected profiles saved to {profile_cache_file}')
+
+
+def read_micrograph_inputs(infilename, n_to_delete_from_end_tobasename, ves_filename_after_base,
+                           ctf_filename_after_base):
+    """
+    Read a micrograph with its ctf and vesicle files.
+    This is a module-level function so it can be run ahead in a Prefetcher.
+
+    args:
+        infilename: micrograph filename
+        Others are the same as in batch_refit_subtract_new_withPOPC_in_folder_parfor_2019
+
+    returns:
+        None if the ctf or vesicle file does not exist.
+        Otherwise a Struct with im, info_ctf, mx1d, my1d, mr1d, mp1d
+    """
+    ves_file = infilename[0: -n_to_delete_from_end_tobasename] + ves_filename_after_base
+    ctf_file = infilename[0: -n_to_delete_from_end_tobasename] + ctf_filename_after_base
+
+    print(f'CTF file is {ctf_file}')
+    print(f'vesicle file is {ves_file}')
+
+    # check ctf and vesicle files
+    if not os.path.isfile(ctf_file):
+        print(f'*** ctf file does not exist: {ctf_file}')
+        return None
+    if not os.path.isfile(ves_file):
+        print(f'*** ctf file does not exist: {ves_file}')
+        return None
+
+    inputs = Struct()
+    print('*** Reading image file ', infilename)
+    inputs.im, __, __, __ = read_mrc(infilename)
+
+    print(f'*** Reading CTF file {ctf_file}')
+    info_ctf = ctf(ctf_file, simple_format=1)
+    inputs.info_ctf = info_ctf.asDict()
+
+    print(f'*** Reading vesicle info: {ves_file}')
+    inputs.mx1d, inputs.my1d, inputs.mr1d, inputs.mp1d, __ = read_box_e_m(ves_file)
+    return inputs
+
+
+def refit_subtract_micrograph(i, infilename, n_to_delete_from_end_tobasename, pixelsize, model_type,
+                              ves_filename_after_base, ctf_filename_after_base, scaling_of_mp_if_skip_refit_xy,
+                              flag_use_local_ctf_from_particle_star_file, mask_k2_edge_setto_0, n_ves_workers,
+                              profile_cache_file, fitter, fit_options, bad_vesicle_amplitude_threshold_saved,
+                              flag_return_images=0, inputs=None, write_behind=None, manifest=None):
+    """
+    Read, refit/subtract and write one micrograph.
+    This is a module-level function so it can be dispatched to a process pool.
+
+    args:
+        i: index of the micrograph (only used for printing)
+        infilename: micrograph filename
+        mask_k2_edge_setto_0: None or a mask for the blank strips from the padding of images
+        n_ves_workers: number of vesicles refitted at the same time
+        profile_cache_file: None or a npz file to load the projected profiles from
+        fitter: 'fmin', 'lm' or 'pyramid'
+        fit_options: None or a dictionary of keyword arguments of the fitter
+        bad_vesicle_amplitude_threshold_saved: threshold passed to subtract_vesicles_popc_ect_2019
+        flag_return_images: also return the original and subtracted images for display
+        inputs: the Struct from read_micrograph_inputs if it is already read. None: read here.
+        write_behind: None to write the outputs here, or a WriteBehind to write them in its thread
+        manifest: None or a RunManifest, where the micrograph is recorded as done after its outputs are written
+        Others are the same as in batch_refit_subtract_new_withPOPC_in_folder_parfor_2019
+
+    returns:
+        None if the ctf or vesicle file does not exist.
+        Otherwise a Struct with bad_vesicle_amplitude_threshold, mxnew, mynew, mrnew, mpnew, outputs
+        and im0, im if flag_return_images is set.
+    """
+
+    print('----------------------------------------')
+    print(f'........ ii= {i} ............')
+
+    # Check whether skip fitting but scale the saved amplitudes
+    if scaling_of_mp_if_skip_refit_xy > 0:
+        flag_skip_refit_xy = 1
+    else:
+        flag_skip_refit_xy = 0
+
+    flag_mask_edge = mask_k2_edge_setto_0 is not None
+
+    # ===================================================
+    # Read image, ctf, and vesicle information
+    if inputs is None:
+        inputs = read_micrograph_inputs(infilename, n_to_delete_from_end_tobasename, ves_filename_after_base,
+                                        ctf_filename_after_base)
+    if inputs is None:
+        return None
+    im = inputs.im
+    info_ctf = inputs.info_ctf
+    mx1d, my1d, mr1d, mp1d = inputs.mx1d, inputs.my1d, inputs.mr1d, inputs.mp1d
+    del inputs
+    if flag_return_images:
         im0 = np.copy(im)
 
-        print(f'*** Reading CTF file {ctf_file}')
-        info_ctf = ctf(ctf_file, simple_format=1)
-        info_ctf = info_ctf.asDict()
-
-        # TODO: local ctf
-        # use gCTF fitted local CTF for each particle in Relion star file format
-        if flag_use_local_ctf_from_particle_star_file:
-            print('Not implemented yet!')
-            # star_file=[infilename(1:end-n_to_delete_from_end_tobasename) star_filename_after_base]
-            # It includes the CTF parameters
-            # info_ctf.flag_use_local_ctf_from_particle_star_file = 1
-            # info_ctf.star_file = star_file
-
-        print(f'*** Reading vesicle info: {ves_file}')
-        mx1d, my1d, mr1d, mp1d, __ = read_box_e_m(ves_file)
-
-        # ===================================================
-        # The following was used to delete fake vesicles at the end of each file.
-        # flag_ves is boolean
-        flag_ves = mr1d < 20
-        flag_mp = mp1d < 1e-8
-        flag_ves = (flag_ves + flag_mp) > 0
-        for ih in range(len(mx1d)):
-            if flag_ves[ih]:
-                print(f'... Deleting vesicle at ({mx1d[ih]},{my1d[ih]}) with a radius of {mr1d[ih]}')
-
-        # To remove vesicles having inf or nan information
-        flag_ves_inf_nan = np.isnan(mx1d) + np.isinf(mx1d)\
-                           + np.isnan(my1d) + np.isinf(my1d)\
-                           + np.isnan(mr1d) + np.isinf(mr1d)\
-                           + np.isnan(mp1d) + np.isinf(mp1d)
-        flag_ves = (flag_ves + flag_ves_inf_nan) > 0
-
-        # Remove bad vesicles
-        mx1d = remove_array_elements(mx1d, flag_ves)
-        my1d = remove_array_elements(my1d, flag_ves)
-        mr1d = remove_array_elements(mr1d, flag_ves)
-        mp1d = remove_array_elements(mp1d, flag_ves)
-
-        # To dos
-        """
-        # Generate a mask for the image based on picked particles, so the bias on
-        # the amplitude of the to-be-subtracted vesicle model is eliminated.
-        # Method 1: put a circular mask around each particles
-        if(flag_mask_part_for_ves_fit)
-            [img_size_x, img_size_y]=size(im)
-            part_file=[infilename,'.matbox'
-            f_part=fopen(part_file)
-            if(~(f_part>0))
-                print(' Particle file ',part_file,' does NOT exist. No mask is used.')
-                im_mask=ones(img_size_x,img_size_y)
-            else
-                im_mask=zeros(img_size_x,img_size_y)
-                %                 [px py pwx pwy]=read_box_E_M(part_file)
-                [px, py]=read_box_E_M(part_file)
-                n_part=numel(px)
-                for jj=1:n_part
-                    ax=px(jj)
-                    ay=py(jj)
-                    ar=round(80/pixelsize) % Assume particles are within a circle of 160A in diameter.
-                    im_mask=im_mask+disc(img_size_x,ar,[ax,ay])
-                end
-                im_mask=im_mask<1% masked aera is 0 and outside is 1 to keep
-            end
-            if(flag_mask_edge)
-                im_mask=im_mask .* mask_k2_edge_setto_0
+    # TODO: local ctf
+    # use gCTF fitted local CTF for each particle in Relion star file format
+    if flag_use_local_ctf_from_particle_star_file:
+        print('Not implemented yet!')
+        # star_file=[infilename(1:end-n_to_delete_from_end_tobasename) star_filename_after_base]
+        # It includes the CTF parameters
+        # info_ctf.flag_use_local_ctf_from_particle_star_file = 1
+        # info_ctf.star_file = star_file
+
+    # ===================================================
+    # The following was used to delete fake vesicles at the end of each file.
+    # flag_ves is boolean
+    flag_ves = mr1d < 20
+    flag_mp = mp1d < 1e-8
+    flag_ves = (flag_ves + flag_mp) > 0
+    for ih in range(len(mx1d)):
+        if flag_ves[ih]:
+            print(f'... Deleting vesicle at ({mx1d[ih]},{my1d[ih]}) with a radius of {mr1d[ih]}')
+
+    # To remove vesicles having inf or nan information
+    flag_ves_inf_nan = np.isnan(mx1d) + np.isinf(mx1d)\
+                       + np.isnan(my1d) + np.isinf(my1d)\
+                       + np.isnan(mr1d) + np.isinf(mr1d)\
+                       + np.isnan(mp1d) + np.isinf(mp1d)
+    flag_ves = (flag_ves + flag_ves_inf_nan) > 0
+
+    # Remove bad vesicles
+    mx1d = remove_array_elements(mx1d, flag_ves)
+    my1d = remove_array_elements(my1d, flag_ves)
+    mr1d = remove_array_elements(mr1d, flag_ves)
+    mp1d = remove_array_elements(mp1d, flag_ves)
+
+    # To dos
+    """
+    # Generate a mask for the image based on picked particles, so the bias on
+    # the amplitude of the to-be-subtracted vesicle model is eliminated.
+    # Method 1: put a circular mask around each particles
+    if(flag_mask_part_for_ves_fit)
+        [img_size_x, img_size_y]=size(im)
+        part_file=[infilename,'.matbox'
+        f_part=fopen(part_file)
+        if(~(f_part>0))
+            print(' Particle file ',part_file,' does NOT exist. No mask is used.')
+            im_mask=ones(img_size_x,img_size_y)
+        else
+            im_mask=zeros(img_size_x,img_size_y)
+            %                 [px py pwx pwy]=read_box_E_M(part_file)
+            [px, py]=read_box_E_M(part_file)
+            n_part=numel(px)
+            for jj=1:n_part
+                ax=px(jj)
+                ay=py(jj)
+                ar=round(80/pixelsize) % Assume particles are within a circle of 160A in diameter.
+                im_mask=im_mask+disc(img_size_x,ar,[ax,ay])
             end
-        """
-
-        if flag_mask_edge:
-            im_mask = np.copy(mask_k2_edge_setto_0)
-
-        # =========================================
-        # If skip fitting, mr1d contains mp1d and mr1d
-        mr1d_in = Struct
-        if flag_skip_refit_xy:  # use saved mp
-            mr1d_in.mr1d = mr1d
-            mr1d_in.mp1d = mp1d * scaling_of_mp_if_skip_refit_xy
-            del mr1d
-            mr1d = mr1d_in
-            del mr1d_in
-
-        if flag_mask_edge:
-            im, mxnew, mynew, mrnew, mpnew, __, bad_vesicle_amplitude_threshold_saved = \
-                subtract_vesicles_popc_ect_2019(im, mx1d, my1d, mr1d, mp1d, pixelsize,
-                                                info_ctf, model_type, im_mask, bad_vesicle_amplitude_threshold_saved)
-        else:
-            im, mxnew, mynew, mrnew, mpnew, __, bad_vesicle_amplitude_threshold_save = \
-                subtract_vesicles_popc_ect_2019(im, mx1d, my1d, mr1d, mp1d, pixelsize,
-                                                info_ctf, model_type, im_mask=None,
-                                                bad_vesicle_amplitude_threshold=bad_vesicle_amplitude_threshold_saved)
-
-        file_out = infilename[0: -4] + '_ves' + num2strn(model_type, 2) + '.mrc'
+            im_mask=im_mask<1% masked aera is 0 and outside is 1 to keep
+        end
+        if(flag_mask_edge)
+            im_mask=im_mask .* mask_k2_edge_setto_0
+        end
+    """
 
-        write_mrc(im, pixelsize, file_out, 2)
+    if flag_mask_edge:
+        im_mask = np.copy(mask_k2_edge_setto_0)
+    else:
+        im_mask = None
+
+    # =========================================
+    # If skip fitting, mr1d contains mp1d and mr1d
+    mr1d_in = Struct
+    if flag_skip_refit_xy:  # use saved mp
+        mr1d_in.mr1d = mr1d
+        mr1d_in.mp1d = mp1d * scaling_of_mp_if_skip_refit_xy
+        del mr1d
+        mr1d = mr1d_in
+        del mr1d_in
+
+    # Start from the saved profiles in this process
+    profile_cache = projected_profile_cache(model_type, pixelsize)
+    if profile_cache_file is not None and profile_cache.n_profile == 0:
+        profile_cache.load(profile_cache_file)
+
+    im, mxnew, mynew, mrnew, mpnew, __, bad_vesicle_amplitude_threshold = \
+        subtract_vesicles_popc_ect_2019(im, mx1d, my1d, mr1d, mp1d, pixelsize,
+                                        info_ctf, model_type, im_mask, bad_vesicle_amplitude_threshold_saved,
+                                        n_ves_workers, ctf_bank=default_ctf_bank(),
+                                        profile_cache=profile_cache, fitter=fitter,
+                                        fit_options=fit_options)
+    print(default_ctf_bank().report())
+
+    file_out = infilename[0: -4] + '_ves' + num2strn(model_type, 2) + '.mrc'
+
+    if flag_skip_refit_xy:
+        pickname = None
+    else:  # vesicle informaiton is fitted
+        pickname = infilename[0: -4] + '_resub' + num2strn(model_type, 2) + '.txt'
+    outputs = [file_out] if pickname is None else [file_out, pickname]
+
+    if write_behind is None:
+        # A write error is raised to the caller, which records the failure
+        write_micrograph_outputs(infilename, im, pixelsize, file_out, pickname, mxnew, mynew, mrnew, mpnew)
+        if manifest is not None:
+            manifest.finish(infilename, outputs, bad_vesicle_amplitude_threshold=bad_vesicle_amplitude_threshold)
+    else:
+        write_behind.submit(write_micrograph_outputs, infilename, im, pixelsize, file_out, pickname, mxnew, mynew,
+                            mrnew, mpnew, manifest, bad_vesicle_amplitude_threshold)
+
+    res = Struct()
+    res.bad_vesicle_amplitude_threshold = bad_vesicle_amplitude_threshold
+    res.mxnew = mxnew
+    res.mynew = mynew
+    res.mrnew = mrnew
+    res.mpnew = mpnew
+    res.outputs = outputs
+    if flag_return_images:
+        res.im0 = im0
+        res.im = im
+    return res
+
+
+def write_micrograph_outputs(infilename, im, pixelsize, file_out, pickname, mxnew, mynew, mrnew, mpnew,
+                             manifest=None, bad_vesicle_amplitude_threshold=None):
+    """
+    Write the subtracted micrograph and, if pickname is not None, the refitted vesicle information.
+    Each file is written to a temporary file and renamed, so a file with the output name is complete.
+    Then the micrograph is recorded as done in the manifest, if it is given. A write error is recorded
+    in the manifest and raised again. The manifest is given when the outputs are written in a WriteBehind
+    thread, where the caller of refit_subtract_micrograph does not see the error.
+    """
+    try:
+        replace_atomic(lambda filename: write_mrc(im, pixelsize, filename, 2), file_out)
         print(f'Subtracted image was saved to {file_out}')
+        outputs = [file_out]
 
-        if not flag_skip_refit_xy:  # vesicle informaiton is fitted
-            pickname = infilename[0: -4] + '_resub' + num2strn(model_type, 2) + '.txt'
-            write_ves_file(pickname, mxnew, mynew, mrnew, mpnew)
+        if pickname is not None:
+            replace_atomic(write_ves_file, pickname, mxnew, mynew, mrnew, mpnew)
             print(f'Vesicle info are saved to {pickname}')
+            outputs.append(pickname)
+    except Exception as err:
+        if manifest is not None:
+            manifest.fail(infilename, repr(err))
+        raise
 
-        if flag_display_image:
-            plt.subplot(1, 2, 1)
-
-            radius_decrease = np.round(nx / 100)
-            im0 = gauss_filt(im0, 0.15)
-            tt1 = add_circle(scale_image(im0), mxnew, mynew, mrnew / pixelsize - radius_decrease, 259, 10, 0, 0)
-            imcolor(tt1)
-            plt.title('Original')
-            plt.axis('image')
-
-            plt.subplot(1, 2, 2)
-            im = gauss_filt(im, 0.15)
-            # tt1 = add_circle(scale_image(im), mxnew, mynew, mrnew/pixelsize-radius_decrease, 259, 10, 0, 0)
-            imcolor(im)
-            plt.title('Vesicle subtracted')
-            plt.axis('image')
-
-            # plt.savefig(infilename[0: -4] + ".ps")
-            plt.show()
-            # plt.close()
+    if manifest is not None:
+        manifest.finish(infilename, outputs, bad_vesicle_amplitude_threshold=bad_vesicle_amplitude_threshold)
+
+
+def display_subtracted_micrograph(res, pixelsize):
+    """
+    Display the original and vesicle subtracted micrographs side by side.
+
+    args:
+        res: returned by refit_subtract_micrograph with flag_return_images set
+        pixelsize: in unit of angstrom per pixel
+    """
+    import matplotlib.pyplot as plt  # only when images are displayed
+    from import_rsc_functions import gauss_filt, add_circle, scale_image, imcolor
+
+    nx = res.im0.shape[0]
+
+    plt.subplot(1, 2, 1)
+
+    radius_decrease = np.round(nx / 100)
+    im0 = gauss_filt(res.im0, 0.15)
+    tt1 = add_circle(scale_image(im0), res.mxnew, res.mynew, res.mrnew / pixelsize - radius_decrease,
+                     259, 10, 0, 0)
+    imcolor(tt1)
+    plt.title('Original')
+    plt.axis('image')
+
+    plt.subplot(1, 2, 2)
+    im = gauss_filt(res.im, 0.15)
+    # tt1 = add_circle(scale_image(im), mxnew, mynew, mrnew/pixelsize-radius_decrease, 259, 10, 0, 0)
+    imcolor(im)
+    plt.title('Vesicle subtracted')
+    plt.axis('image')
+
+    # plt.savefig(infilename[0: -4] + ".ps")
+    plt.show()
+    # plt.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 # This is used to test the command line input
 
+import sys
 import getopt
+import inspect
 from batch_refit_subtract_new_withPOPC_in_folder_parfor_2019 \
     import batch_refit_subtract_new_withPOPC_in_folder_parfor_2019
+from watch_folder import watch_folder_refit_subtract
+from run_config import load_run_config
+from fft_backend import set_fft_backend
 
 
 def main(argv):
@@ -11,7 +16,19 @@ def main(argv):
     This is the wrapper to run batch_refit_subtract_new_withPOPC_in_folder_parfor_2018Aug.
     The input parameters are : file_pattern, pixelsize, model_type,
             ves_filename_after_base, ctf_filename_after_base, scaling_of_mp_if_skip_refit_xy = 0,
-            flag_mask_part_for_ves_fit = 0, flag_display_image = 0, star_filename_after_base = None
+            flag_mask_part_for_ves_fit = 0, flag_display_image = 0, star_filename_after_base = None,
+            n_jobs = 1, n_ves_workers = 1, profile_cache_file = None, fitter = 'fmin',
+            pyramid_levels, pyramid_xtol, pyramid_max_iter (comma separated, for fitter = 'pyramid';
+            pyramid_xtol and pyramid_max_iter have one value each for fitter = 'lm'),
+            lowpass (comma separated resolutions in angstrom of the first low-pass fits of 'lm' and 'pyramid'),
+            io_queue_depth = 0, n_to_delete_from_end_tobasename, flag_mask_edge, nx0, ny0, manifest_file = None,
+            shard = None, claim_dir = None, claim_timeout = 3600
+    fft_backend (numpy/scipy/pyfftw) and fft_workers choose the FFT library (see fft_backend).
+    With --watch, the folder is watched and the micrographs are processed as they arrive
+    (see watch_folder_refit_subtract), with poll_interval = 10, settle_time = 5 and max_idle = None.
+    They can also be given in a JSON or YAML run configuration (-g), with the parameter names as keys.
+    The command line overrides the run configuration. The user is asked for n_to_delete_from_end_tobasename,
+    flag_mask_edge, nx0 and ny0 only if they are not given and the program runs in a terminal.
     """
 
     msg_usage = 'batch_refit_vesicles.py ' \
@@ -20,34 +37,76 @@ def main(argv):
                 '-m <model_type>  ' \
                 '-v <ves_filename_after_base>  ' \
                 '-c <ctf_filename_after_base>  ' \
-                '[-s <scaling_of_mp_if_skip_refit_xy>  ' \
+                '[-g <run_config.json/yaml>  ' \
+                '-s <scaling_of_mp_if_skip_refit_xy>  ' \
                 '-a <flag_mask_part_for_ves_fit 1/0>  ' \
                 '-d <flag_display_image 1/0>  ' \
-                '-r <star_filename_after_base>]'
+                '-r <star_filename_after_base>  ' \
+                '-j <n_jobs>  ' \
+                '-w <n_ves_workers>  ' \
+                '-k <profile_cache_file.npz>  ' \
+                '-t <fitter fmin/lm/pyramid>  ' \
+                '-l <pyramid_levels e.g. 4,2>  ' \
+                '-x <pyramid_xtol e.g. 1,0.5,0.1>  ' \
+                '-i <pyramid_max_iter e.g. 50,10,5>  ' \
+                '--lowpass <resolutions of the lm and pyramid fitters e.g. 80,40>  ' \
+                '-q <io_queue_depth>  ' \
+                '-b <n_to_delete_from_end_tobasename>  ' \
+                '-e <flag_mask_edge 1/0>  ' \
+                '--nx0 <image size in X before padding>  ' \
+                '--ny0 <image size in Y before padding>  ' \
+                '-n <manifest_file.jsonl>  ' \
+                '--shard <i/N>  ' \
+                '--claim_dir <folder shared by the nodes>  ' \
+                '--claim_timeout <seconds>  ' \
+                '--fft_backend <numpy/scipy/pyfftw>  ' \
+                '--fft_workers <threads of each FFT>  ' \
+                '--watch  ' \
+                '--poll_interval <seconds>  ' \
+                '--settle_time <seconds>  ' \
+                '--max_idle <seconds>]'
 
     print('------------------------')
     print(f"Original command: {argv}")
     print('------------------------')
 
-    # If no name is given, exit.
-    if len(argv) < 6:
-        print('Not enough parameters.')
-        print(msg_usage)
-        sys.exit(2)
-
     argv = argv[1:]
 
     try:
-        opts, args = getopt.getopt(argv, "f:p:m:v:c:s:a:d:r:", [
+        opts, args = getopt.getopt(argv, "hf:p:m:v:c:g:s:a:d:r:j:w:k:t:l:x:i:q:b:e:n:", [
             "file_pattern=",
             "pixelsize=",
             "model_type=",
             "ves_filename_after_base=",
             "ctf_filename_after_base=",
+            "config=",
             "scaling_of_mp_if_skip_refit_xy=",
             "flag_mask_part_for_ves_fit=",
             "flag_display_image=",
-            "star_filename_after_base="])
+            "star_filename_after_base=",
+            "n_jobs=",
+            "n_ves_workers=",
+            "profile_cache_file=",
+            "fitter=",
+            "pyramid_levels=",
+            "pyramid_xtol=",
+            "pyramid_max_iter=",
+            "lowpass=",
+            "io_queue_depth=",
+            "n_to_delete_from_end_tobasename=",
+            "flag_mask_edge=",
+            "nx0=",
+            "ny0=",
+            "manifest_file=",
+            "shard=",
+            "claim_dir=",
+            "claim_timeout=",
+            "fft_backend=",
+            "fft_workers=",
+            "watch",
+            "poll_interval=",
+            "settle_time=",
+            "max_idle="])
     except getopt.GetoptError:
         print('Wrong input parameters.')
         print(msg_usage)
@@ -56,11 +115,27 @@ def main(argv):
     # print(f'opts: {opts}')
     # print(f"args: {args}")
 
-    # Set default value of optional variables
-    scaling_of_mp_if_skip_refit_xy = 0
-    flag_mask_part_for_ves_fit = 0
-    flag_display_image = 0
-    star_filename_after_base = None
+    # The run configuration is read first, so the command line overrides it.
+    # Its keys are the parameters of the batch or the watch function, or the options of this wrapper.
+    known_keys = set(inspect.signature(batch_refit_subtract_new_withPOPC_in_folder_parfor_2019).parameters)
+    known_keys |= set(inspect.signature(watch_folder_refit_subtract).parameters)
+    known_keys |= {'pyramid_levels', 'pyramid_xtol', 'pyramid_max_iter', 'lowpass', 'fft_backend', 'fft_workers',
+                   'watch'}
+    params = {}
+    for opt, arg in opts:
+        if opt in ("-g", "--config"):
+            config = load_run_config(arg)
+            unknown = [key for key in config if key not in known_keys]
+            if unknown:
+                print(f'Unknown parameters in {arg}: ' + ', '.join(unknown))
+                print(msg_usage)
+                sys.exit(2)
+            params.update(config)
+
+    fit_options = params.pop('fit_options', None) or {}
+    for key in ('pyramid_levels', 'pyramid_xtol', 'pyramid_max_iter', 'lowpass'):
+        if key in params:
+            fit_options[key.replace('pyramid_', '')] = tuple(params.pop(key))
 
     # extract from opts
     for opt, arg in opts:
@@ -68,42 +143,123 @@ def main(argv):
             print(msg_usage)
             sys.exit()
         elif opt in ("-f", "--file_pattern"):
-            file_pattern = arg
+            params['file_pattern'] = arg
         elif opt in ("-p", "--pixelsize"):
-            pixelsize = float(arg)
+            params['pixelsize'] = float(arg)
         elif opt in ("-m", "--model_type"):
-            model_type = int(arg)
+            params['model_type'] = int(arg)
         elif opt in ("-v", "--ves_filename_after_base"):
-            ves_filename_after_base = arg
+            params['ves_filename_after_base'] = arg
         elif opt in ("-c", "--ctf_filename_after_base"):
-            ctf_filename_after_base = arg
+            params['ctf_filename_after_base'] = arg
         elif opt in ("-s", "--scaling_of_mp_if_skip_refit_xy"):
-            scaling_of_mp_if_skip_refit_xy = float(arg)
+            params['scaling_of_mp_if_skip_refit_xy'] = float(arg)
         elif opt in ("-a", "--flag_mask_part_for_ves_fit"):
-            flag_mask_part_for_ves_fit = int(arg)
+            params['flag_mask_part_for_ves_fit'] = int(arg)
         elif opt in ("-d", "--flag_display_image"):
-            flag_display_image = int(arg)
+            params['flag_display_image'] = int(arg)
         elif opt in ("-r", "--star_filename_after_base"):
-            star_filename_after_base = arg
+            params['star_filename_after_base'] = arg
+        elif opt in ("-j", "--n_jobs"):
+            params['n_jobs'] = int(arg)
+        elif opt in ("-w", "--n_ves_workers"):
+            params['n_ves_workers'] = int(arg)
+        elif opt in ("-k", "--profile_cache_file"):
+            params['profile_cache_file'] = arg
+        elif opt in ("-t", "--fitter"):
+            params['fitter'] = arg
+        elif opt in ("-l", "--pyramid_levels"):
+            fit_options['levels'] = tuple(int(v) for v in arg.split(','))
+        elif opt in ("-x", "--pyramid_xtol"):
+            fit_options['xtol'] = tuple(float(v) for v in arg.split(','))
+        elif opt in ("-i", "--pyramid_max_iter"):
+            fit_options['max_iter'] = tuple(int(v) for v in arg.split(','))
+        elif opt == "--lowpass":
+            fit_options['lowpass'] = tuple(float(v) for v in arg.split(','))
+        elif opt in ("-q", "--io_queue_depth"):
+            params['io_queue_depth'] = int(arg)
+        elif opt in ("-b", "--n_to_delete_from_end_tobasename"):
+            params['n_to_delete_from_end_tobasename'] = int(arg)
+        elif opt in ("-e", "--flag_mask_edge"):
+            params['flag_mask_edge'] = int(arg)
+        elif opt == "--nx0":
+            params['nx0'] = int(arg)
+        elif opt == "--ny0":
+            params['ny0'] = int(arg)
+        elif opt in ("-n", "--manifest_file"):
+            params['manifest_file'] = arg
+        elif opt == "--shard":
+            params['shard'] = arg
+        elif opt == "--claim_dir":
+            params['claim_dir'] = arg
+        elif opt == "--claim_timeout":
+            params['claim_timeout'] = float(arg)
+        elif opt == "--fft_backend":
+            params['fft_backend'] = arg
+        elif opt == "--fft_workers":
+            params['fft_workers'] = int(arg)
+        elif opt == "--watch":
+            params['watch'] = 1
+        elif opt == "--poll_interval":
+            params['poll_interval'] = float(arg)
+        elif opt == "--settle_time":
+            params['settle_time'] = float(arg)
+        elif opt == "--max_idle":
+            params['max_idle'] = float(arg)
+
+    # If a required parameter is not given, exit.
+    required = ['file_pattern', 'pixelsize', 'model_type', 'ves_filename_after_base', 'ctf_filename_after_base']
+    missing = [key for key in required if key not in params]
+    if missing:
+        print('Not enough parameters: ' + ', '.join(missing))
+        print(msg_usage)
+        sys.exit(2)
+
+    if params.get('fitter', 'fmin') == 'pyramid' and fit_options:
+        # Check the pyramid options here, so a wrong one fails before the run starts
+        n_levels = len(fit_options.get('levels', (4,))) + 1
+        for key in ('xtol', 'max_iter'):
+            if key in fit_options and len(fit_options[key]) != n_levels:
+                print(f'Wrong pyramid_{key}: it needs one value for each pyramid level and the full resolution '
+                      f'({n_levels} values), not {len(fit_options[key])}.')
+                print(msg_usage)
+                sys.exit(2)
+        params['fit_options'] = fit_options
+    elif params.get('fitter', 'fmin') == 'lm' and fit_options:
+        # sphere_fit_lm has one xtol and one max_iter, and no levels
+        if 'levels' in fit_options:
+            print('*** pyramid_levels is not used by the lm fitter.')
+            del fit_options['levels']
+        for key in ('xtol', 'max_iter'):
+            if isinstance(fit_options.get(key), (tuple, list)):
+                if len(fit_options[key]) != 1:
+                    print(f'Wrong pyramid_{key}: the lm fitter needs one value, not {len(fit_options[key])}.')
+                    print(msg_usage)
+                    sys.exit(2)
+                fit_options[key] = fit_options[key][0]
+        params['fit_options'] = fit_options
+    elif fit_options:
+        print('*** The fit options ' + ', '.join(fit_options) + ' are not used by the fmin fitter.')
+
+    # The FFT library is set for this process and the processes it starts
+    fft_backend = params.pop('fft_backend', None)
+    fft_workers = params.pop('fft_workers', None)
+    if fft_backend is not None or fft_workers is not None:
+        print('*** FFT backend: {} with {} workers'.format(*set_fft_backend(fft_backend, fft_workers)))
 
     # run the program
-    batch_refit_subtract_new_withPOPC_in_folder_parfor_2019(
-        file_pattern, pixelsize, model_type,
-        ves_filename_after_base, ctf_filename_after_base,
-        scaling_of_mp_if_skip_refit_xy,
-        flag_mask_part_for_ves_fit, flag_display_image,
-        star_filename_after_base)
+    if params.pop('watch', 0):
+        for key in ('n_jobs', 'io_queue_depth', 'shard', 'flag_mask_part_for_ves_fit', 'flag_display_image'):
+            if key in params:
+                print(f'*** {key} is not used when watching a folder.')
+                del params[key]
+        params.setdefault('n_to_delete_from_end_tobasename', None)
+        watch_folder_refit_subtract(**params)
+    else:
+        for key in ('poll_interval', 'settle_time', 'max_idle'):
+            params.pop(key, None)
+        batch_refit_subtract_new_withPOPC_in_folder_parfor_2019(**params)
 
 
 if __name__ == "__main__":
-    import sys
-    try:
-        if sys.stdin.isatty():  # In a terminal
-            # print('This is running in a terminal.')
-            # print(f'{repr(sys.argv)}')
-            main(sys.argv)
-        else:
-            print('This is running in Pycharm.')
-    except AttributeError:  # stdin is NoneType if not in terminal mode
-        print('The program has some errors.')
-        pass
+    main(sys.argv)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import numpy as np
+from fft_backend import fft_backends, set_fft_backend, rfftn, irfftn
+from real_fft import next_fast_size
+
+
+def benchmark_fft(sizes=(190, 256, 290, 380, 512, 758, 1024), backends=fft_backends, workers=None, n_repeat=20):
+    """
+    Time a pair of rfftn and irfftn of an n x n box for each FFT backend, as done for each model of a
+    vesicle (the box is 4 times the vesicle radius; 190 to 758 pixels for radii of 100 to 400 A at 1.056 A).
+
+    args:
+        sizes: box sizes
+        backends: names of the backends (see fft_backend)
+        workers: number of threads of each FFT. None: the default of set_fft_backend.
+        n_repeat: number of pairs timed for each size. The fastest of 3 runs is reported.
+
+    returns:
+        a dictionary of (backend, workers): list of times in ms for the sizes
+    """
+    times = {}
+    print('backend  workers  ' + ''.join(f'{n:>9d}' for n in sizes) + '   (ms per rfftn + irfftn)')
+    for backend in backends:
+        name, workers_used = set_fft_backend(backend, workers)
+        if name != backend:
+            continue
+        t_backend = []
+        for n in sizes:
+            data = np.random.default_rng(0).standard_normal((n, n))
+            irfftn(rfftn(data), data.shape)  # plan
+            best = np.inf
+            for __ in range(3):
+                t0 = time.perf_counter()
+                for __ in range(n_repeat):
+                    irfftn(rfftn(data), data.shape)
+                best = min(best, (time.perf_counter() - t0) / n_repeat)
+            t_backend.append(best * 1000)
+        times[(name, workers_used)] = t_backend
+        print(f'{name:8s} {workers_used:7d}  ' + ''.join(f'{t:9.2f}' for t in t_backend))
+    return times
+
+
+def benchmark_box_sizes(radii=np.arange(80, 401, 10), pixelsize=1.056, n_repeat=10):
+    """
+    Time a pair of rfftn and irfftn of the box of a vesicle of each radius, with the box of 4 times the radius
+    (cutw) and padded to next_fast_size(cutw), as in crop_vesicle_box. The FFT backend in use is timed.
+
+    args:
+        radii: vesicle radii in unit of angstrom
+        pixelsize: in unit of angstrom
+        n_repeat: number of pairs timed for each size. The fastest of 3 runs is reported.
+
+    returns:
+        total time in ms of all radii for the cutw boxes and the padded boxes
+    """
+    def time_size(n):
+        data = np.random.default_rng(0).standard_normal((n, n))
+        irfftn(rfftn(data), data.shape)
+        best = np.inf
+        for __ in range(3):
+            t0 = time.perf_counter()
+            for __ in range(n_repeat):
+                irfftn(rfftn(data), data.shape)
+            best = min(best, (time.perf_counter() - t0) / n_repeat)
+        return best * 1000
+
+    total = np.zeros(2)
+    print('radius (A)   cutw  time (ms)   padded  time (ms)')
+    for r in radii:
+        cutw = int(np.round(r / pixelsize * 2) * 2)
+        n_fast = next_fast_size(cutw)
+        t = np.array([time_size(cutw), time_size(n_fast)])
+        total += t
+        print(f'{r:10.0f} {cutw:6d} {t[0]:10.2f} {n_fast:8d} {t[1]:10.2f}')
+    print(f'total: {total[0]:.1f} ms for cutw, {total[1]:.1f} ms padded')
+    return total
+
+
+if __name__ == '__main__':
+    # python benchmark_fft.py [workers]
+    benchmark_fft(workers=int(sys.argv[1]) if len(sys.argv) > 1 else None)
+    set_fft_backend('numpy')  # the box sizes with the default backend
+    benchmark_box_sizes()
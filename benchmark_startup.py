@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import subprocess
+import time
+import numpy as np
+
+
+def benchmark_startup(module_names=('batch_refit_subtract_new_withPOPC_in_folder_parfor_2019',), n_repeat=5,
+                      n_top=10):
+    """
+    Measure the time to start python and import a module in a new process, as a short batch job does.
+
+    args:
+        module_names: modules to import
+        n_repeat: number of processes for each module. The median time is reported.
+        n_top: number of the slowest imports (python -X importtime) to print
+
+    returns:
+        a dictionary of module name: median time in seconds
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+    for name in module_names:
+        command = [sys.executable, '-c', f'import {name}']
+        t = []
+        for __ in range(n_repeat):
+            t0 = time.perf_counter()
+            subprocess.run(command, cwd=folder, check=True)
+            t.append(time.perf_counter() - t0)
+        times[name] = float(np.median(t))
+        loaded = subprocess.run([sys.executable, '-c', f'import sys, {name}; print("matplotlib" in sys.modules)'],
+                                cwd=folder, check=True, capture_output=True, text=True).stdout.strip()
+        print(f'*** {name}: {times[name]:.3f} s (median of {n_repeat}), matplotlib imported: {loaded}')
+
+        if n_top > 0:
+            lines = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {name}'], cwd=folder,
+                                   check=True, capture_output=True, text=True).stderr.splitlines()
+            imports = []
+            for line in lines[1:]:  # the first line is the title
+                self_us, cumulative_us, module = line.split(':', 1)[1].split('|')
+                imports.append((int(cumulative_us), int(self_us), module.rstrip()))
+            print('    cumulative (ms)  self (ms)  module')
+            for cumulative_us, self_us, module in sorted(imports, reverse=True)[0: n_top]:
+                print(f'    {cumulative_us / 1000:15.1f}  {self_us / 1000:9.1f}  {module}')
+    return times
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] if len(sys.argv) > 1 else \
+        ['batch_refit_subtract_new_withPOPC_in_folder_parfor_2019', 'batch_refit_vesicles', 'rsc_server', 'numpy']
+    benchmark_startup(names)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import numpy as np
+import numpy.fft as npfft
+from real_fft import rfftn
+
+
+class CcReferenceBank():
+    """
+    Cache of the spectra of a stack of references used by make_cc_map_mem.
+
+    The references (e.g. the vesicle models of creat_ref_lib3) are the same for all micrographs of a
+    data set. So each reference is padded to the micrograph size, fftshifted and Fourier transformed
+    once, and the conjugate spectra are kept for the next micrographs. The references are transformed
+    in blocks of block_size along a leading axis. The spectra are kept as complex64 half spectra
+    (see real_fft) for each (micrograph shape, block). The least recently used blocks are evicted when
+    the total size is larger than max_bytes, so max_bytes=0 keeps only one block in memory.
+    The returned arrays are read-only.
+
+    attributes:
+        n_refs: number of references
+        block_size: number of references in a block
+        n_hit: number of blocks found in the bank
+        n_miss: number of blocks calculated
+        nbytes: memory used by the spectra in the bank
+
+    methods:
+        n_blocks: number of blocks
+        get: get the conjugate spectra of a block of references for a micrograph shape
+        report: a string of hit/miss counts
+        clear: remove all spectra
+    """
+
+    def __init__(self, vesicle_array, block_size=1, max_bytes=1024 * 2 ** 20):
+        """
+        args:
+            vesicle_array: nr1 x nr2 x N stack of references, or one nr1 x nr2 reference.
+                The references are centered and not larger than the micrographs.
+            block_size: number of references transformed together
+            max_bytes: memory cap of the bank in bytes
+        """
+        vesicle_array = np.asarray(vesicle_array)
+        if vesicle_array.ndim == 2:
+            vesicle_array = vesicle_array[:, :, np.newaxis]
+        self.vesicle_array = vesicle_array
+        self.n_refs = vesicle_array.shape[2]
+        self.block_size = max(int(block_size), 1)
+        self.max_bytes = max_bytes
+        self.n_hit = 0
+        self.n_miss = 0
+        self.nbytes = 0
+        self._bank = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def n_blocks(self):
+        return (self.n_refs + self.block_size - 1) // self.block_size
+
+    def get(self, shape, k):
+        """
+        Get the conjugate spectra of the references of block k, padded to a micrograph of this shape.
+
+        args:
+            shape: (ns1, ns2) of the micrograph
+            k: block index. The block has the references k * block_size to (k + 1) * block_size - 1.
+
+        returns:
+            a read-only complex64 array of (number of references in the block, ns1, ns2 // 2 + 1)
+        """
+        ns1, ns2 = int(shape[0]), int(shape[1])
+        key = (ns1, ns2, int(k))
+        with self._lock:
+            spec = self._bank.get(key)
+            if spec is not None:
+                self._bank.move_to_end(key)
+                self.n_hit += 1
+                return spec
+            self.n_miss += 1
+
+        i0 = k * self.block_size
+        i1 = min(i0 + self.block_size, self.n_refs)
+        nr1, nr2 = self.vesicle_array.shape[0: 2]
+        if nr1 > ns1 or nr2 > ns2:
+            raise ValueError(f'The references ({nr1}x{nr2}) are bigger than the micrograph ({ns1}x{ns2}).')
+
+        # Pad the references at the center as pad_pic does
+        refs = np.zeros((i1 - i0, ns1, ns2), dtype=np.float32)
+        x0 = ns1 // 2 - nr1 // 2
+        y0 = ns2 // 2 - nr2 // 2
+        refs[:, x0: x0 + nr1, y0: y0 + nr2] = np.moveaxis(self.vesicle_array[:, :, i0: i1], 2, 0)
+        spec = np.conj(rfftn(npfft.fftshift(refs, axes=(1, 2)), axes=(1, 2))).astype(np.complex64)
+        spec.setflags(write=False)
+
+        with self._lock:
+            if key not in self._bank:
+                self._bank[key] = spec
+                self.nbytes += spec.nbytes
+            # Evict the least recently used blocks, but keep the one just calculated
+            while self.nbytes > self.max_bytes and len(self._bank) > 1:
+                __, spec_old = self._bank.popitem(last=False)
+                self.nbytes -= spec_old.nbytes
+        return spec
+
+    def clear(self):
+        with self._lock:
+            self._bank.clear()
+            self.nbytes = 0
+
+    def report(self):
+        return 'Reference bank: {} hits, {} misses, {} blocks, {:.1f} MB'.format(
+            self.n_hit, self.n_miss, len(self._bank), self.nbytes / 2 ** 20)
+
+
+if __name__ == '__main__':
+    from pad_pic import pad_pic
+
+    refs = np.random.default_rng(0).standard_normal((40, 40, 5))
+    bank = CcReferenceBank(refs, block_size=2, max_bytes=2 ** 20)
+    for k in [0, 1, 2, 0, 1, 2]:
+        spec = bank.get((64, 64), k)
+    print(bank.report())
+    assert bank.n_blocks() == 3 and bank.n_hit == 3 and spec.shape == (1, 64, 33)
+    expected = np.conj(np.fft.rfft2(np.fft.fftshift(pad_pic(refs[:, :, 4], 64, 64, 0))))
+    print(np.max(np.abs(spec[0] - expected)) / np.max(np.abs(expected)))
+
+    # make_cc_map_mem gives the same maps with any blocks, threads or a bank
+    from make_cc_map_mem import make_cc_map_mem
+    data = np.random.default_rng(1).standard_normal((64, 64))
+    ccm, cci = make_cc_map_mem(data, refs)
+    for args in [(refs, 2), (refs, 3, 2), (None, 1, 1, bank), (None, 1, 2, bank)]:
+        ccm2, cci2 = make_cc_map_mem(data, *args)
+        assert np.array_equal(ccm2, ccm) and np.array_equal(cci2, cci)
+    print(bank.report())
@@ -2,6 +2,7 @@
 
 # import scipy.io
 import numpy.fft as npfft
+from real_fft import half_plane, filter_real
 from ctf_lwq import *
 from ves_density_circular import *
 
@@ -35,6 +36,7 @@ def creat_ref_lib3(n, a_per_pixel, r_in_a_min, r_in_a_max, r_step_in_a, defocus,
     # res = a_per_pixel
     if flag_ctf:
         hh = ctf_lwq(n, a_per_pixel, _lambda, defocus, cs, bfact, qfact)
+        hh_half = half_plane(npfft.fftshift(hh))
 
     rval = np.arange(r_in_a_min, r_in_a_max, r_step_in_a)
     vesicle_array = np.zeros((n, n, len(rval)))
@@ -43,7 +45,7 @@ def creat_ref_lib3(n, a_per_pixel, r_in_a_min, r_in_a_max, r_step_in_a, defocus,
         r_array[r_count] = r
         t1 = ves_density_circular(n, a_per_pixel, r, d_in_a)
         if flag_ctf:
-            t1 = np.real(npfft.ifftn(npfft.fftn(t1) * npfft.fftshift(hh)))
+            t1 = filter_real(t1, hh_half)
 
         # TODO: plot image
         # if usejava('jvm')
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import numpy as np
+from get_ctf_for_vesicle_subtraction import get_ctf_for_vesicle_subtraction
+from real_fft import half_plane
+
+
+class CtfBank():
+    """
+    Cache of CTFs used for vesicle fitting and subtraction.
+
+    The vesicle box sizes come from a small set of radii while the CTF parameters are fixed for a
+    micrograph. So the CTF is calculated once for each (n_here, pixelsize, CTF parameters) and reused.
+    The least recently used CTFs are evicted when the total size is larger than max_bytes.
+    The returned arrays are read-only. The half of a CTF used with rfftn (see real_fft) is kept
+    in the bank apart from the full CTF.
+
+    attributes:
+        n_hit: number of CTFs found in the bank
+        n_miss: number of CTFs calculated
+        nbytes: memory used by the CTFs in the bank
+
+    methods:
+        get: get the CTF for a box (same arguments as get_ctf_for_vesicle_subtraction)
+        report: a string of hit/miss counts
+        clear: remove all CTFs
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        """
+        args:
+            max_bytes: memory cap of the bank in bytes
+        """
+        self.max_bytes = max_bytes
+        self.n_hit = 0
+        self.n_miss = 0
+        self.nbytes = 0
+        self._bank = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, info_ctf, pixelsize, n_here, flag_half=0):
+        """
+        Get the ctf for vesicle subtraction, which is not centered and ready to use.
+
+        args:
+            info_ctf: a dictionary for CTF parameters
+            pixelsize: in unit of angstrom per pixel
+            n_here: image size
+            flag_half: 1 to get the n_here x (n_here // 2 + 1) half_plane of the CTF, for rfftn
+
+        returns:
+            a read-only 2D array
+        """
+        key = (int(n_here), float(pixelsize), ctf_key(info_ctf), int(bool(flag_half)))
+        with self._lock:
+            ctf = self._bank.get(key)
+            if ctf is not None:
+                self._bank.move_to_end(key)
+                self.n_hit += 1
+                return ctf
+            self.n_miss += 1
+
+        if flag_half:
+            ctf = half_plane(self.get(info_ctf, pixelsize, n_here))
+        else:
+            ctf = get_ctf_for_vesicle_subtraction(info_ctf, pixelsize, n_here)
+        ctf.setflags(write=False)
+
+        with self._lock:
+            if key not in self._bank:
+                self._bank[key] = ctf
+                self.nbytes += ctf.nbytes
+            # Evict the least recently used CTFs, but keep the one just calculated
+            while self.nbytes > self.max_bytes and len(self._bank) > 1:
+                __, ctf_old = self._bank.popitem(last=False)
+                self.nbytes -= ctf_old.nbytes
+        return ctf
+
+    def clear(self):
+        with self._lock:
+            self._bank.clear()
+            self.nbytes = 0
+
+    def report(self):
+        return 'CTF bank: {} hits, {} misses, {} CTFs, {:.1f} MB'.format(
+            self.n_hit, self.n_miss, len(self._bank), self.nbytes / 2 ** 20)
+
+
+def ctf_key(info_ctf):
+    """
+    A hashable key of the CTF parameters.
+    """
+    if isinstance(info_ctf, dict):
+        items = info_ctf.items()
+    else:
+        items = vars(info_ctf).items()
+    return tuple(sorted((k, v) for k, v in items if np.isscalar(v)))
+
+
+_default_ctf_bank = None
+
+
+def default_ctf_bank():
+    """
+    The CTF bank shared by all micrographs in this process.
+    """
+    global _default_ctf_bank
+    if _default_ctf_bank is None:
+        _default_ctf_bank = CtfBank()
+    return _default_ctf_bank
+
+
+if __name__ == '__main__':
+    info_ctf = {"defocus": 1.4398, "bfactor": 48, "lambda": 0.0197, "Cs": 2.7, "qfactor": 0.07, "flag_prewhiten": 0,
+                "deltadef": 0.0073, "theta": 0.3649}
+    bank = CtfBank(max_bytes=8 * 2 ** 20)
+    for n_here in [450, 380, 450, 450, 512, 380, 800, 450]:
+        ctf = bank.get(info_ctf, 1.056, n_here)
+    print(bank.report())
+    print(np.max(np.abs(bank.get(info_ctf, 1.056, 450) - get_ctf_for_vesicle_subtraction(info_ctf, 1.056, 450))))
+    print(bank.get(info_ctf, 1.056, 450, 1).shape, bank.report())
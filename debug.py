@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import scipy.io
 import inspect
 
 # the global variable to check whether it is in debug mode
@@ -24,6 +23,7 @@ def debug_print(*args, **kwargs):
 
 @debugFunction
 def load_mat_var(matfile, var):
+    import scipy.io
     f = scipy.io.loadmat(matfile)
     # print(f.keys())
     # print(var in f.keys())
@@ -36,6 +36,7 @@ def load_mat_var(matfile, var):
 
 @debugFunction
 def save_mat_var(matfile, varname, var):
+    import scipy.io
     scipy.io.savemat(matfile, {varname: var})
 
 def testFunction():
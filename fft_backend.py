@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# The FFT library used by all FFTs of rsc (through real_fft and the functions below).
+#
+# The backend is chosen by the environment variables
+#     RSC_FFT_BACKEND: numpy (default), scipy or pyfftw
+#     RSC_FFT_WORKERS: number of threads of each FFT for scipy and pyfftw (default: number of cpus in the
+#         main process, 1 in the worker processes of a process pool, which already use the cpus)
+#     RSC_FFT_WISDOM: a file to keep the FFTW plans (wisdom) of pyfftw between runs
+# or by set_fft_backend, e.g. from the fft_backend key of a run configuration.
+
+import os
+import atexit
+import pickle
+import multiprocessing
+import numpy.fft as npfft
+
+fft_backends = ('numpy', 'scipy', 'pyfftw')
+
+_state = {}
+_wisdom_files_saved_at_exit = set()
+
+
+def set_fft_backend(name=None, workers=None, wisdom_file=None):
+    """
+    Choose the FFT library.
+
+    The choice is also put in the environment variables, so processes started later (e.g. a process
+    pool) use the same backend. workers is put there only if it is given, so that each process of a pool
+    uses one thread by default instead of all the cpus.
+
+    args:
+        name: 'numpy', 'scipy' (scipy.fft with workers threads) or 'pyfftw' (pyFFTW with workers threads,
+            plans cached and kept in wisdom_file). None: RSC_FFT_BACKEND or 'numpy'.
+            A backend that cannot be imported falls back to numpy with a message.
+        workers: number of threads of each FFT. None: RSC_FFT_WORKERS, or else the number of cpus in the main
+            process and 1 in a process started by multiprocessing (e.g. the pool of batch_refit_vesicles -j).
+        wisdom_file: a file to load the FFTW wisdom from and save it to at exit (pyfftw only).
+            None: RSC_FFT_WISDOM, or no file.
+
+    returns:
+        (name, workers) of the backend used
+    """
+    if name is None:
+        name = os.environ.get('RSC_FFT_BACKEND', 'numpy')
+    name = name.lower()
+    if name not in fft_backends:
+        raise ValueError(f'Unknown FFT backend {name}. It must be one of {fft_backends}.')
+    flag_workers_given = workers is not None
+    if workers is None and 'RSC_FFT_WORKERS' in os.environ:
+        workers = int(os.environ['RSC_FFT_WORKERS'])
+    elif workers is None:
+        workers = 1 if multiprocessing.parent_process() is not None else (os.cpu_count() or 1)
+    if wisdom_file is None:
+        wisdom_file = os.environ.get('RSC_FFT_WISDOM')
+
+    try:
+        if name == 'scipy':
+            functions = _scipy_functions(workers)
+        elif name == 'pyfftw':
+            functions = _pyfftw_functions(workers, wisdom_file)
+        else:
+            functions = _numpy_functions()
+    except ImportError as err:
+        print(f'*** FFT backend {name} is not available ({err}). numpy is used.')
+        name = 'numpy'
+        functions = _numpy_functions()
+    _state.clear()
+    _state.update(functions, name=name, workers=1 if name == 'numpy' else workers)
+    os.environ['RSC_FFT_BACKEND'] = name
+    if flag_workers_given:
+        os.environ['RSC_FFT_WORKERS'] = str(workers)
+    if wisdom_file is not None:
+        os.environ['RSC_FFT_WISDOM'] = wisdom_file
+    return name, _state['workers']
+
+
+def get_fft_backend():
+    """
+    returns:
+        (name, workers) of the backend in use
+    """
+    if not _state:
+        set_fft_backend()
+    return _state['name'], _state['workers']
+
+
+def _numpy_functions():
+    return {'fftn': npfft.fftn, 'ifftn': npfft.ifftn, 'rfftn': npfft.rfftn, 'irfftn': npfft.irfftn}
+
+
+def _scipy_functions(workers):
+    import scipy.fft
+
+    def wrap(function):
+        return lambda a, s=None, axes=None: function(a, s, axes, workers=workers)
+
+    return {'fftn': wrap(scipy.fft.fftn), 'ifftn': wrap(scipy.fft.ifftn), 'rfftn': wrap(scipy.fft.rfftn),
+            'irfftn': wrap(scipy.fft.irfftn)}
+
+
+def _pyfftw_functions(workers, wisdom_file):
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as fftw
+
+    # Keep the plans of the recent sizes, as the vesicle boxes come from a small set of sizes
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(600)
+    if wisdom_file is not None:
+        if os.path.exists(wisdom_file):
+            with open(wisdom_file, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        if wisdom_file not in _wisdom_files_saved_at_exit:
+            _wisdom_files_saved_at_exit.add(wisdom_file)
+            atexit.register(_save_wisdom, wisdom_file)
+
+    def wrap(function):
+        return lambda a, s=None, axes=None: function(a, s, axes, threads=workers, planner_effort='FFTW_MEASURE')
+
+    return {'fftn': wrap(fftw.fftn), 'ifftn': wrap(fftw.ifftn), 'rfftn': wrap(fftw.rfftn),
+            'irfftn': wrap(fftw.irfftn)}
+
+
+def _save_wisdom(wisdom_file):
+    import pyfftw
+    tmp_file = wisdom_file + '.part' + str(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+    os.replace(tmp_file, wisdom_file)
+
+
+def fftn(a, s=None, axes=None):
+    if not _state:
+        set_fft_backend()
+    return _state['fftn'](a, s, axes)
+
+
+def ifftn(a, s=None, axes=None):
+    if not _state:
+        set_fft_backend()
+    return _state['ifftn'](a, s, axes)
+
+
+def rfftn(a, s=None, axes=None):
+    if not _state:
+        set_fft_backend()
+    return _state['rfftn'](a, s, axes)
+
+
+def irfftn(a, s=None, axes=None):
+    if not _state:
+        set_fft_backend()
+    return _state['irfftn'](a, s, axes)
+
+
+if __name__ == '__main__':
+    import numpy as np
+
+    data = np.random.default_rng(0).standard_normal((300, 300))
+    for backend in fft_backends:
+        print(set_fft_backend(backend))
+        assert np.allclose(irfftn(rfftn(data), data.shape), data)
+        assert np.allclose(fftn(data), npfft.fftn(data))
+        assert np.allclose(ifftn(fftn(data)).real, data)
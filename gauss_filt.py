@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import numpy as np
+from real_fft import half_plane, filter_real, rfftn, irfftn
 
 
 def gauss_filt(iin, fc, stack=0):
@@ -62,24 +63,16 @@ def gauss_filt(iin, fc, stack=0):
 
     q = np.fft.fftshift(q)
 
+    # The output is real, so only the half spectrum is used
+    q = half_plane(q)
     if ns == 1:
-        fq = q * np.fft.fftn(iin)
-        out = np.real(np.fft.ifftn(fq))
+        out = filter_real(iin, q)
 
     else:
+        axes = tuple(range(nd))
         out = np.zeros_like(iin)
         for ii in range(ns):
-            if nd == 1:
-                fq = q * np.fft.fft(iin[:, ii])
-                out[:, ii] = np.real(np.fft.ifft(fq))
-
-            elif nd == 2:
-                fq = q * np.fft.fft2(iin[:, :, ii])
-                out[:, :, ii] = np.real(np.fft.ifft2(fq))
-
-            elif nd == 3:
-                fq = q * np.fft.fftn(iin[:, :, :, ii])
-                out[:, :, :, ii] = np.real(np.fft.ifftn(fq))
+            out[..., ii] = irfftn(rfftn(iin[..., ii], axes) * q, iin.shape[0: nd], axes)
 
     return out
 
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import debug
+
+
+def generate_3d_map_radial_abel(fx, fy, r_here, half_size, flag_accuracy=4):
+    """
+    Same as generate_3d_map_radial_2018, but the projected radial profile is calculated on a 1D grid.
+
+    The membrane profile (fx, fy) is linear between its nodes, so the projection along z of each
+    linear piece has a closed form (Abel projection). The projected profile on the grid
+    x = 0:da:half_size is the sum over the pieces, and the 2D image is painted from it by one radial
+    interpolation. generate_3d_map_radial_2018 sums the profile over a (half_size/da)^2 x-z slice
+    instead. The rectangle-rule terms of that sum (the last z sample, and the half weight of the
+    first pixel near the equator) are kept so that the output stays the same.
+
+    args:
+        (fx,fy) is the function which defines the radial density of the membrane.
+                fx: in unit of pixels
+                fx,fy should include the whole membrane (e.g. -30A to 30A)
+        r_here: radius in unit of pixels
+        half_size: half of the image size
+        flag_accuracy: number of samples per pixel of the projected profile
+        r, fx and half_size are of the same unit.
+
+    returns:
+        pm1: the projection of a 3D vesicle
+    """
+    fx = np.asarray(fx, dtype=float)
+    fy = np.asarray(fy, dtype=float)
+    r_here = float(np.squeeze(r_here))
+
+    # The lookup in generate_3d_map_radial_2018 needs a regular grid
+    if not np.abs((fx[1]-fx[0]) - (fx[-1]-fx[-2])) < np.abs(((fx[1]-fx[0])/len(fx)/10000)):
+        print("The membrane profile is not on a regular grid.")
+        return None
+
+    nt = int(half_size)
+    da = 1.0 / flag_accuracy
+    x = np.arange(0, da+nt, da)
+    fy_proj = abel_projection_1d(fx, fy, r_here, x, nt, da)
+
+    # Paint one quarter (distance 0..nt) and mirror it around pixel (nt, nt)
+    d2 = np.arange(nt + 1) ** 2
+    quarter = np.interp(np.sqrt(d2[:, None] + d2[None, :]), x, fy_proj)
+    ind = np.abs(np.arange(-nt, nt))
+    pm1 = quarter[np.ix_(ind, ind)]
+
+    return pm1 * 2.0
+
+
+def abel_projection_1d(fx, fy, r_here, x, z_max, da):
+    """
+    The projection along z (0 <= z <= z_max) of the spherical density f(rho) = fy(rho - r_here),
+    with the rectangle-rule terms of generate_3d_map_radial_2018.
+
+    args:
+        fx, fy: the membrane profile, linear between the nodes. fy[0] inside and fy[-1] outside.
+        r_here: radius
+        x: the distance to the center where the projection is calculated
+        z_max: the projection is over 0 <= z <= z_max
+        da: the z step of the rectangle rule to reproduce
+
+    returns:
+        the projected profile at x
+    """
+    rho_nodes = r_here + fx
+    slope = np.diff(fy) / np.diff(fx)
+
+    # Pieces of f(rho) = c0 + c1 * rho: constant inside, linear pieces, constant outside
+    lo = np.concatenate(([-np.inf], rho_nodes))
+    hi = np.concatenate((rho_nodes, [np.inf]))
+    c1 = np.concatenate(([0.0], slope, [0.0]))
+    c0 = np.concatenate(([fy[0]], fy[:-1] - slope * rho_nodes[:-1], [fy[-1]]))
+
+    x2 = (x ** 2)[:, None]
+    rho_max = np.sqrt(x2 + z_max ** 2)
+    rho0 = np.clip(lo[None, :], x[:, None], rho_max)
+    rho1 = np.clip(hi[None, :], x[:, None], rho_max)
+
+    # z(rho) = sqrt(rho^2 - x^2) and int rho dz = (rho z + x^2 log(rho + z)) / 2
+    def primitives(rho):
+        z = np.sqrt(np.maximum(rho ** 2 - x2, 0))
+        log_term = np.log(np.maximum(rho + z, np.finfo(float).tiny))
+        return z, (rho * z + x2 * log_term) / 2
+
+    z0, g0 = primitives(rho0)
+    z1, g1 = primitives(rho1)
+    fy_proj = np.sum(c0 * (z1 - z0) + c1 * (g1 - g0), axis=1)
+
+    # The rectangle rule of generate_3d_map_radial_2018 is the trapezoid rule (about the integral above)
+    # plus half of the last sample, minus half of the samples 1 .. round(1/da)-1 near the equator.
+    def f(z):
+        return np.interp(np.sqrt(x ** 2 + z ** 2) - r_here, fx, fy)
+
+    fy_proj += f(z_max) * 0.5 * da
+    for k in range(1, int(np.round(1 / da))):
+        fy_proj -= f(k * da) * 0.5 * da
+
+    return fy_proj
+
+
+if __name__ == "__main__":
+    import time
+    from generate_3d_map_radial_2018 import generate_3d_map_radial_2018
+    from get_membrane_profile import get_membrane_profile
+
+    fx = debug.load_mat_var("data/generate_3D_map_radial_2018_in.mat", "fx")
+    fx.shape = (fx.shape[1])
+    fy = debug.load_mat_var("data/generate_3D_map_radial_2018_in.mat", "fy")
+    fy.shape = (fy.shape[1])
+    rr = debug.load_mat_var("data/generate_3D_map_radial_2018_in.mat", "r_here")
+    half_size = debug.load_mat_var("data/generate_3D_map_radial_2018_in.mat", "half_size")
+    half_size = half_size[0][0]
+    cases = [(fx, fy, float(np.squeeze(rr)), half_size)]
+
+    fxt, fyt, pixelsize_membrane = get_membrane_profile(44)
+    fxt = fxt * pixelsize_membrane / 1.056
+    for r_here in [40.3, 95.0, 187.6]:
+        cases.append((fxt, fyt, r_here, np.round(r_here * 2) * 2 / 2))
+
+    # Regression test against generate_3d_map_radial_2018
+    for fx, fy, r_here, half_size in cases:
+        for flag_accuracy in [1, 4]:
+            t0 = time.time()
+            pm_ref = generate_3d_map_radial_2018(fx, fy, r_here, half_size, flag_accuracy)
+            t1 = time.time()
+            pm = generate_3d_map_radial_abel(fx, fy, r_here, half_size, flag_accuracy)
+            t2 = time.time()
+            err = np.max(np.abs(pm - pm_ref)) / np.max(np.abs(pm_ref))
+            print(f'r = {r_here:6.1f}, half_size = {half_size:5.0f}, flag_accuracy = {flag_accuracy}: '
+                  f'rel max diff {err:.2e}, time {t1 - t0:.4f} s -> {t2 - t1:.4f} s')
+            assert pm.shape == pm_ref.shape
+            assert err < 1e-3
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-from import_rsc_functions import *
+from get_yes_no import get_yes_no
+from get_num_from_screen import get_num_from_screen
 
 
 def get_base_filename(emfilename, n_to_delete_from_end_tobasename=4):
@@ -21,6 +21,11 @@ def get_membrane_profile(model_type):
         fx: in unit of current pixelsize
         fy: membrane profile
         pixelsize: current pixelsize
+
+    note:
+        Each profile is built once in a process by membrane_profile. The arrays returned here are copies.
+        To add a model type, write a function like membrane_profile_44 and add it to
+        _membrane_profile_builders (or call register_membrane_profile).
     """
     # 08/25/2018
     # fyt(end) is set to zero, while max(fyt) is set to 1.
@@ -64,49 +69,123 @@ def get_membrane_profile(model_type):
     #
     # scale_factor is used to manipulate membrane profile of model 54.
 
-    if model_type == 44:
-        # OHSU GIF30eV Krios 300keV, how_to_fit_back_hankel_to_get_membrane_profile_2016_jan.m
-        # inverse ctf filter at ctf=0.05, no further modification,
-        # qfactor=0.07, 854 vesicles, asymmetric
-        # profile was raised up by mean(fynn(42:end))
-        fxnn = np.arange(-25, 26)
-        fynnall = [0.0226057019909365, 0.0252021990537559, 0.00485938558557869, 0.0256541100536305,
-                   0.000981550525522873, -0.0497238811929170, 0.0440611267774491, 0.00488015547836201,
-                   -0.00169744859071094, 0.0378464802756880, 0.0240096571753982, 0.0701905042504966, 0.112803145158847,
-                   0.220858833655673, 0.325610180697430, 0.470355832691475, 0.585072998126252, 0.652651493194249,
-                   0.656930757637444, 0.659836776122480, 0.638555542838540, 0.622161865703875, 0.590627989459644,
-                   0.555197812566001, 0.452965746494022, 0.426309369525603, 0.470218987523958, 0.540928357498853,
-                   0.559852365388236, 0.581389132430551, 0.606032801830115, 0.613400245596709, 0.635424310958883,
-                   0.645131542098614, 0.621306836732483, 0.574827517925640, 0.457392485410873, 0.287206470195894,
-                   0.160438292081854, 0.0604879337148811, 0.0364709272295661, 0.000868729643717925,
-                   -0.000591637120631788, -0.0174713174128332, -0.0151496150820872, 0.0138930377783886,
-                   -0.00274894092210304, 0.000264283341471494, 0.00722820749218572, 0.00406397815218479,
-                   0.00964327412970650]
-
-        # Set background to zeros arournd around +/- 32.76 A.
-        fynnt = np.copy(np.asarray(fynnall))
-        fynnt[0:12] = 0
-        fynnt[40-1: np.size(fynnt)] = 0
-
-        fxt = fxnn
-        pixelsize_membrane = 2.112
-
-        # smooth out the peaks
-        fyt1 = gauss_filt_1d(fynnt, 0.15)
-
-        fyt1 = fyt1 * (fyt1 > 0)
-        fyt1 = fyt1 * 1.38
-        
-        fyt = fyt1
-        fyt = fyt - fyt[-1]  # Set min to zeros
-        fyt = fyt / np.max(fyt)  # to scale it to 0-1 range.
-
-        # return [f['fxt'][0].astype('float64'), f['fyt'][0].astype('float64'), f['pixelsize_membrane'][0, 0]]
-        return [fxt.astype('float64'), fyt.astype('float64'), pixelsize_membrane]
-    else:
-        print("Unsupported model type")
+    profile = membrane_profile(model_type)
+    if profile is None:
         return None
 
+    # copies, so the caller can change them without changing the profile in the registry
+    return [profile.fx.copy(), profile.fy.copy(), profile.pixelsize_membrane]
+
+
+class MembraneProfile():
+    """
+    A membrane profile in the registry. fx and fy are read-only.
+
+    attributes:
+        model_type: an integer, as in get_membrane_profile
+        fx: in unit of pixelsize_membrane
+        fy: membrane profile
+        pixelsize_membrane: pixelsize of fx
+
+    methods:
+        fx_in_pixels: fx in unit of the given pixelsize
+    """
+
+    def __init__(self, model_type, fx, fy, pixelsize_membrane):
+        self.model_type = model_type
+        self.fx = np.array(fx, dtype='float64')
+        self.fy = np.array(fy, dtype='float64')
+        self.fx.setflags(write=False)
+        self.fy.setflags(write=False)
+        self.pixelsize_membrane = pixelsize_membrane
+
+    def fx_in_pixels(self, pixelsize):
+        return self.fx * (self.pixelsize_membrane / pixelsize)
+
+
+def membrane_profile(model_type):
+    """
+    Get the MembraneProfile of model_type. Each profile is built once in a process and then reused.
+
+    args:
+        model_type: an integer, as in get_membrane_profile
+
+    returns:
+        a MembraneProfile. None if the model type is not supported.
+    """
+    profile = _membrane_profiles.get(model_type)
+    if profile is None:
+        builder = _membrane_profile_builders.get(model_type)
+        if builder is None:
+            print("Unsupported model type")
+            return None
+        fx, fy, pixelsize_membrane = builder()
+        profile = _membrane_profiles.setdefault(model_type, MembraneProfile(model_type, fx, fy, pixelsize_membrane))
+    return profile
+
+
+def register_membrane_profile(model_type, builder):
+    """
+    Add a membrane model to the registry.
+
+    args:
+        model_type: an integer
+        builder: a function without arguments returning [fx, fy, pixelsize_membrane]
+    """
+    _membrane_profile_builders[model_type] = builder
+    _membrane_profiles.pop(model_type, None)
+
+
+def membrane_profile_44():
+    """
+    44: OHSU GIF30eV Krios 300keV. Good for UW Krios too.
+    """
+    # OHSU GIF30eV Krios 300keV, how_to_fit_back_hankel_to_get_membrane_profile_2016_jan.m
+    # inverse ctf filter at ctf=0.05, no further modification,
+    # qfactor=0.07, 854 vesicles, asymmetric
+    # profile was raised up by mean(fynn(42:end))
+    fxnn = np.arange(-25, 26)
+    fynnall = [0.0226057019909365, 0.0252021990537559, 0.00485938558557869, 0.0256541100536305,
+               0.000981550525522873, -0.0497238811929170, 0.0440611267774491, 0.00488015547836201,
+               -0.00169744859071094, 0.0378464802756880, 0.0240096571753982, 0.0701905042504966, 0.112803145158847,
+               0.220858833655673, 0.325610180697430, 0.470355832691475, 0.585072998126252, 0.652651493194249,
+               0.656930757637444, 0.659836776122480, 0.638555542838540, 0.622161865703875, 0.590627989459644,
+               0.555197812566001, 0.452965746494022, 0.426309369525603, 0.470218987523958, 0.540928357498853,
+               0.559852365388236, 0.581389132430551, 0.606032801830115, 0.613400245596709, 0.635424310958883,
+               0.645131542098614, 0.621306836732483, 0.574827517925640, 0.457392485410873, 0.287206470195894,
+               0.160438292081854, 0.0604879337148811, 0.0364709272295661, 0.000868729643717925,
+               -0.000591637120631788, -0.0174713174128332, -0.0151496150820872, 0.0138930377783886,
+               -0.00274894092210304, 0.000264283341471494, 0.00722820749218572, 0.00406397815218479,
+               0.00964327412970650]
+
+    # Set background to zeros arournd around +/- 32.76 A.
+    fynnt = np.copy(np.asarray(fynnall))
+    fynnt[0:12] = 0
+    fynnt[40-1: np.size(fynnt)] = 0
+
+    fxt = fxnn
+    pixelsize_membrane = 2.112
+
+    # smooth out the peaks
+    fyt1 = gauss_filt_1d(fynnt, 0.15)
+
+    fyt1 = fyt1 * (fyt1 > 0)
+    fyt1 = fyt1 * 1.38
+    
+    fyt = fyt1
+    fyt = fyt - fyt[-1]  # Set min to zeros
+    fyt = fyt / np.max(fyt)  # to scale it to 0-1 range.
+
+    # return [f['fxt'][0].astype('float64'), f['fyt'][0].astype('float64'), f['pixelsize_membrane'][0, 0]]
+    return [fxt.astype('float64'), fyt.astype('float64'), pixelsize_membrane]
+
+
+# model_type -> function to build the profile
+_membrane_profile_builders = {44: membrane_profile_44}
+
+# model_type -> MembraneProfile, built when it is first used
+_membrane_profiles = {}
+
 
 if __name__ == "__main__":
     a, b, c = get_membrane_profile(44)
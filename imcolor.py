@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
 from scale_array import *
 
 
@@ -16,6 +14,9 @@ def imcolor(data):
         None
 
     """
+    import matplotlib.pyplot as plt  # only when images are displayed
+    from matplotlib.colors import ListedColormap
+
     t1 = np.linspace(0, 1, 256).reshape(256, 1)
     new_color = np.tile(t1, (1, 3))
     # 251: blue
@@ -37,6 +38,8 @@ def imcolor(data):
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
     data = np.random.randn(30, 30)
     data = scale_array(data, 0, 250)
     data[:, 0] = 251
@@ -1,9 +1,6 @@
 #!/usr/bin/env python3
 
 
-import matplotlib.pyplot as plt
-
-
 def imgray(data):
     """
     This display an image in gray scale
@@ -15,6 +12,8 @@ def imgray(data):
         None
 
     """
+    import matplotlib.pyplot as plt  # only when images are displayed
+
     h1 = plt.gcf()
     h2 = h1.gca()
     plt.set_cmap('gray')
@@ -23,6 +22,7 @@ def imgray(data):
 
 if __name__ == '__main__':
     import numpy as np
+    import matplotlib.pyplot as plt
     data = np.random.randn(30, 30)
     data[:3, :3] = np.max(data)
     plt.figure(99)
@@ -1,61 +1,92 @@
 # This is used to import all rsc project functions
 # This is the __init__.py for a package in Python distribution
+#
+# The functions are imported when they are first used (PEP 562), so importing this module is fast
+# and a headless run does not import matplotlib:
+#     import import_rsc_functions as rsc
+#     im = rsc.read_mrc(filename)[0]
+#     from import_rsc_functions import read_mrc, write_mrc
+# `from import_rsc_functions import *` still imports every function.
 
-from imgray import imgray
-from imcolor import imcolor
+import importlib
 
-from erotate_2d_90 import erotate_2d_90
+# function name: module name
+_functions = {
+    'imgray': 'imgray',
+    'imcolor': 'imcolor',
 
-from add_box import add_box
-from add_circle import add_circle
-from add_cross import add_cross
-from radius import radius
-from polar_to_2d_uniform import polar_to_2d_uniform
-from radial_average import radial_average
-from to_polar import to_polar
-from better_contrast_simple_2d import better_contrast_simple_2d
-from max2d import max2d
+    'erotate_2d_90': 'erotate_2d_90',
 
-from get_num_from_screen import get_num_from_screen
-from get_yes_no import get_yes_no
-from get_string_from_screen import get_string_from_screen
-from num2strn import num2strn
-from get_files_having_pattern import get_files_having_pattern
-from get_base_filename import get_base_filename
+    'add_box': 'add_box',
+    'add_circle': 'add_circle',
+    'add_cross': 'add_cross',
+    'radius': 'radius',
+    'polar_to_2d_uniform': 'polar_to_2d_uniform',
+    'radial_average': 'radial_average',
+    'to_polar': 'to_polar',
+    'better_contrast_simple_2d': 'better_contrast_simple_2d',
+    'max2d': 'max2d',
 
-from least_square import least_square, least_square_1d
-from sphere_fit_main import sphere_fit_main
+    'get_num_from_screen': 'get_num_from_screen',
+    'get_yes_no': 'get_yes_no',
+    'get_string_from_screen': 'get_string_from_screen',
+    'num2strn': 'num2strn',
+    'get_files_having_pattern': 'get_files_having_pattern',
+    'get_base_filename': 'get_base_filename',
 
-from downsamplen import downsamplen, downsample2
-from scale_array import scale_array, scale_image
-from remove_1d_array_elements import remove_array_elements
+    'least_square': 'least_square',
+    'least_square_1d': 'least_square',
+    'sphere_fit_main': 'sphere_fit_main',
 
-from gauss_filt import gauss_filt, gauss_filt_1d
-from shift_array import shift_array
+    'downsamplen': 'downsamplen',
+    'downsample2': 'downsamplen',
+    'scale_array': 'scale_array',
+    'scale_image': 'scale_array',
+    'remove_array_elements': 'remove_1d_array_elements',
 
-from pad_pic import pad_pic
-from norm_ref_e_mean import norm_ref_e_mean
+    'gauss_filt': 'gauss_filt',
+    'gauss_filt_1d': 'gauss_filt',
+    'shift_array': 'shift_array',
 
-from disc import discm, disc
-from mask import mask
+    'pad_pic': 'pad_pic',
+    'norm_ref_e_mean': 'norm_ref_e_mean',
 
-from apply_filter import apply_filter
-from bandpass_filter_b import bandpass_filter_b
+    'discm': 'disc',
+    'disc': 'disc',
+    'mask': 'mask',
 
-from read_mrc import read_mrc
-from write_mrc import write_mrc
+    'apply_filter': 'apply_filter',
+    'bandpass_filter_b': 'bandpass_filter_b',
 
-#from batch_refit_subtract_new_withPOPC_in_folder_parfor_2019 import batch_refit_subtract_new_withPOPC_in_folder_parfor_2019
-from creat_ref_lib3 import creat_ref_lib3
-from ves_density_circular import ves_density_circular
-from ctf_lwq import ctf_lwq
-from ctf import ctf
-from get_ctf_for_vesicle_subtraction import get_ctf_for_vesicle_subtraction
+    'read_mrc': 'read_mrc',
+    'MRCFile': 'mrc',
+    'write_mrc': 'write_mrc',
 
-from divide_conquer import divide_conquer
-from read_box_e_m import read_box_e_m
-from write_ves_file import write_ves_file
-from make_cc_map_mem import make_cc_map_mem
-from generate_3d_map_radial_2018 import generate_3d_map_radial_2018
+    # 'batch_refit_subtract_new_withPOPC_in_folder_parfor_2019': 'batch_refit_subtract_new_withPOPC_in_folder_parfor_2019',
+    'creat_ref_lib3': 'creat_ref_lib3',
+    'ves_density_circular': 'ves_density_circular',
+    'ctf_lwq': 'ctf_lwq',
+    'ctf': 'ctf',
+    'get_ctf_for_vesicle_subtraction': 'get_ctf_for_vesicle_subtraction',
 
+    'divide_conquer': 'divide_conquer',
+    'read_box_e_m': 'read_box_e_m',
+    'write_ves_file': 'write_ves_file',
+    'make_cc_map_mem': 'make_cc_map_mem',
+    'generate_3d_map_radial_2018': 'generate_3d_map_radial_2018',
+    'generate_3d_map_radial_abel': 'generate_3d_map_radial_abel',
+}
 
+__all__ = list(_functions)
+
+
+def __getattr__(name):
+    if name not in _functions:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_functions[name]), name)
+    globals()[name] = value  # __getattr__ is not called again for it
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_functions))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+
+
+class Prefetcher():
+    """
+    Call a function for a list of arguments in a background thread, ahead of the consumer.
+
+    Iterating over the Prefetcher gives a (result, error) pair for each arguments, in their order.
+    error is None if the function returned, otherwise result is None and error is the exception, and
+    the next arguments are still read. At most depth results wait in the queue, so at most depth + 1
+    are in memory besides the one being used.
+
+        for inputs, err in Prefetcher(read_micrograph_inputs, [(i, files[i]) for i in range(n)], 2):
+            ...
+    """
+
+    _end = object()
+
+    def __init__(self, function, args_list, depth=1):
+        """
+        args:
+            function: called as function(*args) for each args in args_list
+            args_list: a list of tuples of arguments
+            depth: maximum number of results waiting to be used (>= 1)
+        """
+        self._queue = queue.Queue(maxsize=max(int(depth), 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(function, list(args_list)), daemon=True)
+        self._thread.start()
+
+    def _run(self, function, args_list):
+        for args in args_list:
+            if self._stop.is_set():
+                return
+            try:
+                item = (function(*args), None)
+            except Exception as err:
+                item = (None, err)
+            self._put(item)
+        self._put((self._end, None))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        while True:
+            result, err = self._queue.get()
+            if result is self._end:
+                return
+            yield result, err
+
+    def close(self):
+        """
+        Stop reading ahead. The item being read is finished first.
+        """
+        self._stop.set()
+        self._thread.join()
+
+
+class WriteBehind():
+    """
+    Run output functions (e.g. write_mrc) in a background thread, in the order they are submitted.
+
+    submit returns at once unless depth jobs are already waiting, which caps the memory held by the
+    outputs. close waits for all jobs and raises again the first error, unless flag_raise is 0 (e.g. when
+    the errors are already recorded by the jobs). The errors are printed and kept in errors.
+
+        with WriteBehind(2) as writer:
+            writer.submit(write_mrc, im, pixelsize, file_out, 2)
+    """
+
+    def __init__(self, depth=1, flag_raise=1):
+        """
+        args:
+            depth: maximum number of jobs waiting to be run (>= 1)
+            flag_raise: 1 to raise the first error of the jobs again in close
+        """
+        self._queue = queue.Queue(maxsize=max(int(depth), 1))
+        self.flag_raise = flag_raise
+        self.errors = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            function, args, kwargs = job
+            try:
+                function(*args, **kwargs)
+            except Exception as err:
+                print(f'*** Error in writing: {err}')
+                self.errors.append(err)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) after the jobs submitted before.
+        """
+        if self._thread is None:
+            raise RuntimeError('WriteBehind is closed')
+        self._queue.put((function, args, kwargs))
+
+    def close(self):
+        """
+        Wait for all jobs. The first error in the jobs is raised again if flag_raise is set.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self.errors and self.flag_raise:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    import time
+
+    def slow_square(x):
+        time.sleep(0.05)
+        return x * x
+
+    # Reading ahead overlaps with the work on the previous item
+    t0 = time.time()
+    out = []
+    for y, err in Prefetcher(slow_square, [(x,) for x in range(10)], 2):
+        time.sleep(0.05)
+        out.append(y)
+    t1 = time.time()
+    assert out == [x * x for x in range(10)]
+    print(f'prefetch: {t1 - t0:.2f} s (serial 1.00 s)')
+
+    # An error in the middle of the list does not stop the items after it
+    def inverse(x):
+        return 1 / x
+
+    out = list(Prefetcher(inverse, [(x,) for x in [1, 2, 0, 4, 5]], 2))
+    assert [y for y, err in out] == [1, 0.5, None, 0.25, 0.2]
+    assert isinstance(out[2][1], ZeroDivisionError) and all(err is None for i, (y, err) in enumerate(out) if i != 2)
+
+    written = []
+    t0 = time.time()
+    with WriteBehind(2) as writer:
+        for x in range(10):
+            time.sleep(0.05)
+            writer.submit(lambda v: (time.sleep(0.05), written.append(v)), x)
+    t1 = time.time()
+    assert written == list(range(10))
+    print(f'write-behind: {t1 - t0:.2f} s (serial 1.00 s)')
+
+    # The errors of the jobs are raised again in close, or only kept with flag_raise = 0
+    for flag_raise in (1, 0):
+        writer = WriteBehind(2, flag_raise)
+        for x in [1, 0, 2]:
+            writer.submit(inverse, x)
+        try:
+            writer.close()
+            assert not flag_raise and len(writer.errors) == 1
+        except ZeroDivisionError:
+            assert flag_raise
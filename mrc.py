@@ -2,95 +2,170 @@
 
 # process .mrc files
 
-import struct
-import os
 import numpy as np
-
-class mrc():
+from read_mrc import mrc_mode_dtype, read_mrc_header
+
+
+class MRCFile():
+    """
+    A mrc file opened with its header only.
+
+    The dimensions, pixel size and statistics come from the header. The slices are read when they
+    are used, one at a time, so a stack can be iterated in constant memory. Slices are nx x ny arrays
+    in the matlab convention of read_mrc, or ny x nx in the file order with flag_transpose=0.
+
+        with MRCFile(filename) as f:
+            print(f.nx, f.ny, f.nz, f.pixelsize)
+            for img in f:
+                ...
+
+    attributes:
+        nx, ny, nz: dimensions
+        mode: data mode (0: int8, 1: int16, 2: float32, 6: uint16, 12: float16)
+        dtype: numpy data type of the mode
+        pixelsize: in unit of angstrom per pixel (cella / mx)
+        dmin, dmax, dmean, rms: statistics in the header
+        n_bytes: size of the complete file
+        s, header, extra_header: as returned by read_mrc_header
+
+    methods:
+        read_slice: read one slice
+        read: read a range of slices, or map them with np.memmap
+        close: close the file
+    """
+
+    def __init__(self, filename, flag_transpose=1):
+        """
+        args:
+            filename: a mrc file
+            flag_transpose: 1 for nx x ny slices (matlab convention), 0 for the file order ny x nx
+        """
+        s, hdr, extra_header = read_mrc_header(filename)
+        if s.err:
+            raise IOError(f'MRCFile: can not read the header of {filename} (err {s.err})')
+        self.filename = filename
+        self.flag_transpose = flag_transpose
+        self.s = s
+        self.header = hdr
+        self.extra_header = extra_header
+        self.nx, self.ny, self.nz = s.nx, s.ny, s.nz
+        self.mode = s.mode
+        self.dtype = mrc_mode_dtype[s.mode]
+        self.pixelsize = s.pixa
+        self.dmin, self.dmax, self.dmean = float(s.mi), float(s.ma), float(s.av)
+        self.rms = float(hdr['rms'])
+        self._offset = 1024 + max(int(hdr['nsymbt']), 0)
+        self._slice_bytes = self.nx * self.ny * self.dtype.itemsize
+        self._f = open(filename, 'rb')
+
+    @property
+    def shape(self):
+        return self.nx, self.ny, self.nz
+
+    @property
+    def n_bytes(self):
+        """
+        Size of the complete file from its header. A file being written is smaller.
+        """
+        return self._offset + self.nz * self._slice_bytes
+
+    def __len__(self):
+        return self.nz
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        for k in range(1, self.nz + 1):
+            yield self.read_slice(k)
+
+    def _arrange(self, data):
+        data = data.astype(self.dtype.newbyteorder('='), copy=False)
+        if self.flag_transpose:
+            data = np.ascontiguousarray(data.T)
+        return data
+
+    def read_slice(self, k):
+        """
+        Read slice k (starting from 1).
+        """
+        if k < 1 or k > self.nz:
+            raise IndexError(f'MRCFile: slice {k} out of 1 to {self.nz}')
+        self._f.seek(self._offset + (k - 1) * self._slice_bytes)
+        data = np.fromfile(self._f, dtype=self.dtype, count=self.nx * self.ny).reshape((self.ny, self.nx))
+        return self._arrange(data)
+
+    def read(self, start_slice=1, num_slices=None, flag_memmap=0):
+        """
+        Read slices start_slice to start_slice + num_slices - 1 (starting from 1), as read_mrc.
+
+        args:
+            start_slice: the first slice
+            num_slices: number of slices. None: to the last slice.
+            flag_memmap: 1 to return a read-only np.memmap view instead of reading the slices
+
+        returns:
+            nx x ny x nz array (squeezed), or nz x ny x nx with flag_transpose=0
+        """
+        nz = max(self.nz - start_slice + 1, 0)
+        if num_slices is not None:
+            nz = min(nz, num_slices)
+        offset = self._offset + (start_slice - 1) * self._slice_bytes
+        if flag_memmap:
+            data = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=offset, shape=(nz, self.ny, self.nx))
+            if self.flag_transpose:
+                data = data.transpose()
+        else:
+            self._f.seek(offset)
+            data = np.fromfile(self._f, dtype=self.dtype, count=nz * self.nx * self.ny).reshape((nz, self.ny, self.nx))
+            data = data.astype(self.dtype.newbyteorder('='), copy=False)
+            if self.flag_transpose:
+                data = np.ascontiguousarray(data.transpose())
+        return np.squeeze(data)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+class mrc(MRCFile):
+    """
+    The whole data of a mrc file in self.img, nx x ny x nz (matlab convention, as read_mrc).
+    Kept for old scripts. Use MRCFile to read the header or the slices only.
+    """
 
     def __init__(self, filename=None):
-        self._initAllFields()
+        self.img = None
         if filename is not None:
-            self._loadFromFile(filename)
-
-    def _initAllFields(self):
-        pass
-
-    def _loadFromFile(self, filename):
-        fsize = os.stat(filename).st_size
-        #print(fsize)
-        with open(filename, "rb") as f:
-            rawHeader = f.read(1024)
-            preCursor = 0
-
-            # 1. read 10 integer (40 bytes)
-            cursor = 40
-            a = struct.unpack("<iiiiiiiiii", rawHeader[preCursor:cursor])
-            [nx, ny, nz, mode, ncstart, nrstart, nsstart, mx, my, mz] = a
-            preCursor = cursor
-            # print(a)
-            # should be 3840 3840 1 2 -1920 -1920 -1 3840 3840 1 for the test file
-
-            # 2. read 12 float (48 bytes)
-            cursor += 48
-            b = struct.unpack("<ffffffffffff", rawHeader[preCursor:cursor])
-            [xlength, ylength, zlength, alpha, beta, gamma, mapc, mapr, maps, amin, amax, amean] = b
-            preCursor = cursor
-            # print(b)
-            # xlength ylength zlength alpha beta gamma mapc mapr maps amin amax amean
-            # 4055.04003906250 4055.04003906250 1.05599999427795 90 90 90 1.40129846432482e-45 2.80259692864963e-45 4.20389539297445e-45 12.2504720687866 15.3350839614868 13.4940538406372
-
-            # 3. read 30 integer (120 bytes)
-            cursor += 120
-            c = struct.unpack("<iiiiiiiiiiiiiiiiiiiiiiiiiiiiii", rawHeader[preCursor:cursor])
-            extendedHeaderSize = c[1]
-            preCursor = cursor
-            #print(c)
-            # should be all 0 in test file
-
-            # 4. read 8 byte string (8 bytes)
-            cursor += 8
-            d = rawHeader[preCursor:cursor].decode("utf-8")
-            preCursor = cursor
-            # print(d)
-            # should be "MAP DA" in test file
-
-            # 5. read 2 integer (8 bytes)
-            cursor += 8
-            e = struct.unpack("<ii", rawHeader[preCursor:cursor])
-            preCursor = cursor
-            # print(e)
-            # should be 1048992488 10 in test file
-
-            # 6. read up to 10 strings, each with 80 bytes (800 bytes)
-            _str = []
-            for _ in range(10):
-                cursor += 80
-                _str.append(rawHeader[preCursor:cursor].decode("utf-8"))
-                preCursor = cursor
-            #print(_str)
-
-            # 7. TODO: read extended header (skipped because test file had no extended header)
-
-            # 8. read data
-            pixelSize = 4
-            nPixel = nx * ny * nz
-            #print(nPixel)
-            # data portion:
-            # type "*float32"
-            # number of value to read: 14745600
-
-            self.img = np.reshape(np.fromfile(f, dtype=np.float32, count=nPixel), (nx, ny, nz))
-            #np.savetxt("img.csv", img, delimiter=",")
+            MRCFile.__init__(self, filename)
+            self.img = self.read().reshape((self.nx, self.ny, self.nz))
+            self.close()
 
 
 # below are for debugging purpose
 if __name__ == "__main__":
-    filename = "18jun07c_em6b_00002gr_00010sq_v01_00002hl_v01_00005en.framescor2x_DW_dmBIN01.mrc"
-    filename = "test3.mrc"
-    test = mrc(filename)
-    # get all attribute name
-    attrs = [x for x in dir(test) if x[0] != '_']
-    # print all attributes
-    #for x in attrs:
-    #    print("{}: {}".format(x, getattr(test, x)))
+    import os
+    import tempfile
+    from read_mrc import read_mrc
+    from write_mrc import write_mrc
+
+    out, s, __, __ = read_mrc('data/3dstack.mrc')
+    with MRCFile('data/3dstack.mrc') as f:
+        print(f.shape, f.mode, f.pixelsize, f.dmin, f.dmax, f.dmean, f.rms)
+        for k, img in enumerate(f):
+            assert np.array_equal(img, out[:, :, k])
+        assert np.array_equal(f.read(3, 2), out[:, :, 2:4])
+        assert np.array_equal(f.read(3, 2, flag_memmap=1), out[:, :, 2:4])
+    assert np.array_equal(mrc('data/3dstack.mrc').img, out)
+
+    # float16
+    filename = os.path.join(tempfile.mkdtemp(), 'half.mrc')
+    vol = np.float16(np.random.RandomState(0).normal(size=(30, 20, 3)))
+    write_mrc(vol, 1.5, filename, 12)
+    with MRCFile(filename) as f:
+        print(f.shape, f.dtype, f.pixelsize)
+        assert np.array_equal(f.read(), vol)
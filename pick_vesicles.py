@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import getopt
+import collections
+import numpy as np
+from creat_ref_lib3 import creat_ref_lib3
+from make_cc_map_mem import make_cc_map_mem
+from cc_reference_bank import CcReferenceBank
+from downsamplen import downsamplen
+from real_fft import next_fast_size
+from ctf_bank import CtfBank, ctf_key
+from projected_profile_cache import ProjectedProfileCache
+from vesicle_model_evaluator import VesicleModelEvaluator
+from least_square import least_square_1d
+from get_files_having_pattern import get_files_having_pattern
+from read_mrc import read_mrc
+from ctf import ctf
+from mrc import MRCFile
+from write_ves_file import write_ves_file
+from run_manifest import replace_atomic
+from watch_folder import InputWatcher
+
+
+class Struct(object):  # Used to create an empty structure/class
+    pass
+
+
+class VesiclePicker():
+    """
+    Automatic picking of vesicles, which writes the vesicle files used by the refit and subtraction
+    (mx, my, mr, mp as in *_resub44_screen.txt).
+
+    The micrograph is binned to about pixelsize_pick and cross-correlated with a library of CTF-filtered
+    vesicles of radii r_min to r_max (creat_ref_lib3), which gives the best cc and radius at each position
+    (make_cc_map_mem). Then the vesicles are picked one by one from the highest cc:
+        the amplitude is fitted with the membrane model (VesicleModelEvaluator) and the vesicle is
+        subtracted from the binned micrograph;
+        the cc map is recalculated in a window around it, so its side lobes and overlaps are not picked;
+        positions within nms_factor x radius of the center are not picked again (non-maximum suppression).
+    Picking stops at a cc of threshold robust standard deviations (median absolute deviation) above the
+    median of the cc map, or after max_vesicles.
+
+    The libraries are kept for the last few CTFs, with the spectra of the references at the sizes of the
+    micrograph and of the windows (CcReferenceBank). So micrographs with the same CTF only need the
+    inverse FFTs.
+
+    methods:
+        library: the reference library for a CTF
+        pick: pick the vesicles of a micrograph
+    """
+
+    def __init__(self, pixelsize, model_type=44, r_min=50, r_max=300, r_step=10, pixelsize_pick=10, threshold=5,
+                 max_vesicles=500, nms_factor=1.0, max_libraries=4):
+        """
+        args:
+            pixelsize: in unit of angstrom per pixel
+            model_type: membrane model of the subtraction, as in get_membrane_profile
+            r_min, r_max, r_step: radii of the references in unit of angstrom
+            pixelsize_pick: the micrograph is binned by round(pixelsize_pick / pixelsize) to pick
+            threshold: lowest cc of a vesicle in robust standard deviations above the median of the cc map
+            max_vesicles: largest number of vesicles in a micrograph
+            nms_factor: no other vesicle is picked within nms_factor x radius of a vesicle
+            max_libraries: number of CTFs whose libraries are kept
+        """
+        self.pixelsize = pixelsize
+        self.model_type = model_type
+        self.r_min = r_min
+        self.r_max = r_max
+        self.r_step = r_step
+        self.ds = max(1, int(round(pixelsize_pick / pixelsize)))
+        self.pixelsize_ds = pixelsize * self.ds
+        self.threshold = threshold
+        self.max_vesicles = max_vesicles
+        self.nms_factor = nms_factor
+        self.max_libraries = max_libraries
+
+        # The references hold the largest vesicle with its membrane and CTF fringes (100 A)
+        self.n_ref = next_fast_size(2 * (r_max + 100) / self.pixelsize_ds)
+        # Subtracting a vesicle changes the cc up to the sum of its radius and the largest radius
+        self.half_window = int(np.ceil(2 * (r_max + 100) / self.pixelsize_ds))
+        self.n_window = next_fast_size(2 * self.half_window + 1 + self.n_ref)
+
+        self.profile_cache = ProjectedProfileCache(model_type, self.pixelsize_ds)
+        self.ctf_bank = CtfBank()
+        self._libraries = collections.OrderedDict()
+
+    def library(self, info_ctf):
+        """
+        The reference library for a CTF.
+
+        returns:
+            a Struct with r_array (radii in angstrom), bank (a CcReferenceBank of the references, each with
+            zero mean and unit norm) and evaluators (a dictionary of box size: VesicleModelEvaluator)
+        """
+        key = ctf_key(info_ctf)
+        lib = self._libraries.get(key)
+        if lib is not None:
+            self._libraries.move_to_end(key)
+            return lib
+
+        __, r_array, vesicle_array = creat_ref_lib3(self.n_ref, self.pixelsize_ds, self.r_min,
+                                                    self.r_max + self.r_step / 2, self.r_step, info_ctf['defocus'],
+                                                    info_ctf['Cs'], info_ctf['bfactor'], info_ctf['qfactor'],
+                                                    info_ctf['lambda'])
+        # The cc of a reference is then the amplitude of the matching vesicle in the micrograph
+        vesicle_array -= np.mean(vesicle_array, axis=(0, 1))
+        vesicle_array /= np.sqrt(np.sum(vesicle_array ** 2, axis=(0, 1)))
+
+        lib = Struct()
+        lib.info_ctf = info_ctf
+        lib.r_array = r_array
+        lib.bank = CcReferenceBank(vesicle_array)
+        lib.evaluators = {}
+        self._libraries[key] = lib
+        if len(self._libraries) > self.max_libraries:
+            self._libraries.popitem(last=False)
+        return lib
+
+    def _evaluator(self, lib, n_box):
+        evaluator = lib.evaluators.get(n_box)
+        if evaluator is None:
+            ctf2d = self.ctf_bank.get(lib.info_ctf, self.pixelsize_ds, n_box, 1)
+            evaluator = VesicleModelEvaluator(self.profile_cache, n_box, ctf2d)
+            lib.evaluators[n_box] = evaluator
+        return evaluator
+
+    def pick(self, im, info_ctf, im_mask=None):
+        """
+        Pick the vesicles of a micrograph.
+
+        args:
+            im: micrograph
+            info_ctf: a dictionary for CTF parameters
+            im_mask: None or a mask of the micrograph (0 for the blank strips from padding)
+
+        returns:
+            mx, my, mr, mp: vesicle centers in unit of pixels (starting from 1), radii in unit of angstrom and
+            amplitudes, in the order they are picked (highest cc first).
+            No vesicles are picked in a micrograph that is constant or has NaN or infinite values.
+        """
+        ds = self.ds
+
+        # Binned micrograph with zero mean and unit standard deviation, in the middle of a zero array
+        data = downsamplen(im, ds)
+        if im_mask is None:
+            valid = np.ones(data.shape, dtype=bool)
+        else:
+            valid = downsamplen(im_mask, ds) > 0.5
+        if not np.all(np.isfinite(data[valid])):
+            print('*** The micrograph has NaN or infinite values. No vesicles are picked.')
+            return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+        data_std = np.std(data[valid]) if np.any(valid) else 0
+        if not data_std > 0:
+            print('*** The micrograph is constant. No vesicles are picked.')
+            return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+        lib = self.library(info_ctf)
+        nx, ny = data.shape
+        data = (data - np.mean(data[valid])) / data_std
+        data[~valid] = 0
+        pad = self.n_ref // 2
+        n1 = next_fast_size(nx + 2 * pad)
+        n2 = next_fast_size(ny + 2 * pad)
+        img = np.zeros((n1, n2))
+        img[pad: pad + nx, pad: pad + ny] = data
+        allowed = np.zeros((n1, n2), dtype=bool)
+        allowed[pad: pad + nx, pad: pad + ny] = valid
+
+        ccm, cci = make_cc_map_mem(img, None, reference_bank=lib.bank, flag_print=0)
+        ccm[~allowed] = -np.inf
+        level = np.median(ccm[allowed])
+        cc_min = level + self.threshold * 1.4826 * np.median(np.abs(ccm[allowed] - level))
+
+        mx, my, mr, mp = [], [], [], []
+        while len(mx) < self.max_vesicles:
+            ix, iy = np.unravel_index(np.argmax(ccm), ccm.shape)
+            if not ccm[ix, iy] >= cc_min:
+                break
+            r = lib.r_array[int(cci[ix, iy]) - 1]
+            r_px = r / self.pixelsize_ds
+            dx = peak_offset(ccm[ix - 1: ix + 2, iy])
+            dy = peak_offset(ccm[ix, iy - 1: iy + 2])
+
+            # Fit the amplitude of the vesicle model and subtract it
+            n_box = next_fast_size(4 * r_px)
+            bx0 = ix - n_box // 2
+            by0 = iy - n_box // 2
+            box = crop_with_zeros(img, bx0, by0, n_box)
+            box_allowed = crop_with_zeros(allowed, bx0, by0, n_box)
+            model = self._evaluator(lib, n_box).model(r_px, n_box / 2 + 1 + dx, n_box / 2 + 1 + dy)
+            lp = least_square_1d(box[box_allowed], model[box_allowed])
+            if lp[1] > 0:
+                add_to(img, bx0, by0, -lp[1] * model * box_allowed)
+                mx.append((ix + dx - pad) * ds + (ds + 1) / 2)
+                my.append((iy + dy - pad) * ds + (ds + 1) / 2)
+                mr.append(r)
+                # The model at the binned pixelsize is 1/ds of the binned model at pixelsize
+                mp.append(lp[1] * data_std / ds)
+
+                # Recalculate the cc around the subtracted vesicle
+                wx0 = ix - self.n_window // 2
+                wy0 = iy - self.n_window // 2
+                ccw, ciw = make_cc_map_mem(crop_with_zeros(img, wx0, wy0, self.n_window), None,
+                                           reference_bank=lib.bank, flag_print=0)
+                x0 = max(ix - self.half_window, 0)
+                x1 = min(ix + self.half_window + 1, n1)
+                y0 = max(iy - self.half_window, 0)
+                y1 = min(iy + self.half_window + 1, n2)
+                ccm[x0: x1, y0: y1] = np.where(np.isfinite(ccm[x0: x1, y0: y1]),
+                                               ccw[x0 - wx0: x1 - wx0, y0 - wy0: y1 - wy0], -np.inf)
+                cci[x0: x1, y0: y1] = ciw[x0 - wx0: x1 - wx0, y0 - wy0: y1 - wy0]
+
+            # Suppress the positions inside the vesicle
+            rn = max(self.nms_factor * r_px, 1)
+            x0 = max(ix - int(rn) - 1, 0)
+            y0 = max(iy - int(rn) - 1, 0)
+            xx, yy = np.mgrid[x0: min(ix + int(rn) + 2, n1), y0: min(iy + int(rn) + 2, n2)]
+            ccm[x0: x0 + xx.shape[0], y0: y0 + xx.shape[1]][(xx - ix - dx) ** 2 + (yy - iy - dy) ** 2 < rn ** 2] \
+                = -np.inf
+
+        return np.array(mx), np.array(my), np.array(mr), np.array(mp)
+
+
+def peak_offset(c):
+    """
+    Subpixel offset of a peak from the vertex of the parabola through 3 values c[0], c[1] (the peak), c[2].
+    """
+    if len(c) < 3 or not np.all(np.isfinite(c)):
+        return 0.0
+    d = c[0] - 2 * c[1] + c[2]
+    if d >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (c[0] - c[2]) / d, -0.5, 0.5))
+
+
+def crop_with_zeros(a, x0, y0, n):
+    """
+    The n x n array a[x0: x0 + n, y0: y0 + n], with zeros outside a.
+    """
+    out = np.zeros((n, n), dtype=a.dtype)
+    sx0, sy0 = max(x0, 0), max(y0, 0)
+    sx1, sy1 = min(x0 + n, a.shape[0]), min(y0 + n, a.shape[1])
+    if sx1 > sx0 and sy1 > sy0:
+        out[sx0 - x0: sx1 - x0, sy0 - y0: sy1 - y0] = a[sx0: sx1, sy0: sy1]
+    return out
+
+
+def add_to(a, x0, y0, b):
+    """
+    a[x0: x0 + n, y0: y0 + n] += b for the part inside a.
+    """
+    n = b.shape[0]
+    sx0, sy0 = max(x0, 0), max(y0, 0)
+    sx1, sy1 = min(x0 + n, a.shape[0]), min(y0 + n, a.shape[1])
+    if sx1 > sx0 and sy1 > sy0:
+        a[sx0: sx1, sy0: sy1] += b[sx0 - x0: sx1 - x0, sy0 - y0: sy1 - y0]
+
+
+def pick_vesicles(file_pattern, pixelsize, ctf_filename_after_base, ves_filename_after_base,
+                  n_to_delete_from_end_tobasename, flag_overwrite=0, poll_interval=None, settle_time=5,
+                  max_idle=None, **picker_options):
+    """
+    Pick the vesicles of the micrographs in the current folder and write the vesicle files.
+
+    args:
+        file_pattern: pattern of the micrograph filenames, e.g. '*dmBIN01.mrc'
+        pixelsize: in unit of angstrom per pixel
+        ctf_filename_after_base: e.g. 'dmBIN01.mrc.ctf'
+        ves_filename_after_base: the vesicle files written, e.g. 'dmBIN01.mrc_resub44_screen.txt'
+        n_to_delete_from_end_tobasename: e.g. 11 for 'dmBIN01.mrc'
+        flag_overwrite: 1 to pick again the micrographs with a vesicle file
+        poll_interval: None to pick the micrographs in the folder once.
+            Otherwise the folder is polled every poll_interval seconds for new micrographs.
+        settle_time: when polling, seconds the micrograph and ctf files must be unchanged before they are used
+            (see InputWatcher)
+        max_idle: stop polling after max_idle seconds without a new micrograph. None: never stop.
+        picker_options: keyword arguments of VesiclePicker, e.g. r_min, r_max, threshold
+
+    returns:
+        a dictionary of micrograph: (number of vesicles, seconds to pick)
+
+    note:
+        A micrograph is picked when its ctf file exists and the mrc file is complete. When polling, the two
+        files must also be unchanged for settle_time seconds.
+        The vesicle file is written at once (replace_atomic), so the refit in watch mode reads complete files.
+        A micrograph that fails (e.g. a bad file) is reported and the others are still picked.
+    """
+    picker = VesiclePicker(pixelsize, **picker_options)
+    watcher = None
+    if poll_interval is not None:
+        watcher = InputWatcher(file_pattern, n_to_delete_from_end_tobasename, None, ctf_filename_after_base,
+                               settle_time)
+    picked = {}
+    t_last = time.time()
+    try:
+        while True:
+            if watcher is None:
+                files = sorted(get_files_having_pattern(file_pattern))
+            else:
+                files = [infilename for infilename, __ in watcher.poll()]
+            for infilename in files:
+                base = infilename[0: -n_to_delete_from_end_tobasename]
+                ctf_file = base + ctf_filename_after_base
+                ves_file = base + ves_filename_after_base
+                if infilename in picked or not os.path.isfile(ctf_file):
+                    continue
+                if os.path.isfile(ves_file) and not flag_overwrite:
+                    continue
+                try:
+                    with MRCFile(infilename) as f:
+                        if os.path.getsize(infilename) < f.n_bytes:
+                            continue
+                except Exception:  # the header is not written yet
+                    continue
+
+                t0 = time.time()
+                try:
+                    im, __, __, __ = read_mrc(infilename)
+                    info_ctf = ctf(ctf_file, simple_format=1).asDict()
+                    mx, my, mr, mp = picker.pick(im, info_ctf)
+                    replace_atomic(write_ves_file, ves_file, mx, my, mr, mp)
+                except Exception as err:
+                    print(f'*** Failed: {infilename}: {err!r}')
+                    continue
+                picked[infilename] = (len(mx), time.time() - t0)
+                t_last = time.time()
+                print(f'*** {len(mx)} vesicles picked in {picked[infilename][1]:.2f} s: {ves_file}')
+
+            if watcher is None or (max_idle is not None and time.time() - t_last > max_idle):
+                return picked
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print('*** Stopped.')
+        return picked
+
+
+def main(argv):
+    msg_usage = 'pick_vesicles.py ' \
+                '-f <file_pattern> ' \
+                '-p <pixelsize>  ' \
+                '-c <ctf_filename_after_base>  ' \
+                '-v <ves_filename_after_base>  ' \
+                '-b <n_to_delete_from_end_tobasename>  ' \
+                '[-m <model_type>  ' \
+                '--r_min <A>  ' \
+                '--r_max <A>  ' \
+                '--r_step <A>  ' \
+                '--pixelsize_pick <A>  ' \
+                '--threshold <robust standard deviations>  ' \
+                '--max_vesicles <number>  ' \
+                '--overwrite  ' \
+                '--watch  ' \
+                '--poll_interval <seconds>  ' \
+                '--settle_time <seconds>  ' \
+                '--max_idle <seconds>]'
+    try:
+        opts, args = getopt.getopt(argv[1:], "hf:p:c:v:b:m:", [
+            "file_pattern=", "pixelsize=", "ctf_filename_after_base=", "ves_filename_after_base=",
+            "n_to_delete_from_end_tobasename=", "model_type=", "r_min=", "r_max=", "r_step=", "pixelsize_pick=",
+            "threshold=", "max_vesicles=", "overwrite", "watch", "poll_interval=", "settle_time=", "max_idle="])
+    except getopt.GetoptError:
+        print('Wrong input parameters.')
+        print(msg_usage)
+        sys.exit(2)
+
+    params = {'n_to_delete_from_end_tobasename': 11}
+    flag_watch = 0
+    for opt, arg in opts:
+        if opt == '-h':
+            print(msg_usage)
+            sys.exit()
+        elif opt in ("-f", "--file_pattern"):
+            params['file_pattern'] = arg
+        elif opt in ("-p", "--pixelsize"):
+            params['pixelsize'] = float(arg)
+        elif opt in ("-c", "--ctf_filename_after_base"):
+            params['ctf_filename_after_base'] = arg
+        elif opt in ("-v", "--ves_filename_after_base"):
+            params['ves_filename_after_base'] = arg
+        elif opt in ("-b", "--n_to_delete_from_end_tobasename"):
+            params['n_to_delete_from_end_tobasename'] = int(arg)
+        elif opt in ("-m", "--model_type"):
+            params['model_type'] = int(arg)
+        elif opt in ("--r_min", "--r_max", "--r_step", "--pixelsize_pick", "--threshold", "--poll_interval",
+                     "--settle_time", "--max_idle"):
+            params[opt[2:]] = float(arg)
+        elif opt == "--max_vesicles":
+            params['max_vesicles'] = int(arg)
+        elif opt == "--overwrite":
+            params['flag_overwrite'] = 1
+        elif opt == "--watch":
+            flag_watch = 1
+
+    for key in ('file_pattern', 'pixelsize', 'ctf_filename_after_base', 'ves_filename_after_base'):
+        if key not in params:
+            print(f'*** {key} is not given.')
+            print(msg_usage)
+            sys.exit(2)
+    if flag_watch:
+        params.setdefault('poll_interval', 10)
+    else:
+        params.pop('poll_interval', None)
+        params.pop('settle_time', None)
+
+    pick_vesicles(**params)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv)
+        sys.exit()
+
+    # Without arguments, pick 4 vesicles drawn with the subtraction model in a noisy micrograph
+    from subtract_ves_2019 import subtract_ves_2019
+    from get_membrane_profile import membrane_profile
+    info_ctf = {"defocus": 1.4398, "bfactor": 48, "lambda": 0.0197, "Cs": 2.7, "qfactor": 0.07, "flag_prewhiten": 0,
+                "deltadef": 0.0073, "theta": 0.3649}
+    pixelsize = 2.0
+    mx0 = np.array([200.3, 700.8, 300.1, 760.6])
+    my0 = np.array([250.7, 300.2, 720.4, 760.9])
+    mr0 = np.array([150.0, 220.0, 100.0, 260.0])
+    profile = membrane_profile(44)
+    rng = np.random.default_rng(0)
+    im = rng.normal(0, 0.01, (1024, 1024))
+    im -= subtract_ves_2019(np.zeros((1024, 1024)), profile.fx_in_pixels(pixelsize), profile.fy, mx0, my0, mr0,
+                            np.full(4, 0.02), pixelsize, info_ctf, 0)
+    picker = VesiclePicker(pixelsize, r_max=300)
+    mx, my, mr, mp = picker.pick(im, info_ctf)
+    dist = np.sqrt((mx[:, np.newaxis] - mx0) ** 2 + (my[:, np.newaxis] - my0) ** 2)
+    print(f'{len(mx)} vesicles picked. Center errors: {np.round(np.min(dist, axis=1), 2)} pixels, '
+          f'radii {mr}')
+    assert len(mx) == 4 and np.all(np.min(dist, axis=1) < 2) and len(set(np.argmin(dist, axis=1))) == 4
+
+    # A constant or NaN micrograph gives no vesicles
+    assert len(picker.pick(np.ones((1024, 1024)), info_ctf)[0]) == 0
+    im[10, 10] = np.nan
+    assert len(picker.pick(im, info_ctf)[0]) == 0
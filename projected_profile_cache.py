@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from get_membrane_profile import membrane_profile
+from generate_3d_map_radial_abel import generate_3d_map_radial_abel, abel_projection_1d
+
+
+class ProjectedProfileCache():
+    """
+    Cache of projected vesicle profiles on a fine radius grid, for one membrane model_type and pixelsize.
+
+    The projected profile of a radius on the grid (radius_step in angstrom) is calculated by
+    abel_projection_1d the first time it is needed. The model of any other radius is interpolated
+    from the profiles of the two neighbouring grid radii, each shifted to the requested radius so
+    that the membranes line up. The cache can be saved to and loaded from a npz file.
+
+    The profiles are the projection over the whole membrane. So a model comes from the cache only
+    when the box is large enough to hold the membrane (half_size >= r + fx[-1]), which is the case
+    for the boxes used in vesicle subtraction. Otherwise it is calculated by generate_3d_map_radial_abel.
+
+    attributes:
+        fx, fy: membrane profile in the pixelsize of the image
+        n_profile: number of profiles in the cache
+
+    methods:
+        model: same as generate_3d_map_radial_abel(fx, fy, r_here, half_size, flag_accuracy)
+        save: save the profiles to a npz file
+        load: load the profiles from a npz file
+    """
+
+    def __init__(self, model_type, pixelsize, flag_accuracy=4, radius_step=0.1):
+        """
+        args:
+            model_type: membrane model, as in get_membrane_profile
+            pixelsize: in unit of angstrom per pixel
+            flag_accuracy: number of samples per pixel of the projected profile
+            radius_step: the radius grid in unit of angstrom
+        """
+        profile = membrane_profile(model_type)
+        self.fx = profile.fx_in_pixels(pixelsize)
+        self.fx.setflags(write=False)
+        self.fy = profile.fy
+        self.model_type = model_type
+        self.pixelsize = pixelsize
+        self.flag_accuracy = flag_accuracy
+        self.radius_step = radius_step
+        self._profiles = {}
+
+        self._da = 1.0 / flag_accuracy
+        self._n_equator = int(np.round(1 / self._da))
+
+    @property
+    def n_profile(self):
+        return len(self._profiles)
+
+    def profile(self, k):
+        """
+        The projected profile of radius k * radius_step, on the grid x = 0:da:(r + fx[-1]) in pixels.
+        """
+        proj = self._profiles.get(k)
+        if proj is None:
+            r_here = k * self.radius_step / self.pixelsize
+            z_max = r_here + self.fx[-1]
+            x = np.arange(0, z_max + self._da, self._da)
+            # The outside level fy[-1] is removed here and added back in model
+            proj = abel_projection_1d(self.fx, self.fy - self.fy[-1], r_here, x, z_max, self._da)
+            self._profiles[k] = proj
+        return proj
+
+    def model(self, r_here, half_size):
+        """
+        The projection of a vesicle.
+
+        args:
+            r_here: radius in unit of pixels
+            half_size: half of the image size
+
+        returns:
+            pm1: the projection of a 3D vesicle, as from generate_3d_map_radial_abel
+        """
+        r_here = float(np.squeeze(r_here))
+        nt = int(half_size)
+        if nt < r_here + self.fx[-1]:
+            return generate_3d_map_radial_abel(self.fx, self.fy, r_here, half_size, self.flag_accuracy)
+
+        d2 = np.arange(nt + 1) ** 2
+        d = np.sqrt(d2[:, None] + d2[None, :])
+
+        k_float = r_here * self.pixelsize / self.radius_step
+        k0 = int(np.floor(k_float))
+        w = k_float - k0
+        quarter = np.zeros(d.shape)
+        for k, weight in ((k0, 1 - w), (k0 + 1, w)):
+            if weight > 0:
+                proj = self.profile(k)
+                shift = k * self.radius_step / self.pixelsize - r_here
+                quarter += weight * np.interp(d + shift, np.arange(proj.size) * self._da, proj, right=0)
+
+        # The outside level fy[-1] projected over 0 <= z <= half_size, with the same rectangle-rule terms
+        quarter += self.fy[-1] * (nt + self._da / 2 - (self._n_equator - 1) * self._da / 2)
+
+        ind = np.abs(np.arange(-nt, nt))
+        pm1 = quarter[np.ix_(ind, ind)]
+
+        return pm1 * 2.0
+
+    def save(self, filename):
+        """
+        Save the profiles to a npz file.
+        """
+        keys = np.array(sorted(self._profiles.keys()), dtype=int)
+        profiles = [self._profiles[k] for k in keys]
+        with open(filename, 'wb') as f:  # np.savez would add .npz to a filename without it
+            np.savez(f, model_type=self.model_type, pixelsize=self.pixelsize, flag_accuracy=self.flag_accuracy,
+                     radius_step=self.radius_step, fx=self.fx, fy=self.fy, keys=keys,
+                     sizes=np.array([p.size for p in profiles], dtype=int),
+                     data=np.concatenate(profiles) if profiles else np.zeros(0))
+
+    def load(self, filename):
+        """
+        Load the profiles from a npz file saved with the same model, pixelsize, flag_accuracy and radius_step.
+
+        returns:
+            number of profiles loaded
+        """
+        if not os.path.exists(filename):
+            return 0
+        f = np.load(filename)
+        if (int(f['model_type']) != self.model_type or float(f['pixelsize']) != self.pixelsize or
+                int(f['flag_accuracy']) != self.flag_accuracy or float(f['radius_step']) != self.radius_step or
+                f['fx'].shape != self.fx.shape or not np.array_equal(f['fx'], self.fx) or
+                not np.array_equal(f['fy'], self.fy)):
+            print('*** The profile cache ' + filename + ' is for a different membrane model. Not loaded.')
+            return 0
+
+        offsets = np.concatenate(([0], np.cumsum(f['sizes'])))
+        data = f['data']
+        for j, k in enumerate(f['keys']):
+            self._profiles.setdefault(int(k), data[offsets[j]:offsets[j + 1]])
+        return len(f['keys'])
+
+
+_caches = {}
+
+
+def projected_profile_cache(model_type, pixelsize, flag_accuracy=4):
+    """
+    The ProjectedProfileCache shared in this process for a model_type, pixelsize and flag_accuracy.
+    """
+    key = (model_type, float(pixelsize), flag_accuracy)
+    cache = _caches.get(key)
+    if cache is None:
+        cache = _caches.setdefault(key, ProjectedProfileCache(model_type, pixelsize, flag_accuracy))
+    return cache
+
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+    from generate_3d_map_radial_2018 import generate_3d_map_radial_2018
+
+    pixelsize = 1.056
+    cache = ProjectedProfileCache(44, pixelsize)
+    rng = np.random.RandomState(0)
+    radii = rng.uniform(100, 400, 20)
+    radii[1] = radii[0] + 0.03
+
+    t_cache = 0
+    t_ref = 0
+    err = 0
+    for r in radii:
+        half_size = np.round(r / pixelsize * 2) * 2 / 2
+        t0 = time.time()
+        pm = cache.model(r / pixelsize, half_size)
+        t1 = time.time()
+        pm_ref = generate_3d_map_radial_2018(cache.fx, cache.fy, r / pixelsize, half_size, 4)
+        t2 = time.time()
+        t_cache += t1 - t0
+        t_ref += t2 - t1
+        err = max(err, np.max(np.abs(pm - pm_ref)) / np.max(np.abs(pm_ref)))
+    print(f'{radii.size} radii, {cache.n_profile} profiles: rel max diff {err:.2e}, '
+          f'time {t_ref:.3f} s -> {t_cache:.3f} s')
+    assert err < 1e-3
+
+    filename = os.path.join(tempfile.mkdtemp(), 'profiles_44.npz')
+    cache.save(filename)
+    cache2 = ProjectedProfileCache(44, pixelsize)
+    print(cache2.load(filename), 'profiles loaded')
+    assert np.array_equal(cache2.model(radii[0] / pixelsize, 200), cache.model(radii[0] / pixelsize, 200))
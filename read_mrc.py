@@ -3,10 +3,92 @@
 import numpy as np
 import os
 import warnings
-import struct
 
 
-def read_mrc(filename, start_slice=1, num_slices=None):
+# The 1024-byte header of a mrc file (little Endian)
+mrc_header_dtype = np.dtype([
+    ('nx', '<i4'), ('ny', '<i4'), ('nz', '<i4'), ('mode', '<i4'),
+    ('nxstart', '<i4'), ('nystart', '<i4'), ('nzstart', '<i4'),
+    ('mx', '<i4'), ('my', '<i4'), ('mz', '<i4'),
+    ('cella', '<f4', (3,)), ('cellb', '<f4', (3,)),
+    ('mapc', '<i4'), ('mapr', '<i4'), ('maps', '<i4'),
+    ('dmin', '<f4'), ('dmax', '<f4'), ('dmean', '<f4'),
+    ('ispg', '<i4'), ('nsymbt', '<i4'), ('extra', '<i4', (25,)),
+    ('origin', '<f4', (3,)), ('map', 'S4'), ('machst', 'u1', (4,)),
+    ('rms', '<f4'), ('nlabl', '<i4'), ('label', 'S80', (10,))])
+
+# Data type of each mrc mode
+mrc_mode_dtype = {0: np.dtype('int8'), 1: np.dtype('<i2'), 2: np.dtype('<f4'), 6: np.dtype('<u2'),
+                  12: np.dtype('<f2')}
+
+
+def read_mrc_header(filename):
+    """
+    Read the header of a mrc file.
+
+    args:
+        filename: a mrc file
+
+    returns:
+        s: the header fields as attributes (as in read_mrc), with s.err for errors
+        hdr: the header as a record of mrc_header_dtype
+        extra_header: the extended header as an int16 array, or [] if there is none
+    """
+    s = type('', (), {})()
+    s.err = 0
+    hdr = []
+    extra_header = []
+
+    # Check whether file exist
+    if not os.path.exists(filename):
+        warnings.warn('File could not be found.')
+        s.err = 1
+        return s, hdr, extra_header
+
+    # Check the file size. If it is smaller than 1024 byte, it is wrong file.
+    if os.path.getsize(filename) < 1024:
+        warnings.warn('File is too short for mrc header')
+        s.err = 2
+        return s, hdr, extra_header
+
+    with open(filename, 'rb') as f:
+        hdr = np.fromfile(f, dtype=mrc_header_dtype, count=1)[0]
+        if hdr['nsymbt'] > 0:
+            extra_header = np.fromfile(f, dtype='<i2', count=int(hdr['nsymbt'] // 2))
+
+    if abs(int(hdr['nx'])) > 1e5:  # it is not encoded as little Endian
+        s.err = 3
+        warnings.warn('File is not in little Endian')
+        return s, hdr, extra_header
+
+    s.mode = int(hdr['mode'])
+    s.nx = int(hdr['nx'])
+    s.ny = int(hdr['ny'])
+    s.nz = int(hdr['nz'])
+    s.mx = int(hdr['mx'])
+    s.my = int(hdr['my'])
+    s.mz = int(hdr['mz'])
+    s.org = [float(hdr['nxstart']), float(hdr['nystart']), float(hdr['nzstart'])]
+    if s.mode not in mrc_mode_dtype:
+        s.err = 4
+        raise ValueError('Readmrc: unknown data mode: ' + str(s.mode))
+    s.string = mrc_mode_dtype[s.mode].name
+
+    s.mi = hdr['dmin']
+    s.ma = hdr['dmax']
+    s.av = hdr['dmean']
+    s.rez = float(hdr['cella'][0])
+    s.pixa = s.rez / s.mx if s.mx != 0 else 0.0
+
+    s.chars = [chr(c) for c in hdr.tobytes()[208:216]]
+    ns = min(max(int(hdr['nlabl']), 0), 10)
+    labels = hdr.tobytes()[224:1024]
+    s.header = np.array([[chr(c) for c in labels[80 * i: 80 * (i + 1)]] for i in range(ns)], dtype='<U1')
+
+    return s, hdr, extra_header
+
+
+def read_mrc(filename, start_slice=1, num_slices=None, flag_memmap=0, flag_transpose=1):
     """
     This program read mrc files with an option to start from a specific slice.
 
@@ -14,7 +96,24 @@ def read_mrc(filename, start_slice=1, num_slices=None):
     In python, the image is read with nz = 1:nz while nx = ny = 1 (row major, last index first).
     In matlab, it is different:       nx = 1:nx while ny = nz = 1 (column first, first index first).
     So for 2D image, the transpose of python data is the same as matlab data.
-    For 3D image stack, we need to convert it slice by slice.
+    For 3D image stack, the axes are reversed, so out[:, :, k] is slice k in the matlab convention.
+
+    args:
+        filename: a mrc file
+        start_slice: the first slice to read, starting from 1
+        num_slices: number of slices to read. None: to the last slice.
+        flag_memmap: 1 to return a read-only np.memmap of the slices instead of reading them. The file is
+            opened in constant time and memory, and only the pixels used are read from disk.
+        flag_transpose: 1: the matlab convention above, out is nx x ny (x nz). With flag_memmap, it is a
+            transposed view of the memmap, not a copy.
+            0: the order in the file, out is (nz x) ny x nx.
+
+    returns:
+        out, s, hdr, extra_header
+        out: the slices, squeezed, in the data type of the file
+        s: the header fields as attributes
+        hdr: the header as a record of mrc_header_dtype
+        extra_header: the extended header as an int16 array, or []
 
     s.err =
         1: file doen't exist
@@ -24,180 +123,61 @@ def read_mrc(filename, start_slice=1, num_slices=None):
         5: Number of slices to read is smaller than 1
     """
 
-    start_slice = float(start_slice)
-    hdr = []
-    extra_header = []
-    s = type('', (), {})()
-    s.err = 0
-    # mmap = []
-
+    start_slice = int(start_slice)
     if (num_slices is not None) and (num_slices < 1):
-        s.err = 5
         warnings.warn('Number of slices must be larger than 1')
         return
 
-    # Check whether file exist
-    if not os.path.exists(filename):
-        warnings.warn('File could not be found.')
-        s.err = 1
+    s, hdr, extra_header = read_mrc_header(filename)
+    if s.err:
         return
 
-    # Open the file as a binary file
-    f = open(filename, 'rb')  # read in binary file
+    # Calculate how many slices to read in
+    nz = max(s.nz - max(start_slice, 1) + 1, 0)
+    if num_slices is not None:
+        nz = min(nz, int(num_slices))
 
-    # Check the file size. If it is smaller than 1024 byte, it is wrong file.
-    nbytes = os.path.getsize(filename)
-    if nbytes < 1024:
-        warnings.warn('File is too short for mrc header')
-        s.err = 2
-        return
+    dtype = mrc_mode_dtype[s.mode]
+    offset = 1024 + max(int(hdr['nsymbt']), 0) + (max(start_slice, 1) - 1) * s.nx * s.ny * dtype.itemsize
 
-    # get first 10 entries
-    a = []
-    for i in range(0, 10):
-        x, = np.uint32(struct.unpack('<i', f.read(4)))
-        a.append(x)
-    
-    if abs(a[0]) > 1e5:  # it is not encoded as little Endian
-        s.err = 3
-        warnings.warn('File is not in little Endian')
-        return
-    
-    s.mode = a[3]
-    s.nx = int(a[0])
-    s.ny = int(a[1])
-    s.nz = int(a[2])
-    s.mx = int(a[7])
-    s.my = int(a[8])
-    s.mz = int(a[9])
-    s.org = list(map(float, a[4:7]))
-    nx = s.nx
-    ny = s.ny
-    # nz = s.nz
-
-    if s.mode == 0:
-        string = 'int8'
-        pixbytes = 1
-    elif s.mode == 1:
-        string = 'int16'
-        pixbytes = 2
-    elif s.mode == 2:
-        string = 'float32'
-        pixbytes = 4
-    elif s.mode == 6:
-        string = 'uint16'
-        pixbytes = 2
+    # Read the image data. The data saved in mrc file is column first.
+    if flag_memmap and nz > 0:
+        out = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(nz, s.ny, s.nx))
     else:
-        s.err = 4
-        raise ValueError('Readmrc: unknown data mode: ' + str(s.mode))
-        # return
-
-    s.string = string
-    # pixbyte = int(pixbytes)
-
-    # get the next 12 entries
-    b = []
-    for i in range(10, 22):
-        x, = np.float32(struct.unpack('<f', f.read(4)))
-        b.append(x)
-
-    s.mi = b[9]
-    s.ma = b[10]
-    s.av = b[11]
-    s.rez = float(b[0])
-    s.pixa = s.rez / s.mx
-
-    # get the next 30
-    c = []
-    for i in range(0, 30):
-        x, = np.int32(struct.unpack('<i', f.read(4)))
-        c.append(x)
-
-    d = []
-    for i in range(0, 8):
-        x, = np.uint8(struct.unpack('<b', f.read(1)))        
-        d.append(x)
-    
-    s.chars = list(map(chr, d))  
-
-    e = []
-    for i in range(0, 2):
-        x, = np.int32(struct.unpack('<i', f.read(4)))        
-        e.append(x)
-    
-    # 10 strings
-    ns = min(e[1], 10)
-    sstr = list(map(chr, np.zeros((800, 1))))
-    sstr = np.reshape(sstr, (10, 80))
-    for i in range(0, 10):
-        g = []
-        for j in range(0, 80):
-            x, = np.uint8(struct.unpack('<b', f.read(1)))        
-            g.append(x)
-        g = list(map(int, g))
-        sstr[i, :] = list(map(chr, g))
-    s.header = sstr[0: ns, :]
-
-    # Make sure we are at end of header
-    f.seek(1024)
-
-    # Handle extra header
-    if c[1] > 0:
-        extra_header = []
-        extra_header_num = int(c[1] / 2)
-        for i in range(0, extra_header_num):
-            x, = np.int16(struct.unpack('<h', f.read(2)))
-            extra_header.append(x)
-
-    if start_slice > 1:
-        skipbytes = int((start_slice - 1) * s.nx * s.ny * pixbytes)
-        f.seek(skipbytes, 1)  # move this many byte from current position
-        
-    # Calculate how many slices and data to read in
-    if num_slices is None:
-        nz = int(int(s.nz) - int(start_slice) + 1)
-        if nz < 0:
-            nz = 0
-    else:
-        if num_slices > s.nz:
-            nz = s.nz
-
-    ndata_to_read = int(s.nx * s.ny * nz)
-
-    # Read the image data
-    out = np.zeros((nx, ny, nz))  # out array
-    if s.mode == 0:
-        # string = 'int8'
-        mmap = np.fromfile(f, dtype='int8', count=ndata_to_read)
-        out = np.int8(out)
-    elif s.mode == 1:
-        # string = 'int16'
-        mmap = np.fromfile(f, dtype='int16', count=ndata_to_read)
-        out = np.int16(out)
-    elif s.mode == 2:
-        # string = 'float32'
-        mmap = np.fromfile(f, dtype='float32', count=ndata_to_read)
-        out = np.float32(out)
-    elif s.mode == 6:
-        # string = 'uint16'
-        mmap = np.fromfile(f, dtype='uint16', count=ndata_to_read)
-        out = np.uint16(out)
-    else:
-        raise ValueError('Readmrc: unknown data mode: ' + str(s.mode))
-        # return
-
-    f.close()
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            out = np.fromfile(f, dtype=dtype, count=nz * s.ny * s.nx).reshape((nz, s.ny, s.nx))
+        out = out.astype(dtype.newbyteorder('='), copy=False)
+        if flag_transpose:  # in memory, the same layout as the matlab convention
+            out = np.ascontiguousarray(out.transpose())
+            flag_transpose = 0
 
-    # As the data saved in mrc file is column first, we need to unwrap it that way
-    for ii in range(nz):
-        temp_img = mmap[nx * ny * ii: nx * ny * (ii + 1)]
-        temp_img2 = np.reshape(temp_img, (ny, nx))
-        out[:, :, ii] = np.transpose(temp_img2)
+    if flag_transpose:
+        out = out.transpose()
 
     return np.squeeze(out), s, hdr, extra_header
 
 
 if __name__ == '__main__':
+    import time
+    import tempfile
+    from write_mrc import write_mrc
+
     out, s, hdr, extra_header = read_mrc('data/3dstack.mrc', 3)
-    import scipy.io
-    scipy.io.savemat('test_output/test_readMRC.mat', {'out': out, 's': s, 'hdr': hdr, 'extra': extra_header})
+    print(out.shape, out.dtype, s.nx, s.ny, s.nz, s.pixa)
+
+    # Compare with the slice-by-slice transpose of the old version
+    stack, __, __, __ = read_mrc('data/3dstack.mrc', flag_transpose=0)
+    stack = stack.reshape((-1, s.ny, s.nx))
+    for k in range(out.shape[-1] if out.ndim > 2 else 1):
+        assert np.array_equal(out[..., k] if out.ndim > 2 else out, np.transpose(stack[k + 2]))
+    out2, __, __, __ = read_mrc('data/3dstack.mrc', 3, 1, flag_memmap=1)
+    assert np.array_equal(out2, np.transpose(stack[2]))
+
+    # A large stack is opened without reading it
+    filename = os.path.join(tempfile.mkdtemp(), 'stack.mrc')
+    write_mrc(np.zeros((1024, 1024, 64), dtype=np.float32), 1.0, filename)
+    t0 = time.time()
+    big, s, __, __ = read_mrc(filename, 10, 5, flag_memmap=1)
+    t1 = time.time()
+    print(f'memmap of {big.shape} from a {s.nx} x {s.ny} x {s.nz} stack: {t1 - t0:.4f} s')
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# FFTs of real arrays, which keep only the half of the spectrum along the last axis (rfftn/irfftn).
+# The other half is the complex conjugate, so this halves the arithmetic and the memory of the
+# complex fftn/ifftn followed by np.real. The FFTs are done by the library chosen in fft_backend.
+
+import numpy as np
+import numpy.fft as npfft
+import fft_backend
+
+
+def rfftn(data, axes=None):
+    """
+    FFT of a real array. The last axis of the spectrum has n // 2 + 1 frequencies (see rfft_shape).
+    """
+    return fft_backend.rfftn(data, axes=axes)
+
+
+def irfftn(spec, shape, axes=None):
+    """
+    Inverse of rfftn.
+
+    args:
+        spec: half spectrum
+        shape: shape of the real array (along axes), which is not given by spec when the last size is odd
+    """
+    return fft_backend.irfftn(spec, shape, axes)
+
+
+def rfft_shape(shape):
+    """
+    Shape of the half spectrum of a real array of this shape.
+    """
+    shape = tuple(shape)
+    return shape[:-1] + (shape[-1] // 2 + 1,)
+
+
+def next_fast_size(n):
+    """
+    The smallest even size >= n whose prime factors are 2, 3 and 5, for which FFTs are fast.
+    e.g. 422 (2 * 211) -> 432, 466 (2 * 233) -> 480
+    """
+    m = int(np.ceil(n))
+    m += m % 2
+    while True:
+        k = m
+        for p in (2, 3, 5):
+            while k % p == 0:
+                k //= p
+        if k == 1:
+            return m
+        m += 2
+
+
+def half_plane(q):
+    """
+    The half of a real filter (not centered) used with rfftn.
+
+    np.real(ifftn(q * fftn(data))) only uses the symmetric part (q(f) + q(-f)) / 2 of q, which is
+    returned here, so filter_real gives the same result with any real q. CTFs and Gaussian filters
+    on even sizes are symmetric already.
+
+    args:
+        q: a real filter of the same shape as the data, not centered
+
+    returns:
+        an array of rfft_shape(q.shape)
+    """
+    q = np.asarray(q)
+    m = q.shape[-1] // 2 + 1
+    # q(-f): reverse each axis and roll the zero frequency back to index 0
+    q_minus = np.roll(np.flip(q), 1, axis=tuple(range(q.ndim)))
+    return 0.5 * (q[..., 0:m] + q_minus[..., 0:m])
+
+
+def as_half_plane(q, shape):
+    """
+    q if it is already the half of a filter for data of this shape, otherwise half_plane(q).
+    """
+    if q.shape == rfft_shape(shape) and q.shape != tuple(shape):
+        return q
+    return half_plane(q)
+
+
+def filter_real(data, q_half):
+    """
+    Apply a filter to a real array in Fourier space, np.real(ifftn(q * fftn(data))) with rfftn.
+
+    args:
+        data: a real array
+        q_half: half_plane of the filter (not centered)
+
+    returns:
+        the filtered array
+    """
+    return irfftn(rfftn(data) * q_half, data.shape)
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for shape in [(64, 64), (63, 65), (50, 51), (32,), (33,), (12, 10, 9)]:
+        data = rng.standard_normal(shape)
+        q = rng.random(shape)  # not symmetric
+        out_full = np.real(npfft.ifftn(q * npfft.fftn(data)))
+        out_half = filter_real(data, half_plane(q))
+        print(shape, np.max(np.abs(out_half - out_full)))
+        assert np.allclose(out_half, out_full, rtol=0, atol=1e-12)
+        assert as_half_plane(half_plane(q), shape).shape == rfft_shape(shape)
+
+    assert [next_fast_size(n) for n in (1, 190, 422, 466, 758)] == [2, 192, 432, 480, 768]
+
+    # The filtering functions match their complex FFT versions
+    from apply_filter import apply_filter
+    from gauss_filt import gauss_filt
+    from make_cc_map_mem import make_cc_map_mem
+
+    data = rng.standard_normal((96, 96))
+    q = rng.random((96, 96))
+    assert np.allclose(apply_filter(data, q, 1), np.real(npfft.ifftn(npfft.fftshift(q) * npfft.fftn(data))),
+                       rtol=0, atol=1e-12)
+
+    x, y = np.mgrid[-48: 48, -48: 48]
+    q = npfft.fftshift(np.exp(-np.log(2) * (x ** 2 + y ** 2) / (2 * 0.1 ** 2 * 96 ** 2)))
+    assert np.allclose(gauss_filt(data, 0.1), np.real(npfft.ifftn(q * npfft.fftn(data))), rtol=0, atol=1e-12)
+
+    refs = rng.standard_normal((96, 96, 2))
+    ccm, __ = make_cc_map_mem(data, refs)
+    cc = [np.real(npfft.ifftn(npfft.fftn(data) * np.conj(npfft.fftn(npfft.fftshift(refs[:, :, i])))))
+          for i in range(2)]
+    cc_max = np.maximum(cc[0], cc[1])
+    assert np.allclose(ccm, cc_max, rtol=0, atol=1e-6 * np.max(np.abs(cc_max)))  # ccm is float32
+    print('apply_filter, gauss_filt and make_cc_map_mem match the complex FFT')
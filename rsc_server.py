@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+import sys
+import getopt
+import inspect
+import json
+import threading
+import time
+import concurrent.futures
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from read_mrc import read_mrc
+from write_mrc import write_mrc
+from ctf import ctf
+from read_box_e_m import read_box_e_m
+from get_membrane_profile import membrane_profile
+from subtract_ves_2019 import subtract_ves_2019
+from ctf_bank import default_ctf_bank
+from projected_profile_cache import projected_profile_cache
+from run_manifest import replace_atomic
+from batch_refit_subtract_new_withPOPC_in_folder_parfor_2019 import refit_subtract_micrograph
+
+
+def refit_subtract_request(infilename, pixelsize, model_type, ves_filename_after_base, ctf_filename_after_base,
+                           n_to_delete_from_end_tobasename, scaling_of_mp_if_skip_refit_xy=0, n_ves_workers=1,
+                           fitter='fmin', fit_options=None, bad_vesicle_amplitude_threshold=None):
+    """
+    Refit and subtract the vesicles of a micrograph, as in a batch run (refit_subtract_micrograph).
+    The arguments are the same as in batch_refit_subtract_new_withPOPC_in_folder_parfor_2019.
+
+    returns:
+        a dictionary of outputs (filenames), n_vesicles, bad_vesicle_amplitude_threshold and time (seconds)
+    """
+    t = time.time()
+    res = refit_subtract_micrograph(0, infilename, n_to_delete_from_end_tobasename, pixelsize, model_type,
+                                    ves_filename_after_base, ctf_filename_after_base, scaling_of_mp_if_skip_refit_xy,
+                                    0, None, n_ves_workers, None, fitter, fit_options, bad_vesicle_amplitude_threshold)
+    if res is None:
+        raise FileNotFoundError('ctf or vesicle file does not exist for ' + infilename)
+    return {'outputs': res.outputs, 'n_vesicles': int(res.mxnew.size),
+            'bad_vesicle_amplitude_threshold': float(res.bad_vesicle_amplitude_threshold),
+            'time': time.time() - t}
+
+
+def subtract_request(infilename, ves_file, ctf_file, pixelsize, model_type, outfilename):
+    """
+    Subtract the vesicles of a vesicle file from a micrograph without refitting them (subtract_ves_2019).
+
+    args:
+        infilename: micrograph filename
+        ves_file: vesicle file with mx, my (pixels), mr (angstrom) and mp
+        ctf_file: ctf file
+        pixelsize: in unit of angstrom per pixel
+        model_type: an integer
+        outfilename: filename of the subtracted micrograph
+
+    returns:
+        a dictionary of outputs (filenames), n_vesicles and time (seconds)
+    """
+    t = time.time()
+    im, __, __, __ = read_mrc(infilename)
+    info_ctf = ctf(ctf_file, simple_format=1).asDict()
+    mx, my, mr, mp, __ = read_box_e_m(ves_file)
+    profile = membrane_profile(model_type)
+    im = subtract_ves_2019(im, profile.fx_in_pixels(pixelsize), profile.fy, mx, my, mr, mp, pixelsize, info_ctf, 0,
+                           default_ctf_bank(), projected_profile_cache(model_type, pixelsize))
+    replace_atomic(lambda filename: write_mrc(im, pixelsize, filename, 2), outfilename)
+    return {'outputs': [outfilename], 'n_vesicles': int(mx.size), 'time': time.time() - t}
+
+
+def worker_status():
+    """
+    The caches of the process running the requests.
+    """
+    return {'ctf_bank': default_ctf_bank().report()}
+
+
+class SubtractionServer():
+    """
+    Serve vesicle subtraction over HTTP on localhost, so the imports and caches are paid for once.
+
+    Requests are POSTed as JSON with the arguments of refit_subtract_request (/refit_subtract) or
+    subtract_request (/subtract). File paths are read and written by the server, so they should be
+    absolute. The reply is JSON with the outputs and metrics, or {"error": ...} with status 400 for a bad
+    request (not JSON, wrong arguments) and 500 for a failed one. Requests without Content-Type
+    application/json, or with a Host header other than localhost or the server address, are refused
+    (415, 403), so a web page in a browser cannot post to the server.
+    GET /status gives the number of requests and the caches. It does not wait for the running requests.
+
+    The requests are run by a pool of n_workers. The processes of the pool live as long as the server,
+    so the membrane profiles, projected profiles and ctf banks of each stay in memory between requests.
+    With n_workers = 1, requests are run one by one in a thread of the server.
+
+        server = SubtractionServer(port=8765, n_workers=2)
+        server.serve_forever()
+
+        post_request('http://127.0.0.1:8765', 'subtract', infilename=..., ...)
+    """
+
+    endpoints = {'refit_subtract': refit_subtract_request, 'subtract': subtract_request}
+
+    def __init__(self, host='127.0.0.1', port=8765, n_workers=1):
+        """
+        args:
+            host: address to listen on. Only localhost is safe: the requests can read and write any file.
+            port: port to listen on. 0: any free port (see self.port)
+            n_workers: number of requests run at the same time
+        """
+        if n_workers > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.n_workers = n_workers
+        self.n_requests = 0
+        self.n_running = 0
+        self.n_failed = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.port = self.httpd.server_address[1]
+        self.allowed_hosts = {'localhost', '127.0.0.1', '::1', host}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, result):
+                body = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _check_host(self):
+                # The Host header without the port, e.g. 'localhost:8765' or '[::1]:8765'
+                try:
+                    host = urllib.parse.urlsplit('//' + self.headers.get('Host', '')).hostname
+                except ValueError:
+                    host = None
+                if host in server.allowed_hosts:
+                    return True
+                self._reply(403, {'error': 'host not allowed: ' + self.headers.get('Host', '')})
+                return False
+
+            def do_GET(self):
+                if not self._check_host():
+                    return
+                if self.path.strip('/') == 'status':
+                    self._reply(200, server.status())
+                else:
+                    self._reply(404, {'error': 'unknown endpoint ' + self.path})
+
+            def do_POST(self):
+                if not self._check_host():
+                    return
+                function = server.endpoints.get(self.path.strip('/'))
+                if function is None:
+                    self._reply(404, {'error': 'unknown endpoint ' + self.path})
+                    return
+                content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type != 'application/json':
+                    self._reply(415, {'error': 'Content-Type must be application/json, not ' + content_type})
+                    return
+                try:
+                    params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                except ValueError as err:
+                    self._reply(400, {'error': 'request is not JSON: ' + str(err)})
+                    return
+                status, result = server.run(function, params)
+                self._reply(status, result)
+
+            def log_message(self, format, *args):
+                print('*** ' + self.address_string() + ' ' + format % args)
+
+        return Handler
+
+    def run(self, function, params):
+        """
+        Run a request in the pool and wait for it.
+
+        returns:
+            (HTTP status, result dictionary)
+        """
+        try:
+            if not isinstance(params, dict):
+                raise TypeError('the request must be a JSON object of arguments')
+            inspect.signature(function).bind(**params)
+        except TypeError as err:
+            print(f'*** Bad request {function.__name__} {params}: {err}')
+            return 400, {'error': 'bad arguments: ' + str(err)}
+        with self._lock:
+            self.n_requests += 1
+            self.n_running += 1
+        try:
+            return 200, self.executor.submit(function, **params).result()
+        except Exception as err:
+            with self._lock:
+                self.n_failed += 1
+            print(f'*** Failed request {function.__name__} {params}: {err!r}')
+            return 500, {'error': repr(err)}
+        finally:
+            with self._lock:
+                self.n_running -= 1
+
+    def status(self):
+        result = {'n_workers': self.n_workers, 'n_requests': self.n_requests, 'n_running': self.n_running,
+                  'n_failed': self.n_failed}
+        if self.n_workers == 1:
+            # The requests are run in a thread of this process, so its caches are read here,
+            # without waiting behind the running request in the executor.
+            result.update(worker_status())
+        return result
+
+    def serve_forever(self):
+        host, port = self.httpd.server_address[0: 2]
+        print(f'*** Serving vesicle subtraction on http://{host}:{port} with {self.n_workers} workers. '
+              f'Ctrl-C to stop.')
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            print('*** Stopped.')
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """
+        Stop serve_forever from another thread.
+        """
+        self.httpd.shutdown()
+
+    def close(self):
+        self.httpd.server_close()
+        self.executor.shutdown()
+
+
+def post_request(url, endpoint, **params):
+    """
+    Send a request to a SubtractionServer and wait for the reply.
+
+    args:
+        url: e.g. 'http://127.0.0.1:8765'
+        endpoint: 'refit_subtract' or 'subtract'
+        params: arguments of the request
+
+    returns:
+        the reply dictionary. A failed request raises urllib.error.HTTPError.
+    """
+    request = urllib.request.Request(url.rstrip('/') + '/' + endpoint, data=json.dumps(params).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as reply:
+        return json.loads(reply.read())
+
+
+def main(argv):
+    msg_usage = 'rsc_server.py [-a <host, default 127.0.0.1>  -p <port, default 8765>  -w <n_workers, default 1>]'
+    try:
+        opts, args = getopt.getopt(argv[1:], "ha:p:w:", ["host=", "port=", "n_workers="])
+    except getopt.GetoptError:
+        print('Wrong input parameters.')
+        print(msg_usage)
+        sys.exit(2)
+
+    params = {}
+    for opt, arg in opts:
+        if opt == '-h':
+            print(msg_usage)
+            sys.exit()
+        elif opt in ("-a", "--host"):
+            params['host'] = arg
+        elif opt in ("-p", "--port"):
+            params['port'] = int(arg)
+        elif opt in ("-w", "--n_workers"):
+            params['n_workers'] = int(arg)
+
+    SubtractionServer(**params).serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def load_run_config(filename):
+    """
+    Read a run configuration from a JSON or YAML file (.yaml/.yml, needs pyyaml).
+
+    The keys are the parameter names of batch_refit_subtract_new_withPOPC_in_folder_parfor_2019, e.g.
+        {"file_pattern": "*dmBIN01.mrc", "pixelsize": 1.056, "model_type": 44,
+         "ves_filename_after_base": "dmBIN01.mrc_resub44_screen.txt", "ctf_filename_after_base": "dmBIN01.mrc.ctf",
+         "n_to_delete_from_end_tobasename": 11, "flag_mask_edge": 0}
+
+    args:
+        filename: a .json, .yaml or .yml file
+
+    returns:
+        a dictionary
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    with open(filename, 'r') as f:
+        if ext in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ImportError('pyyaml is needed to read ' + filename + '. Use a JSON file instead.')
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    if config is None:
+        config = {}
+    if not isinstance(config, dict):
+        raise ValueError('The run configuration in ' + filename + ' is not a dictionary.')
+    return config
+
+
+def has_terminal():
+    """
+    True if the input is from a terminal, so the user can be asked.
+    """
+    try:
+        return sys.stdin is not None and sys.stdin.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def ask_if_missing(value, name, function, *args):
+    """
+    Return value if it is given. Otherwise ask the user with function(*args) (e.g. get_yes_no),
+    which is only possible in a terminal.
+
+    args:
+        value: the value from the command line or the run configuration, None if not given
+        name: name of the parameter, for the error message
+        function: the interactive function to get the value
+        args: arguments of function
+
+    returns:
+        the value
+    """
+    if value is not None:
+        return value
+    if not has_terminal():
+        raise ValueError(f'{name} is not given and there is no terminal to ask for it. '
+                         f'Give it on the command line or in the run configuration.')
+    return function(*args)
+
+
+if __name__ == '__main__':
+    import tempfile
+    from get_yes_no import get_yes_no
+
+    filename = os.path.join(tempfile.mkdtemp(), 'run.json')
+    with open(filename, 'w') as f:
+        json.dump({'pixelsize': 1.056, 'flag_mask_edge': 0}, f)
+    config = load_run_config(filename)
+    print(config)
+    print(ask_if_missing(config.get('flag_mask_edge'), 'flag_mask_edge', get_yes_no, 'Blank edges?', 1))
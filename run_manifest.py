@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def file_fingerprint(filename, n_bytes=1 << 20):
+    """
+    A quick fingerprint of a file: sha1 of its size and its first and last n_bytes.
+    It changes when a micrograph is replaced, without reading the whole file.
+
+    returns:
+        [size, hex digest]
+    """
+    size = os.path.getsize(filename)
+    h = hashlib.sha1(str(size).encode('ascii'))
+    with open(filename, 'rb') as f:
+        h.update(f.read(n_bytes))
+        if size > n_bytes:
+            f.seek(max(size - n_bytes, n_bytes))
+            h.update(f.read(n_bytes))
+    return [size, h.hexdigest()]
+
+
+def replace_atomic(write_function, filename, *args):
+    """
+    Write a file by write_function(tmp_filename, *args) to a temporary file in the same folder,
+    then rename it to filename. A file named filename is therefore always complete.
+    """
+    folder, name = os.path.split(filename)
+    tmp_filename = os.path.join(folder, '.' + name + '.part' + str(os.getpid()))
+    try:
+        write_function(tmp_filename, *args)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+class RunManifest():
+    """
+    A JSON-lines log of the micrographs of a batch run, so a run can be restarted where it stopped.
+
+    Each line is a record of one micrograph: input, size, hash (file_fingerprint), status ('running',
+    'done' or 'failed'), time (seconds), outputs, error, and other fields given to finish. Records are only
+    appended, and the last one of an input is its state. A micrograph is done only if its last record
+    is 'done', the input has not changed and all outputs exist.
+
+        manifest = RunManifest('run_manifest.jsonl')
+        if not manifest.is_done(infilename):
+            manifest.start(infilename)
+            ...
+            manifest.finish(infilename, [file_out])
+
+    methods:
+        is_done: whether a micrograph is done
+        record: the last record of a micrograph
+        start, finish, fail: add a record
+        summary: number of micrographs in each status
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._records = {}
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:  # a line cut by a crash
+                        continue
+                    self._records[rec['input']] = rec
+
+    def _key(self, infilename):
+        return os.path.abspath(infilename)
+
+    def _append(self, rec):
+        with self._lock:
+            self._records[rec['input']] = rec
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def record(self, infilename):
+        return self._records.get(self._key(infilename))
+
+    def is_done(self, infilename):
+        rec = self.record(infilename)
+        if rec is None or rec['status'] != 'done':
+            return False
+        if [rec['size'], rec['hash']] != file_fingerprint(infilename):
+            return False
+        return all(os.path.exists(f) for f in rec['outputs'])
+
+    def start(self, infilename):
+        """
+        Record the start of a micrograph.
+        """
+        size, digest = file_fingerprint(infilename)
+        self._append({'input': self._key(infilename), 'size': size, 'hash': digest, 'status': 'running',
+                      'start': time.time(), 'outputs': []})
+
+    def finish(self, infilename, outputs, **fields):
+        """
+        Record that a micrograph is done, with its output files. The time is counted from start.
+        """
+        rec = dict(self.record(infilename))
+        rec.update(status='done', time=time.time() - rec['start'], outputs=[os.path.abspath(f) for f in outputs],
+                   **fields)
+        self._append(rec)
+
+    def fail(self, infilename, error):
+        """
+        Record that a micrograph failed. It is tried again in the next run.
+        """
+        rec = dict(self.record(infilename))
+        rec.update(status='failed', time=time.time() - rec['start'], error=str(error))
+        self._append(rec)
+
+    def summary(self):
+        """
+        returns:
+            a dictionary of the number of micrographs in each status
+        """
+        counts = {}
+        for rec in self._records.values():
+            counts[rec['status']] = counts.get(rec['status'], 0) + 1
+        return counts
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    infilename = os.path.join(folder, 'a.mrc')
+    outfilename = os.path.join(folder, 'a_ves44.mrc')
+    with open(infilename, 'wb') as f:
+        f.write(os.urandom(3 << 20))
+
+    manifest = RunManifest(os.path.join(folder, 'manifest.jsonl'))
+    manifest.start(infilename)
+    assert not manifest.is_done(infilename)
+    replace_atomic(lambda name, data: open(name, 'wb').write(data), outfilename, b'123')
+    manifest.finish(infilename, [outfilename], n_ves=3)
+
+    manifest = RunManifest(os.path.join(folder, 'manifest.jsonl'))
+    print(manifest.record(infilename))
+    assert manifest.is_done(infilename)
+    os.remove(outfilename)
+    assert not manifest.is_done(infilename)
+    print(manifest.summary(), sorted(os.listdir(folder)))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import numpy.fft as npfft
+from real_fft import rfftn, irfftn, as_half_plane
+from ves_density_circular import ves_density_profile, ves_density_scale, ves_density_lookup, ves_density_interp
+
+
+def sphere_fit_lm(p, n, pixelsize, data, ctf, d=50, t=0.2, cp=0.05, wth=4.2, lowpass=(80, 40), xtol=0.1,
+                  max_iter=50, full_return=False):
+    """
+    Fit the radius and center of a vesicle by Levenberg-Marquardt, with the fake membrane profile
+    of sphere_fit_main mode 1 (ves_density_circular).
+
+    The model and the error are the same as in sphere_fit_main mode 1. The derivatives of the model are
+    calculated in Fourier space: the center derivatives by multiplying its spectrum with -2*pi*i*f
+    (the derivative of a phase ramp), and the radius derivative from a finite difference of the 1D radial
+    profile (ves_density_profile). The offset and amplitude are solved in closed form for each
+    (radius, center) (variable projection), so only three parameters are fitted, as with
+    fmin(sphere_fit_main, ...).
+
+    The CTF rings make many local minima. So the fit is first done on Gaussian low-pass filtered data and
+    model (lowpass, in angstrom), which has a wider basin, and then at full resolution.
+
+    Steps are only taken inside the window that refit_vesicle_box accepts: the radius at most n/2 pixels
+    and the center at most n/4 pixels from the initial guess. Otherwise the fit could move to another
+    minimum outside the window, and the result would be rejected.
+
+    args:
+        p: initial guess of parameters [radius x0 y0], radius in angstrom, center starting from 1
+        n: box size
+        pixelsize: in unit of angstrom per pixel
+        data: nxn or nxn x2 array. If it is a nxnx2 array, it has a mask
+        ctf: nxn array representing the CTF (not centered), or its half_plane (see real_fft)
+        d, t, cp, wth: parameters for fake membrane profile, as in sphere_fit_main
+        lowpass: resolutions (angstrom) of the low-pass levels before the fit at full resolution
+        xtol: stop when the step is smaller than xtol (angstrom for the radius, pixels for the center).
+            The low-pass levels stop at 1.
+        max_iter: maximum number of iterations of each level
+        full_return: also return the number of model evaluations
+
+    returns:
+        [radius x_fit y_fit]
+        and n_eval if full_return
+    """
+    if (len(data.shape) > 2) and data.shape[2] == 2:  # If data is nxnx2, it includes a mask
+        ind = data[:, :, 1] > 0
+        data = data[:, :, 0]
+    else:
+        ind = np.ones(data.shape, dtype=bool)
+    weight_sum = np.sum(ind)
+
+    # Spectra are kept as halves along the last axis (rfftn), since all images are real
+    ctf = as_half_plane(ctf, (n, n))
+    freq = npfft.fftfreq(n)
+    freq_half = npfft.rfftfreq(n)
+    deriv_x = (-2j * np.pi * freq)[:, None]
+    deriv_y = (-2j * np.pi * freq_half)[None, :]
+    h = 0.01 * pixelsize  # step of the radius derivative in angstrom
+    x0, y0 = p[1], p[2]
+
+    def evaluate(par, filt, data_used):
+        """
+        returns: cost, residual on the pixels in the mask, and a function to calculate the Jacobian
+        """
+        a, x, y = par
+        if a <= d / 2 or a / pixelsize > n / 2 or np.abs(x - x0) > n / 4 or np.abs(y - y0) > n / 4:
+            return np.inf, None, None
+
+        # The same vesicle image as ves_density_circular(n, pixelsize, a, d, t, cp, wth, x, y)
+        scale = ves_density_scale(a, pixelsize)
+        r0, rf, nr = ves_density_lookup(n, x, y, scale)
+        dd, norm = ves_density_profile(nr, pixelsize, a, d, t, cp, wth, scale)
+        spec = rfftn(ves_density_interp(dd, r0, rf) / norm) * ctf
+        if filt is not None:
+            spec *= filt
+        model = irfftn(spec, (n, n))[ind]
+
+        # Offset and amplitude in closed form
+        basis = np.array([[weight_sum, np.sum(model)], [np.sum(model), np.sum(model ** 2)]])
+        if np.linalg.cond(basis) > 1e12:
+            return np.inf, None, None
+        lp = np.linalg.solve(basis, [np.sum(data_used), np.sum(model * data_used)])
+        residual = data_used - lp[0] - lp[1] * model
+
+        def jacobian():
+            dd_plus, __ = ves_density_profile(nr, pixelsize, a + h, d, t, cp, wth, scale)
+            dd_minus, __ = ves_density_profile(nr, pixelsize, a - h, d, t, cp, wth, scale)
+            dd_a = (dd_plus - dd_minus) / (2 * h)
+            spec_a = rfftn(ves_density_interp(dd_a, r0, rf) / norm) * ctf
+            if filt is not None:
+                spec_a *= filt
+
+            # A shift of the center is a phase ramp, so its derivative is a multiplication in Fourier space
+            grads = [irfftn(spec_a, (n, n))[ind],
+                     irfftn(spec * deriv_x, (n, n))[ind],
+                     irfftn(spec * deriv_y, (n, n))[ind]]
+
+            # Derivatives of the model after projecting out the offset and the amplitude
+            jac = np.empty((model.size, 3))
+            for k, g in enumerate(grads):
+                coef = np.linalg.solve(basis, [np.sum(g), np.sum(g * model)])
+                jac[:, k] = lp[1] * (g - coef[0] - coef[1] * model)
+            return jac
+
+        return np.sum(residual ** 2), residual, jacobian
+
+    par = np.array(p, dtype=float)
+    n_eval = 0
+    spec_data = rfftn(data)
+    f2 = (freq ** 2)[:, None] + (freq_half ** 2)[None, :]
+    for res in list(lowpass) + [None]:
+        if res is None:
+            filt = None
+            data_used = data[ind]
+            xtol_here = xtol
+        else:
+            filt = np.exp(-f2 * (res / pixelsize) ** 2 / 2)
+            data_used = irfftn(spec_data * filt, (n, n))[ind]
+            xtol_here = max(xtol, 1)
+
+        cost, residual, jacobian = evaluate(par, filt, data_used)
+        n_eval += 1
+        if not np.isfinite(cost):
+            break
+        jac = jacobian()
+        lam = 1e-3
+        for __ in range(max_iter):
+            jtj = jac.T @ jac
+            grad = jac.T @ residual
+            flag_stop = False
+            while True:
+                step = np.linalg.solve(jtj + lam * np.diag(np.diag(jtj)), grad)
+                cost_new, residual_new, jacobian_new = evaluate(par + step, filt, data_used)
+                n_eval += 1
+                if cost_new < cost:
+                    par, cost, residual = par + step, cost_new, residual_new
+                    lam = max(lam / 10, 1e-9)
+                    break
+                lam *= 10
+                if lam > 1e8:
+                    flag_stop = True
+                    break
+            if flag_stop or np.all(np.abs(step) < xtol_here):
+                break
+            jac = jacobian_new()
+
+    if full_return:
+        return [par, n_eval]
+    else:
+        return par
+
+
+if __name__ == "__main__":
+    import time
+    from ctf_bank import CtfBank
+    from real_fft import filter_real, half_plane
+    from ves_density_circular import ves_density_circular
+    from subtract_vesicles_popc_ect_2019 import crop_vesicle_box, refit_vesicle_box
+
+    # A vesicle in a noisy micrograph, refitted from a guess 3 pixels and 5 A off as in the subtraction
+    info_ctf = {"defocus": 1.4398, "bfactor": 48, "lambda": 0.0197, "Cs": 2.7, "qfactor": 0.07, "flag_prewhiten": 0,
+                "deltadef": 0.0073, "theta": 0.3649}
+    pixelsize = 1.056
+    mx, my, mr = 500.3, 520.8, 160.0
+    ctf_bank = CtfBank()
+    im = -0.02 * filter_real(ves_density_circular(1024, pixelsize, mr, x=mx, y=my),
+                             half_plane(ctf_bank.get(info_ctf, pixelsize, 1024)))
+    im += np.random.default_rng(0).normal(0, 0.02, im.shape)
+    box = crop_vesicle_box(im, mx + 3, my - 2, mr - 5, pixelsize, np.mean(im))
+    ctf2d = ctf_bank.get(info_ctf, pixelsize, box.n_here)
+    for fitter in ('fmin', 'lm'):
+        t0 = time.time()
+        a_fit, x_fit, y_fit = refit_vesicle_box(box.data, box.n_here, pixelsize, ctf2d, box.r0, fitter)
+        # The center in the micrograph, as in subtract_vesicles_popc_ect_2019
+        dx = x_fit + box.x0 - box.n_here / 2 - mx
+        dy = y_fit + box.y0 - box.n_here / 2 - my
+        print(f'{fitter}: radius error {a_fit - mr:.2f} A, center error {dx:.2f} {dy:.2f} pixels, '
+              f'{time.time() - t0:.2f} s')
+        if fitter == 'lm':
+            assert abs(a_fit - mr) < 1 and abs(dx) < 0.5 and abs(dy) < 0.5
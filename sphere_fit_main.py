@@ -1,17 +1,17 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import numpy.fft as npfft
+from real_fft import filter_real, as_half_plane
 import scipy.optimize
 import debug
 from least_square import least_square, least_square_1d
-from generate_3d_map_radial_2018 import generate_3d_map_radial_2018
+from projected_profile_cache import projected_profile_cache
 from ves_density_circular import ves_density_circular
-from get_membrane_profile import get_membrane_profile
-from shift_array import shift_array
+from vesicle_model_evaluator import VesicleModelEvaluator
 
 
-def sphere_fit_main(p, mode, n, pixelsize, data, ctf, a, d, t, cp, wth, x=None, y=None, scale=None):
+def sphere_fit_main(p, mode, n, pixelsize, data, ctf, a, d, t, cp, wth, x=None, y=None, scale=None, profile=None,
+                    evaluator=None):
     """
     This is called by vesicle subtraction to fit the vesicle size and position
     using either fake membrane profile or rale membrane profile
@@ -23,7 +23,7 @@ def sphere_fit_main(p, mode, n, pixelsize, data, ctf, a, d, t, cp, wth, x=None,
             44: real membrane profile, vesicle type
         pixelsize:
         data: nxn or nxn x2 array. If it is a nxnx2 array, it has a mask
-        ctf:    nxn array representing the CTF
+        ctf:    nxn array representing the CTF, or its half_plane (see real_fft)
         a:  parameters for fake membrane profile
         d:  parameters for fake membrane profile
         t:  parameters for fake membrane profile
@@ -32,6 +32,11 @@ def sphere_fit_main(p, mode, n, pixelsize, data, ctf, a, d, t, cp, wth, x=None,
         x:  parameters for fake membrane profile
         y:  parameters for fake membrane profile
         scale:parameters for fake membrane profile
+        profile: the prepared membrane profile for mode > 1, a ProjectedProfileCache of model 'mode'
+            at this pixelsize. None: projected_profile_cache(mode, pixelsize, 1) is used.
+        evaluator: a VesicleModelEvaluator of profile, n and ctf for mode > 1. It keeps the spectra of the
+            models between calls, so each call is one inverse FFT. It should be made once for a fit
+            (see refit_vesicle_box). None: one is made for this call only, and the spectra are recalculated.
 
     return:
         [radius x_fit y_fit]
@@ -50,25 +55,20 @@ def sphere_fit_main(p, mode, n, pixelsize, data, ctf, a, d, t, cp, wth, x=None,
     if mode == 1:
         a, x, y = p
         dd = ves_density_circular(n, pixelsize, a, d, t, cp, wth, x, y)
+        model = filter_real(dd, as_half_plane(ctf, dd.shape))
     elif mode > 1:
         a, x_fit, y_fit = p
-        n_here = n
 
-        fxt, fyt, pixelsize_membrane = get_membrane_profile(mode)
-        fxt = fxt * pixelsize_membrane / pixelsize   # membrane profile is in the same pixelsize as in the image now.
-        dd = generate_3d_map_radial_2018(fxt, fyt, a / pixelsize, n_here / 2, 1)
-
-        shiftx = np.round(x_fit) - (np.round(n_here / 2) + 1) + 1  # Calculate shift for shift_array
-        shifty = np.round(y_fit) - (np.round(n_here / 2) + 1) + 1
-        shiftx += ((shiftx < 1) * n_here)
-        shifty += ((shifty < 1) * n_here)
-        dd = shift_array(dd, shiftx, shifty)
+        # The model is placed at the subpixel center (x_fit, y_fit) by a phase ramp
+        if evaluator is None:
+            if profile is None:
+                profile = projected_profile_cache(mode, pixelsize, 1)
+            evaluator = VesicleModelEvaluator(profile, n, ctf)
+        model = evaluator.model(a / pixelsize, x_fit, y_fit)
     else:
         print('The mode is not chosen correctly!')
         return None
 
-    model = np.real(npfft.ifftn(npfft.fftn(dd) * ctf))
-
     if nzt > 1:
         ind = np.where(data_mask > 0)
         lp = least_square_1d(data[ind], model[ind])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import time
+import numpy as np
+import numpy.fft as npfft
+import fft_backend
+import debug
+from sphere_fit_lm import sphere_fit_lm
+
+
+def fourier_crop(data, m):
+    """
+    Downsample an n x n array to m x m (m <= n, both even) by keeping the m x m lowest frequencies.
+    Pixel j (starting from 0) of the output is at position j * n / m of the input, so the center
+    pixel n/2+1 goes to m/2+1. The mean is kept.
+
+    args:
+        data: n x n array (real)
+        m: output size
+
+    returns:
+        m x m array
+    """
+    n = data.shape[0]
+    if m == n:
+        return np.copy(data)
+    spec = npfft.fftshift(fft_backend.fftn(data))
+    c0 = n // 2 - m // 2
+    spec = npfft.ifftshift(spec[c0:c0 + m, c0:c0 + m])
+    return np.real(fft_backend.ifftn(spec)) * (m / n) ** 2
+
+
+def crop_ctf(ctf, m):
+    """
+    The m x m part of an n x n CTF (not centered) at the lowest frequencies, which is the CTF of the
+    box downsampled by fourier_crop.
+    """
+    n = ctf.shape[0]
+    if m == n:
+        return ctf
+    c0 = n // 2 - m // 2
+    return npfft.ifftshift(npfft.fftshift(ctf)[c0:c0 + m, c0:c0 + m])
+
+
+def sphere_fit_pyramid(p, n, pixelsize, data, ctf, d=50, t=0.2, cp=0.05, wth=4.2, levels=(4,), xtol=None,
+                       max_iter=None, lowpass=(80, 40), full_return=False):
+    """
+    Fit the radius and center of a vesicle coarse to fine, with sphere_fit_lm.
+
+    The box, its mask and the CTF are downsampled by fourier_crop for each level in levels (the
+    downsampling factors, from coarse to fine). The first level is fitted from p with the low-pass
+    levels of sphere_fit_lm, and each next level starts from the result of the previous one. At last
+    the fit is refined at full resolution for at most max_iter[-1] iterations.
+
+    args:
+        p: initial guess of parameters [radius x0 y0], radius in angstrom, center starting from 1
+        n: box size
+        pixelsize: in unit of angstrom per pixel
+        data: nxn or nxn x2 array. If it is a nxnx2 array, it has a mask
+        ctf: nxn array representing the CTF (not centered)
+        d, t, cp, wth: parameters for fake membrane profile, as in sphere_fit_main
+        levels: downsampling factors of the levels before the full resolution. () fits at full resolution only.
+        xtol: tolerance of each level and of the full resolution (len(levels) + 1 values), in angstrom
+            for the radius and in pixels of the level for the center. None: 1 for the levels and 0.1 at last.
+        max_iter: maximum number of iterations of each level and of the full resolution.
+            None: 50 for the levels and 5 at last.
+        lowpass: resolutions (angstrom) of the low-pass filters of sphere_fit_lm, used at the first level only.
+            The ones finer than the Nyquist resolution of that level are skipped.
+        full_return: also return the number of model evaluations and the time of each level
+
+    returns:
+        [radius x_fit y_fit]
+        and n_eval, [time of each level in seconds] if full_return
+    """
+    if xtol is None:
+        xtol = [1] * len(levels) + [0.1]
+    if max_iter is None:
+        max_iter = [50] * len(levels) + [5]
+    if len(xtol) != len(levels) + 1 or len(max_iter) != len(levels) + 1:
+        raise ValueError(f'sphere_fit_pyramid needs one xtol and one max_iter for each level and the full '
+                         f'resolution ({len(levels) + 1} values), not {len(xtol)} and {len(max_iter)}.')
+
+    if (len(data.shape) > 2) and data.shape[2] == 2:  # If data is nxnx2, it includes a mask
+        image = data[:, :, 0]
+        mask = data[:, :, 1]
+    else:
+        image = data
+        mask = None
+
+    par = np.array(p, dtype=float)
+    n_eval = 0
+    times = []
+    for k, ds in enumerate(list(levels) + [1]):
+        t0 = time.time()
+        m = int(2 * np.round(n / ds / 2))
+        pixelsize_level = pixelsize * n / m
+        if m == n:
+            data_level = data
+            ctf_level = ctf
+        else:
+            data_level = fourier_crop(image, m)
+            if mask is not None:
+                data_level = np.stack((data_level, fourier_crop(mask, m) > 0.5), axis=2)
+            ctf_level = crop_ctf(ctf, m)
+
+        if k == 0:
+            lowpass_level = [res for res in lowpass if res > 2 * pixelsize_level]
+        else:
+            lowpass_level = ()
+
+        # center in the pixels of this level
+        par[1:] = (par[1:] - 1) * m / n + 1
+        par, n_eval_level = sphere_fit_lm(par, m, pixelsize_level, data_level, ctf_level, d, t, cp, wth,
+                                          lowpass_level, xtol[k], max_iter[k], full_return=True)
+        par[1:] = (par[1:] - 1) * n / m + 1
+        n_eval += n_eval_level
+        times.append(time.time() - t0)
+
+    if full_return:
+        return [par, n_eval, times]
+    else:
+        return par
+
+
+if __name__ == "__main__":
+    from sphere_fit_main import sphere_fit_main
+
+    par0 = debug.load_mat_var("data/sphere_fit_main_in.mat", "par0")[0, 0]
+    par1 = debug.load_mat_var("data/sphere_fit_main_in.mat", "par1")[0, 0]
+    par2 = debug.load_mat_var("data/sphere_fit_main_in.mat", "par2")[0, 0]
+    n_here = debug.load_mat_var("data/sphere_fit_main_in.mat", "n_here")[0, 0]
+    pixelsize = debug.load_mat_var("data/sphere_fit_main_in.mat", "pixelsize")[0, 0]
+    data_for_opt = debug.load_mat_var("data/sphere_fit_main_in.mat", "data_for_opt")
+    Ctf = debug.load_mat_var("data/sphere_fit_main_in.mat", "Ctf")
+    r0 = debug.load_mat_var("data/sphere_fit_main_in.mat", "r0")[0, 0]
+    args = (1, n_here, pixelsize, data_for_opt, Ctf, r0, 50, 0.2, 0.05, 4.2)
+
+    # A smooth image is kept by fourier_crop
+    xx = np.arange(64)
+    img = np.cos(2 * np.pi * 3 * xx / 64)[:, None] * np.ones(64)[None, :]
+    assert np.allclose(fourier_crop(img, 16), img[::4, ::4])
+
+    t0 = time.time()
+    res_lm, n_lm = sphere_fit_lm(np.array([par0, par1, par2]), n_here, pixelsize, data_for_opt, Ctf,
+                                 full_return=True)
+    t1 = time.time()
+    print(f'lm:      {res_lm}, error {sphere_fit_main(res_lm, *args):.6g}, {n_lm} evaluations, {t1 - t0:.2f} s')
+    for levels, xtol, max_iter in (((2,), (1, 0.1), (50, 5)), ((4,), (1, 0.1), (50, 5)),
+                                   ((4, 2), (1, 0.5, 0.1), (50, 10, 5))):
+        res, n_eval, times = sphere_fit_pyramid(np.array([par0, par1, par2]), n_here, pixelsize, data_for_opt, Ctf,
+                                                levels=levels, xtol=xtol, max_iter=max_iter, full_return=True)
+        print(f'levels {levels}: {res}, error {sphere_fit_main(res, *args):.6g}, {n_eval} evaluations, '
+              f'time of levels ' + ', '.join(f'{s:.2f}' for s in times) + ' s')
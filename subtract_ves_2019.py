@@ -1,22 +1,21 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import scipy.io
-import debug
 
 from get_ctf_for_vesicle_subtraction import get_ctf_for_vesicle_subtraction
-from generate_3d_map_radial_2018 import generate_3d_map_radial_2018
+from generate_3d_map_radial_abel import generate_3d_map_radial_abel
 from apply_filter import apply_filter
+from real_fft import next_fast_size
 
 from gauss_filt import gauss_filt
 
-import matplotlib.pyplot as plt
 from imgray import imgray
 from imcolor import imcolor
 from add_circle import add_circle
 
 
-def subtract_ves_2019(data_in, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, displaymode=0):
+def subtract_ves_2019(data_in, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, displaymode=0, ctf_bank=None,
+                      profile_cache=None, flag_fft_size=1):
     """
     This is used to subtract a set of vesicles from input micrograph.
     Just subtraction, no fitting.
@@ -29,6 +28,11 @@ def subtract_ves_2019(data_in, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, disp
         pixelsize: in unit of angstrom per pixel
         info_ctf: ctf information
         displaymode:
+        ctf_bank: a CtfBank to get the ctf of each vesicle box from. None: ctf is calculated for each vesicle.
+        profile_cache: a ProjectedProfileCache of the membrane profile (fx, fy) to get the vesicle models from.
+            None: models are calculated by generate_3d_map_radial_abel.
+        flag_fft_size: 1 to calculate the model of each vesicle in a box of a size with fast FFTs
+            (next_fast_size of 4 times the radius). Only the 4 times the radius around the vesicle is subtracted.
 
     returns:
         rtn: vesicle-subtract image
@@ -36,57 +40,21 @@ def subtract_ves_2019(data_in, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, disp
 
     """
     num_ves = mx.size
-    n = data_in.shape
-    ndx = n[0]
-    ndy = n[1]
     # padx = int(ndx/2)
     # pady = int(ndy/2)
     # small_now = np.zeros((ndx*2, ndy*2))
     # small_now[padx:padx+ndx, pady:pady+ndy] += data
     small_now = np.copy(data_in)
 
-    # check whether th vesicle is completely outside the image
-    flag_out = np.less(mx + mr, 1)
-    flag_out += np.less(my + mr, 1)
-    flag_out += np.greater(mx - mr, ndx)
-    flag_out += np.greater(my - mr, ndy)
+    flag_sub = flag_ves_to_subtract(data_in.shape, mx, my, mr, mp)
 
-    nd = min(ndx, ndy)
     for i in range(num_ves):
-
-        if (mp[i] > 0) and (not flag_out[i]):
-            x0 = int(np.round(mx[i] - 1))
-            y0 = int(np.round(my[i] - 1))
-            r0 = mr[i]
-            cutw = int(min(np.round(r0 / pixelsize * 2) * 2, nd))
-
-            cutx0 = int(max(np.round(x0 - cutw / 2), 0))
-            cutx1 = int(min(np.round(x0 + cutw / 2), ndx))
-            cuty0 = int(max(np.round(y0 - cutw / 2), 0))
-            cuty1 = int(min(np.round(y0 + cutw / 2), ndy))
-            cutw_half = int(cutw / 2)
-
-            data = np.zeros((cutw, cutw))
-            # print(i)
-
-            data[cutw_half - (x0 - cutx0): cutw_half + (cutx1 - x0), cutw_half - (y0 - cuty0): cutw_half + (
-                    cuty1 - y0)] = small_now[cutx0: cutx1, cuty0: cuty1]
-
-            n_here = cutw
-            ctf_here = get_ctf_for_vesicle_subtraction(info_ctf, pixelsize, n_here)
-
-            vesicle_model = generate_3d_map_radial_2018(fx, fy, mr[i] / pixelsize, n_here / 2, 4)
-
-            model = apply_filter(vesicle_model, ctf_here, 0)
-
-            data_after_sub = data - (model * mp[i])
-            xt0 = cutw_half - (x0 - cutx0)
-            xt1 = cutw_half + (cutx1 - x0)
-            yt0 = cutw_half - (y0 - cuty0)
-            yt1 = cutw_half + (cuty1 - y0)
-            small_now[cutx0: cutx1, cuty0: cuty1] = data_after_sub[xt0: xt1, yt0: yt1]
+        if flag_sub[i]:
+            subtract_one_ves_2019(small_now, fx, fy, mx[i], my[i], mr[i], mp[i], pixelsize, info_ctf, ctf_bank,
+                                  profile_cache, flag_fft_size)
 
     if displaymode:
+        import matplotlib.pyplot as plt  # only when images are displayed
         print('... prepare images to display...')
         plt.subplot(1, 2, 1)
         imf = gauss_filt(data_in, 0.2)
@@ -101,8 +69,86 @@ def subtract_ves_2019(data_in, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, disp
     return small_now
 
 
+def flag_ves_to_subtract(shape, mx, my, mr, mp):
+    """
+    Check which vesicles are subtracted by subtract_ves_2019
+
+    args:
+        shape: shape of the micrograph
+        mx, my, mr, mp: the same as in subtract_ves_2019
+
+    returns:
+        a boolean array. False if the amplitude is not positive or the vesicle is completely outside the image.
+    """
+    ndx = shape[0]
+    ndy = shape[1]
+
+    # check whether th vesicle is completely outside the image
+    flag_out = np.less(mx + mr, 1)
+    flag_out += np.less(my + mr, 1)
+    flag_out += np.greater(mx - mr, ndx)
+    flag_out += np.greater(my - mr, ndy)
+
+    return np.greater(mp, 0) * np.logical_not(flag_out)
+
+
+def subtract_one_ves_2019(small_now, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, ctf_bank=None, profile_cache=None,
+                          flag_fft_size=1):
+    """
+    Subtract one vesicle from small_now in place. A negative mp adds the vesicle back.
+
+    args:
+        small_now: a 2D array which is modified
+        mx, my: position of the vesicle in unit of pixels
+        mr: radius of the vesicle in unit of angstrom
+        mp: amplitude of the model vesicle
+        Others are the same as in subtract_ves_2019
+    """
+    ndx, ndy = small_now.shape
+    nd = min(ndx, ndy)
+
+    x0 = int(np.round(mx - 1))
+    y0 = int(np.round(my - 1))
+    r0 = mr
+    cutw = int(min(np.round(r0 / pixelsize * 2) * 2, nd))
+
+    cutx0 = int(max(np.round(x0 - cutw / 2), 0))
+    cutx1 = int(min(np.round(x0 + cutw / 2), ndx))
+    cuty0 = int(max(np.round(y0 - cutw / 2), 0))
+    cuty1 = int(min(np.round(y0 + cutw / 2), ndy))
+    # The model box is padded around the crop to a size with fast FFTs
+    n_here = next_fast_size(cutw) if flag_fft_size else cutw
+    cutw_half = int(n_here / 2)
+
+    data = np.zeros((n_here, n_here))
+
+    data[cutw_half - (x0 - cutx0): cutw_half + (cutx1 - x0), cutw_half - (y0 - cuty0): cutw_half + (
+            cuty1 - y0)] = small_now[cutx0: cutx1, cuty0: cuty1]
+
+    if ctf_bank is None:
+        ctf_here = get_ctf_for_vesicle_subtraction(info_ctf, pixelsize, n_here)
+    else:
+        ctf_here = ctf_bank.get(info_ctf, pixelsize, n_here, 1)  # half_plane for rfftn in apply_filter
+
+    if profile_cache is None:
+        vesicle_model = generate_3d_map_radial_abel(fx, fy, mr / pixelsize, n_here / 2, 4)
+    else:
+        vesicle_model = profile_cache.model(mr / pixelsize, n_here / 2)
+
+    model = apply_filter(vesicle_model, ctf_here, 0)
+
+    data_after_sub = data - (model * mp)
+    xt0 = cutw_half - (x0 - cutx0)
+    xt1 = cutw_half + (cutx1 - x0)
+    yt0 = cutw_half - (y0 - cuty0)
+    yt1 = cutw_half + (cuty1 - y0)
+    small_now[cutx0: cutx1, cuty0: cuty1] = data_after_sub[xt0: xt1, yt0: yt1]
+
+
 if __name__ == "__main__":
     # import time
+    import scipy.io
+    import debug
     fx = debug.load_mat_var("data/subtract_ves_2019_in.mat", "fx")
     fx.shape = (fx.shape[1],)
     fy = debug.load_mat_var("data/subtract_ves_2019_in.mat", "fy")
@@ -31,15 +31,80 @@ def ves_density_circular(n, pixelsize, a, d=50, t=0.2, cp=0.05, wth=4.2,
     if y is None:
         y = np.floor(n / 2 + 1)
     if scale is None:
-        if a / pixelsize > 50 * 2:
-            scale = 1
-        elif a / pixelsize > 25 * 2:
-            scale = 2
-        elif a / pixelsize > 12 * 2:
-            scale = 4
-        else:
-            scale = 8
+        scale = ves_density_scale(a, pixelsize)
 
+    r0, rf, nr = ves_density_lookup(n, x, y, scale)
+    dd, norm = ves_density_profile(nr, pixelsize, a, d, t, cp, wth, scale, ion)
+
+    # Use D as a look-up table with linear interpolation.
+    ww = ves_density_interp(dd, r0, rf)
+    ww = ww / norm
+    if full_return:
+        return [ww, dd, scale]
+    else:
+        return ww
+
+
+def ves_density_scale(a, pixelsize):
+    """
+    The number of samples per pixel of the radial profile of ves_density_circular for a radius a (angstrom).
+    Small vesicles are sampled more finely.
+    """
+    if a / pixelsize > 50 * 2:
+        return 1
+    elif a / pixelsize > 25 * 2:
+        return 2
+    elif a / pixelsize > 12 * 2:
+        return 4
+    else:
+        return 8
+
+
+def ves_density_lookup(n, x, y, scale):
+    """
+    The positions of the pixels of an nxn image in the radial profile of a vesicle centered at x, y
+    (starting from 1), sampled scale times per pixel.
+
+    returns:
+        r0: index of each pixel into the profile (starting from 1)
+        rf: fraction between r0 and r0 + 1
+        nr: length of the profile needed (see ves_density_profile)
+    """
+    # Make zero at x,y (center of the nxn image)
+    yy, xx = np.meshgrid(np.arange(1-y, n-y+1), np.arange(1-x, n-x+1))
+    # index into the radial function
+    rr = scale * np.sqrt(xx**2 + yy**2) + 1
+    nr = int(np.floor(np.max(rr))) + 1
+
+    r0 = np.floor(rr)
+    rf = rr - r0
+    r0 = r0.astype('int', copy=False)
+    return r0, rf, nr
+
+
+def ves_density_interp(dd, r0, rf):
+    """
+    The image of a radial profile dd (e.g. from ves_density_profile) at the positions of ves_density_lookup,
+    by linear interpolation. It is not divided by the normalization of the profile.
+    """
+    return (1 - rf) * dd[r0 - 1] + rf * dd[r0]
+
+
+def ves_density_profile(nr, pixelsize, a, d=50, t=0.2, cp=0.05, wth=4.2, scale=1, ion=0.0):
+    """
+    The projected radial profile of a circular vesicle, which is the look-up table of ves_density_circular.
+    The density at distance r (in unit of pixelsize/scale) from the center is the linear interpolation
+    of dd at r, divided by norm.
+
+    args:
+        nr: the profile is calculated at r = 0, 1, ..., nr - 1. dd[nr] is 0.
+        scale: number of samples per pixel
+        Others are the same as in ves_density_circular.
+
+    returns:
+        dd: nr + 1 values
+        norm: normalization of the density
+    """
     pixelsize = pixelsize / scale
     a /= pixelsize
     d /= pixelsize
@@ -53,13 +118,7 @@ def ves_density_circular(n, pixelsize, a, d=50, t=0.2, cp=0.05, wth=4.2,
     cp_in = (a - wth)
     cp_out = (a + wth)
 
-    # Make zero at x,y (center of the nxn image)
-    yy, xx = np.meshgrid(np.arange(1-y, n-y+1), np.arange(1-x, n-x+1))
-    # index into the radial function
-    rr = scale * np.sqrt(xx**2 + yy**2) + 1
-    nr = np.floor(np.max(rr)) + 1
-
-    dd = np.zeros((int(nr) + 1))
+    dd = np.zeros((nr + 1))
 
     xp = np.arange(0.5, nr + 0.5)
     xm = np.arange(-0.5, nr - 0.5)
@@ -84,18 +143,8 @@ def ves_density_circular(n, pixelsize, a, d=50, t=0.2, cp=0.05, wth=4.2,
     #
 
     dd[0:int(nr)] = (w1 - w0) * 1.0 + (t_in - w0) * t + (w1 - t_out) * t - (cp_out - cp_in) * cp + w0 * ion
-    # scipy.io.savemat('test_output/test2.mat', {'w0': w0, 'ion': ion})
-    r0 = np.floor(rr)
-    rf = rr - r0
-    r0 = r0.astype('int', copy=False)
 
-    # Use D as a look-up table with linear interpolation.
-    ww = (1 - rf) * dd[r0 - 1] + rf * dd[r0]
-    ww = ww / (d + wth * 2 * 2 * t - wth * 2 * cp)
-    if full_return:
-        return [ww, dd, scale]
-    else:
-        return ww
+    return [dd, d + wth * 2 * 2 * t - wth * 2 * cp]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import collections
+import numpy as np
+import numpy.fft as npfft
+from real_fft import rfftn, irfftn, as_half_plane
+
+
+class VesicleModelEvaluator():
+    """
+    CTF-filtered vesicle models in an n x n box, with subpixel centers.
+
+    The FFT of the centered model (center at pixel n/2+1), multiplied by the CTF, is calculated once
+    for each radius on the grid of the ProjectedProfileCache. Only its half along the last axis is
+    kept (rfftn), since the models are real. A model at any center is that spectrum
+    times a phase ramp, followed by one inverse FFT. A radius between two grid radii uses the linear
+    interpolation of their spectra.
+
+    At integer centers the models are the same as generate_3d_map_radial_2018 + shift_array +
+    apply_filter, within the accuracy of the profile cache (about 1e-4 relative).
+
+    methods:
+        model: the CTF-filtered model of a vesicle
+    """
+
+    def __init__(self, profile_cache, n, ctf=None, max_spectra=64):
+        """
+        args:
+            profile_cache: a ProjectedProfileCache of the membrane model and pixelsize
+            n: box size (even)
+            ctf: n x n CTF, not centered, or its half_plane (see real_fft). None: no CTF is applied.
+            max_spectra: number of spectra kept. The least recently used are removed.
+        """
+        self.profile_cache = profile_cache
+        self.n = int(n)
+        self.ctf = None if ctf is None else as_half_plane(ctf, (self.n, self.n))
+        self.max_spectra = max_spectra
+        self._spectra = collections.OrderedDict()
+
+        # radius grid of the profile cache in pixels
+        self._radius_step = profile_cache.radius_step / profile_cache.pixelsize
+        self._freq = npfft.fftfreq(self.n)
+        self._freq_half = npfft.rfftfreq(self.n)
+
+    def spectrum(self, k):
+        """
+        FFT of the centered model of the grid radius k, multiplied by the CTF.
+        """
+        spec = self._spectra.get(k)
+        if spec is None:
+            dd = self.profile_cache.model(k * self._radius_step, self.n / 2)
+            spec = rfftn(dd)
+            if self.ctf is not None:
+                spec *= self.ctf
+            self._spectra[k] = spec
+            if len(self._spectra) > self.max_spectra:
+                self._spectra.popitem(last=False)
+        else:
+            self._spectra.move_to_end(k)
+        return spec
+
+    def model(self, r_here, x, y):
+        """
+        args:
+            r_here: radius in unit of pixels
+            x, y: center of the vesicle in the box, starting from 1 (as x_fit, y_fit in sphere_fit_main)
+
+        returns:
+            an n x n array
+        """
+        k_float = float(np.squeeze(r_here)) / self._radius_step
+        k0 = int(np.floor(k_float))
+        w = k_float - k0
+        if w < 1e-9:
+            spec = self.spectrum(k0) + 0
+        else:
+            spec = self.spectrum(k0) * (1 - w)
+            spec += self.spectrum(k0 + 1) * w
+
+        # Shift from the center of the box (pixel n/2+1) to (x, y)
+        ramp_x = np.exp(-2j * np.pi * self._freq * (x - 1 - self.n // 2))
+        ramp_y = np.exp(-2j * np.pi * self._freq_half * (y - 1 - self.n // 2))
+        spec *= ramp_x[:, None]
+        spec *= ramp_y[None, :]
+
+        return irfftn(spec, (self.n, self.n))
+
+
+if __name__ == "__main__":
+    import time
+    from ctf_bank import CtfBank
+    from generate_3d_map_radial_2018 import generate_3d_map_radial_2018
+    from projected_profile_cache import projected_profile_cache
+    from shift_array import shift_array
+    from apply_filter import apply_filter
+
+    info_ctf = {"defocus": 1.4398, "bfactor": 48, "lambda": 0.0197, "Cs": 2.7, "qfactor": 0.07, "flag_prewhiten": 0,
+                "deltadef": 0.0073, "theta": 0.3649}
+    pixelsize = 1.056
+    r = 153.66
+    n = int(np.round(r / pixelsize * 2) * 2)
+    ctf = CtfBank().get(info_ctf, pixelsize, n)
+    profile_cache = projected_profile_cache(44, pixelsize)
+    evaluator = VesicleModelEvaluator(profile_cache, n, ctf)
+
+    # Compare with the old way at an integer center
+    x_fit, y_fit = 147.0, 139.0
+    t0 = time.time()
+    dd = generate_3d_map_radial_2018(profile_cache.fx, profile_cache.fy, r / pixelsize, n / 2, 4)
+    shiftx = np.round(x_fit) - (np.round(n / 2) + 1) + 1
+    shifty = np.round(y_fit) - (np.round(n / 2) + 1) + 1
+    shiftx += ((shiftx < 1) * n)
+    shifty += ((shifty < 1) * n)
+    dd = shift_array(dd, int(shiftx), int(shifty))
+    model_ref = apply_filter(dd, ctf, 0)
+    t1 = time.time()
+    model = evaluator.model(r / pixelsize, x_fit, y_fit)
+    t2 = time.time()
+    model = evaluator.model(r / pixelsize, x_fit + 0.3, y_fit)
+    t3 = time.time()
+    model = evaluator.model(r / pixelsize, x_fit, y_fit)
+    err = np.max(np.abs(model - model_ref)) / np.max(np.abs(model_ref))
+    print(f'rel max diff {err:.2e}, time {t1 - t0:.4f} s -> {t2 - t1:.4f} s (first), {t3 - t2:.4f} s (next)')
+    assert err < 1e-3
+
+    # A subpixel center lies between the two integer centers
+    m0 = evaluator.model(r / pixelsize, x_fit, y_fit)
+    m1 = evaluator.model(r / pixelsize, x_fit + 1, y_fit)
+    mh = evaluator.model(r / pixelsize, x_fit + 0.5, y_fit)
+    print(f'half pixel vs mean of neighbours: {np.max(np.abs(mh - (m0 + m1) / 2)) / np.max(np.abs(m0)):.2e}')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+def vesicle_box_overlap(mx, my, mr, pixelsize):
+    """
+    Build the overlap graph of vesicle boxes.
+    The box of a vesicle is the cutw x cutw region used by subtract_vesicles_popc_ect_2019 (cutw = 4 * r).
+
+    args:
+        mx, my: vesicle centers in unit of pixels
+        mr: vesicle radii in unit of angstrom
+        pixelsize: in unit of angstrom per pixel
+
+    returns:
+        an n x n boolean array. True if the boxes of two vesicles overlap. The diagonal is False.
+    """
+    x0 = np.round(mx - 1)
+    y0 = np.round(my - 1)
+    cutw = np.round(mr / pixelsize * 2) * 2
+
+    # [x0 - cutw/2, x0 + cutw/2) along each axis
+    x_low = np.round(x0 - cutw / 2)
+    x_high = np.round(x0 + cutw / 2)
+    y_low = np.round(y0 - cutw / 2)
+    y_high = np.round(y0 + cutw / 2)
+
+    overlap_x = np.logical_and(x_low[:, None] < x_high[None, :], x_low[None, :] < x_high[:, None])
+    overlap_y = np.logical_and(y_low[:, None] < y_high[None, :], y_low[None, :] < y_high[:, None])
+    overlap = np.logical_and(overlap_x, overlap_y)
+    np.fill_diagonal(overlap, False)
+
+    return overlap
+
+
+def vesicle_overlap_schedule(mx, my, mr, pixelsize):
+    """
+    Group vesicles into sets whose boxes do not overlap, by greedy coloring of the box overlap graph
+    in the order of the vesicle index.
+
+    args:
+        mx, my: vesicle centers in unit of pixels
+        mr: vesicle radii in unit of angstrom
+        pixelsize: in unit of angstrom per pixel
+
+    returns:
+        a list of sets. Each set is a sorted list of vesicle indices.
+        Vesicle 0 is always in the first set.
+    """
+    overlap = vesicle_box_overlap(mx, my, mr, pixelsize)
+    n_ves = overlap.shape[0]
+
+    color = np.zeros(n_ves, dtype=int) - 1
+    for i in range(n_ves):
+        used = set(color[:i][overlap[i, :i]])
+        c = 0
+        while c in used:
+            c += 1
+        color[i] = c
+
+    ves_sets = []
+    for c in range(np.max(color) + 1 if n_ves > 0 else 0):
+        ves_sets.append(list(np.where(color == c)[0]))
+
+    return ves_sets
+
+
+if __name__ == "__main__":
+    from read_box_e_m import read_box_e_m
+
+    mx, my, mr, mp, __ = read_box_e_m(
+        'data/18jun07c_em6b_00002gr_00010sq_v01_00002hl_v01_00005en.framescor2x_DW_dmBIN01.mrc_resub44_screen.txt')
+    ves_sets = vesicle_overlap_schedule(mx, my, mr, 1.056)
+    print(f'{mx.size} vesicles in {len(ves_sets)} sets')
+    for ves_set in ves_sets:
+        print(ves_set)
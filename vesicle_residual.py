@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from subtract_ves_2019 import subtract_ves_2019, subtract_one_ves_2019, flag_ves_to_subtract
+
+
+class VesicleResidual():
+    """
+    Incremental residual image used when vesicles are refitted one by one.
+
+    The image with all initial vesicle models subtracted is built once. Before vesicle i is fitted,
+    only its initial model is added back. After it is fitted, the refined model is subtracted.
+    So the residual is always the image after subtraction of the fitted vesicles (1:i-1) and
+    the not-fitted vesicles (i+1:end), which used to be calculated by calling subtract_ves_2019
+    on all remaining vesicles for every vesicle.
+
+    attributes:
+        img: the residual image
+
+    methods:
+        add_back: add the initial model of one vesicle back to the residual
+        subtract_box: subtract a refined model in a box from the residual
+    """
+
+    def __init__(self, im, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, ctf_bank=None, profile_cache=None,
+                 flag_fft_size=1):
+        """
+        args:
+            im: input image, which is not modified
+            Others are the same as in subtract_ves_2019
+        """
+        self.fx = fx
+        self.fy = fy
+        self.mx = mx
+        self.my = my
+        self.mr = mr
+        self.mp = mp
+        self.pixelsize = pixelsize
+        self.info_ctf = info_ctf
+        self.ctf_bank = ctf_bank
+        self.profile_cache = profile_cache
+        self.flag_fft_size = flag_fft_size
+
+        self.flag_subtracted = flag_ves_to_subtract(im.shape, mx, my, mr, mp)
+        self.img = subtract_ves_2019(im, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, 0, ctf_bank,
+                                     profile_cache, flag_fft_size)
+
+    def add_back(self, i):
+        """
+        Add the initial model of vesicle i back to the residual image.
+        """
+        if self.flag_subtracted[i]:
+            subtract_one_ves_2019(self.img, self.fx, self.fy, self.mx[i], self.my[i], self.mr[i], -self.mp[i],
+                                  self.pixelsize, self.info_ctf, self.ctf_bank, self.profile_cache,
+                                  self.flag_fft_size)
+            self.flag_subtracted[i] = False
+
+    def subtract_box(self, cutx0, cutx1, cuty0, cuty1, model_in_box):
+        """
+        Subtract model_in_box from the region [cutx0:cutx1, cuty0:cuty1] of the residual image.
+        """
+        self.img[cutx0:cutx1, cuty0:cuty1] -= model_in_box
+
+
+if __name__ == "__main__":
+    from get_membrane_profile import get_membrane_profile
+
+    info_ctf = {"defocus": 1.4398, "bfactor": 48, "lambda": 0.0197, "Cs": 2.7, "qfactor": 0.07, "flag_prewhiten": 0,
+                "deltadef": 0.0073, "theta": 0.3649}
+    pixelsize = 1.056
+    fx, fy, pixelsize_membrane = get_membrane_profile(44)
+    fx *= pixelsize_membrane / pixelsize
+    mx = np.array([200.0, 330.0, 420.0])
+    my = np.array([210.0, 300.0, 150.0])
+    mr = np.array([100.0, 90.0, 80.0])
+    mp = np.array([0.02, 0.03, 0.025])
+    im = np.random.rand(512, 512)
+
+    residual = VesicleResidual(im, fx, fy, mx, my, mr, mp, pixelsize, info_ctf)
+    residual.add_back(0)
+    expected = subtract_ves_2019(im, fx, fy, mx[1:], my[1:], mr[1:], mp[1:], pixelsize, info_ctf, 0)
+    print(np.max(np.abs(residual.img - expected)))
+
+    # Models calculated in boxes padded to fast FFT sizes subtract the same vesicles
+    out_cutw = subtract_ves_2019(im, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, 0, flag_fft_size=0)
+    out_fast = subtract_ves_2019(im, fx, fy, mx, my, mr, mp, pixelsize, info_ctf, 0, flag_fft_size=1)
+    error = np.max(np.abs(out_fast - out_cutw)) / np.max(np.abs(im - out_cutw))
+    print(error)
+    assert error < 1e-2
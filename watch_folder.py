@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import numpy as np
+from get_files_having_pattern import get_files_having_pattern
+from mrc import MRCFile
+from pad_pic import pad_pic
+from run_config import ask_if_missing
+from get_yes_no import get_yes_no
+from get_num_from_screen import get_num_from_screen
+from run_manifest import RunManifest
+from work_sharing import WorkClaims, RecordAll
+from batch_refit_subtract_new_withPOPC_in_folder_parfor_2019 import refit_subtract_micrograph
+
+
+class InputWatcher():
+    """
+    Find the micrographs in the current folder whose inputs (micrograph, ctf and vesicle files) are complete.
+
+    The inputs of a micrograph are complete when all three files exist (two if ves_filename_after_base is
+    None, e.g. to pick the vesicles), their sizes and modification times have not changed since the last
+    poll, the newest is at least settle_time seconds old, and the micrograph is as large as its mrc header
+    says. Each micrograph is given once by poll, unless retry is called after it failed.
+
+        watcher = InputWatcher('*dmBIN01.mrc', 11, 'dmBIN01.mrc_resub44_screen.txt', 'dmBIN01.mrc.ctf')
+        while True:
+            for infilename, t_ready in watcher.poll():
+                ...
+            time.sleep(10)
+    """
+
+    def __init__(self, file_pattern, n_to_delete_from_end_tobasename, ves_filename_after_base,
+                 ctf_filename_after_base, settle_time=5):
+        """
+        args:
+            settle_time: seconds without change before the inputs are taken as complete
+            Others are the same as in batch_refit_subtract_new_withPOPC_in_folder_parfor_2019
+        """
+        self.file_pattern = file_pattern
+        self.n_to_delete_from_end_tobasename = n_to_delete_from_end_tobasename
+        self.ves_filename_after_base = ves_filename_after_base
+        self.ctf_filename_after_base = ctf_filename_after_base
+        self.settle_time = settle_time
+        self.given = set()
+        self._last_state = {}
+        self._failed_state = {}
+
+    def input_files(self, infilename):
+        base = infilename[0: -self.n_to_delete_from_end_tobasename]
+        return [infilename] + [base + after_base for after_base in
+                               (self.ctf_filename_after_base, self.ves_filename_after_base) if after_base is not None]
+
+    def retry(self, infilename):
+        """
+        Give infilename again by poll, e.g. after its processing failed. It is given once its inputs have
+        changed (e.g. a file was still being written) and are complete again, so inputs that cannot be
+        processed are not retried in every poll.
+        """
+        self.given.discard(infilename)
+        self._failed_state[infilename] = self._state(infilename)
+
+    def _state(self, infilename):
+        """
+        Sizes and modification times of the inputs, or None if one does not exist.
+        """
+        try:
+            return tuple((st.st_size, st.st_mtime) for st in map(os.stat, self.input_files(infilename)))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _is_complete_mrc(infilename, size):
+        try:
+            with MRCFile(infilename) as f:
+                return size >= f.n_bytes
+        except Exception:  # the header is not written yet
+            return False
+
+    def poll(self):
+        """
+        returns:
+            a list of (infilename, t_ready) of the micrographs newly complete, in sorted order.
+            t_ready is the modification time of the newest input, when the micrograph was ready.
+        """
+        files = [f for f in sorted(get_files_having_pattern(self.file_pattern)) if f not in self.given]
+        now = time.time()
+        ready = []
+        for infilename in files:
+            state = self._state(infilename)
+            if infilename in self._failed_state:
+                if state == self._failed_state[infilename]:
+                    continue
+                del self._failed_state[infilename]
+            last_state = self._last_state.get(infilename)
+            self._last_state[infilename] = state
+            if state is None or state != last_state:
+                continue
+            t_ready = max(mtime for __, mtime in state)
+            if now - t_ready < self.settle_time or not self._is_complete_mrc(infilename, state[0][0]):
+                continue
+            self.given.add(infilename)
+            del self._last_state[infilename]
+            ready.append((infilename, t_ready))
+        return ready
+
+
+def watch_folder_refit_subtract(
+        file_pattern, pixelsize, model_type, ves_filename_after_base, ctf_filename_after_base,
+        n_to_delete_from_end_tobasename, scaling_of_mp_if_skip_refit_xy=0, star_filename_after_base=None,
+        n_ves_workers=1, profile_cache_file=None, fitter='fmin', fit_options=None, flag_mask_edge=None,
+        nx0=None, ny0=None, manifest_file=None, claim_dir=None, claim_timeout=3600,
+        poll_interval=10, settle_time=5, max_idle=None):
+    """
+    Refit and subtract the vesicles of the micrographs in the current folder as they arrive, e.g. during
+    data collection. The folder is polled every poll_interval seconds, and a micrograph is processed when
+    its micrograph, ctf and vesicle files are complete (see InputWatcher).
+
+    All micrographs are processed in this process, so the ctf bank and the projected profiles are
+    kept from one micrograph to the next. The latency of each micrograph, from its inputs being ready
+    to its outputs being written, is printed.
+
+    args:
+        poll_interval: seconds between polls of the folder
+        settle_time: seconds the inputs must be unchanged before they are used
+        max_idle: stop after max_idle seconds without a new micrograph. None: run until interrupted (Ctrl-C).
+        Others are the same as in batch_refit_subtract_new_withPOPC_in_folder_parfor_2019.
+        With a manifest_file, the micrographs done before are skipped. With a claim_dir, several
+        watchers (e.g. on different nodes) share the micrographs.
+
+    returns:
+        a list of the latencies in seconds
+    """
+
+    if star_filename_after_base is None:
+        flag_use_local_ctf_from_particle_star_file = 0
+    else:
+        flag_use_local_ctf_from_particle_star_file = 1
+
+    n_to_delete_from_end_tobasename = int(ask_if_missing(
+        n_to_delete_from_end_tobasename, 'n_to_delete_from_end_tobasename', get_num_from_screen,
+        'How many characters are deleted from the end of the micrograph name to get its base name?', 11))
+    flag_mask_edge = ask_if_missing(flag_mask_edge, 'flag_mask_edge', get_yes_no,
+                                    'Are there blank edges in the image (e.g. K2 image)?', 1)
+    if flag_mask_edge:
+        nx0 = int(ask_if_missing(nx0, 'nx0', get_num_from_screen, "What is the image size in X before padding?",
+                                 3710))
+        ny0 = int(ask_if_missing(ny0, 'ny0', get_num_from_screen, "What is the image size in Y before padding?",
+                                 3838))
+    mask_k2_edge_setto_0 = None  # made from the size of the first micrograph
+
+    watcher = InputWatcher(file_pattern, n_to_delete_from_end_tobasename, ves_filename_after_base,
+                           ctf_filename_after_base, settle_time)
+    manifest = None if manifest_file is None else RunManifest(manifest_file)
+    claims = None if claim_dir is None else WorkClaims(claim_dir, claim_timeout)
+    if manifest is None and claims is None:
+        tracker = None
+    else:
+        tracker = RecordAll([manifest, claims])
+
+    bad_vesicle_amplitude_threshold_saved = 0.1
+    flag_calibrated = False
+    latencies = []
+    i = 0
+    t_last = time.time()
+    print(f'*** Watching {os.getcwd()} for {file_pattern} every {poll_interval} s. Ctrl-C to stop.')
+    try:
+        while max_idle is None or time.time() - t_last < max_idle:
+            ready = watcher.poll()
+            if not ready:
+                time.sleep(poll_interval)
+                continue
+            for infilename, t_ready in ready:
+                if manifest is not None and manifest.is_done(infilename):
+                    continue
+                if claims is not None and not claims.claim(infilename):
+                    continue
+                if flag_mask_edge and mask_k2_edge_setto_0 is None:
+                    with MRCFile(infilename) as f:
+                        mask_k2_edge_setto_0 = pad_pic(np.ones([nx0, ny0]), f.nx, f.ny, 0)
+
+                t_start = time.time()
+                if tracker is not None:
+                    tracker.start(infilename)
+                try:
+                    res = refit_subtract_micrograph(
+                        i, infilename, n_to_delete_from_end_tobasename, pixelsize, model_type,
+                        ves_filename_after_base, ctf_filename_after_base, scaling_of_mp_if_skip_refit_xy,
+                        flag_use_local_ctf_from_particle_star_file, mask_k2_edge_setto_0, n_ves_workers,
+                        profile_cache_file, fitter, fit_options, bad_vesicle_amplitude_threshold_saved,
+                        0, None, None, tracker)
+                except Exception as err:
+                    print(f'*** Failed: {infilename}: {err!r}')
+                    if tracker is not None:
+                        tracker.fail(infilename, repr(err))
+                    watcher.retry(infilename)
+                    continue
+                finally:
+                    i += 1
+                t_end = time.time()
+                if res is None:
+                    if tracker is not None:
+                        tracker.fail(infilename, 'ctf or vesicle file does not exist')
+                    watcher.retry(infilename)
+                    continue
+                if not flag_calibrated:
+                    bad_vesicle_amplitude_threshold_saved = res.bad_vesicle_amplitude_threshold
+                    flag_calibrated = True
+
+                latencies.append(t_end - t_ready)
+                print(f'*** Latency of {infilename}: {t_end - t_ready:.1f} s '
+                      f'(waiting {t_start - t_ready:.1f} s, processing {t_end - t_start:.1f} s)')
+            t_last = time.time()
+    except KeyboardInterrupt:
+        print('*** Stopped.')
+
+    if latencies:
+        print(f'*** {len(latencies)} micrographs. Latency: mean {np.mean(latencies):.1f} s, '
+              f'max {np.max(latencies):.1f} s')
+    return latencies
+
+
+if __name__ == '__main__':
+    import sys
+    import shutil
+    import tempfile
+    import threading
+
+    # Micrographs are copied into an empty folder one by one while it is watched
+    data_folder = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else 'data')
+    os.chdir(tempfile.mkdtemp())
+    names = sorted(os.listdir(data_folder))
+
+    def collect():
+        for name in names:
+            if name.endswith('dmBIN01.mrc') or name.endswith('.ctf') or name.endswith('_screen.txt'):
+                shutil.copy(os.path.join(data_folder, name), name)
+                time.sleep(1)
+
+    threading.Thread(target=collect, daemon=True).start()
+    latencies = watch_folder_refit_subtract('*dmBIN01.mrc', 1.056, 44, 'dmBIN01.mrc_resub44_screen.txt',
+                                            'dmBIN01.mrc.ctf', 11, flag_mask_edge=0,
+                                            poll_interval=1, settle_time=2, max_idle=10)
+    print(sorted(os.listdir('.')))
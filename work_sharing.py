@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import threading
+import time
+
+
+def parse_shard(shard):
+    """
+    args:
+        shard: 'i/N' or (i, N), with 0 <= i < N
+
+    returns:
+        (i, N)
+    """
+    if isinstance(shard, str):
+        i, n = shard.split('/')
+        shard = (int(i), int(n))
+    i, n = int(shard[0]), int(shard[1])
+    if n < 1 or i < 0 or i >= n:
+        raise ValueError(f'Shard {i}/{n} is not valid. It needs 0 <= i < N.')
+    return i, n
+
+
+def shard_files(files, shard):
+    """
+    The files of shard i out of N: every N-th file, starting from file i, in sorted order.
+    Every node sorts the same list, so the shards do not overlap and cover all files.
+
+    args:
+        files: a list of filenames
+        shard: 'i/N' or (i, N). None: all files.
+    """
+    if shard is None:
+        return list(files)
+    i, n = parse_shard(shard)
+    return sorted(files)[i::n]
+
+
+class WorkClaims():
+    """
+    Share the micrographs of a folder between nodes, with claim files in a shared folder.
+
+    A node processes a micrograph only after it creates its claim file <basename>.claim with
+    O_CREAT | O_EXCL, which only one node can do. The claim is renamed to <basename>.done when
+    the outputs are written, and removed if the micrograph fails, so another node can try it.
+    A claim not touched for timeout seconds is stale (its node died): it is renamed away, which
+    only one node can do, and claimed again. From start to finish or fail, a thread touches the claim
+    every timeout / 4 seconds, so a long micrograph is not taken as stale. finish and fail only change
+    a claim that this node still owns (the owner line of the claim file); if another node took it over,
+    it is left to that node.
+
+    start, finish and fail have the same arguments as in RunManifest.
+
+    methods:
+        claim: try to claim a micrograph
+        is_done: whether a micrograph is done by any node
+        start: touch the claim, and keep touching it until finish or fail
+        finish: mark a claimed micrograph done
+        fail: release a claimed micrograph
+    """
+
+    def __init__(self, claim_dir, timeout=3600):
+        """
+        args:
+            claim_dir: a folder shared by all nodes
+            timeout: seconds after which a claim is stale. It must be longer than the time of one micrograph.
+        """
+        self.claim_dir = claim_dir
+        self.timeout = timeout
+        self.owner = f'{socket.gethostname()} {os.getpid()}'
+        self._heartbeats = {}
+        os.makedirs(claim_dir, exist_ok=True)
+
+    def _name(self, infilename, ext):
+        return os.path.join(self.claim_dir, os.path.basename(infilename) + ext)
+
+    def is_done(self, infilename):
+        return os.path.exists(self._name(infilename, '.done'))
+
+    def claim(self, infilename):
+        """
+        returns:
+            True if this node has claimed the micrograph, False if it is done or claimed by another node
+        """
+        if self.is_done(infilename):
+            return False
+        claim_file = self._name(infilename, '.claim')
+        for __ in range(2):
+            try:
+                fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(claim_file)
+                except FileNotFoundError:  # released in the meantime
+                    continue
+                if age < self.timeout:
+                    return False
+                # Stale claim: only the node whose rename succeeds removes it
+                stale_file = claim_file + '.stale.' + self.owner.replace(' ', '.')
+                try:
+                    os.rename(claim_file, stale_file)
+                except FileNotFoundError:
+                    return False
+                if time.time() - os.path.getmtime(stale_file) < self.timeout:
+                    # Another node reclaimed it just before: put its claim back
+                    try:
+                        os.link(stale_file, claim_file)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_file)
+                    return False
+                print(f'*** Reclaiming {infilename} from a stale claim ({age:.0f} s old)')
+                os.remove(stale_file)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'{self.owner} {time.time()}\n')
+            return True
+        return False
+
+    def owns(self, infilename):
+        """
+        returns:
+            True if the claim of the micrograph exists and was made by this node
+        """
+        try:
+            with open(self._name(infilename, '.claim')) as f:
+                return f.readline().rsplit(' ', 1)[0] == self.owner
+        except FileNotFoundError:
+            return False
+
+    def _touch(self, infilename):
+        if not self.owns(infilename):
+            return False
+        try:
+            os.utime(self._name(infilename, '.claim'))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _heartbeat(self, infilename, stop):
+        while not stop.wait(self.timeout / 4):
+            if not self._touch(infilename):
+                return
+
+    def start(self, infilename):
+        """
+        Touch the claim, so it is not taken as stale, and keep touching it until finish or fail.
+        """
+        self._stop_heartbeat(infilename)
+        if not self._touch(infilename):
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=self._heartbeat, args=(infilename, stop), daemon=True)
+        self._heartbeats[infilename] = (stop, thread)
+        thread.start()
+
+    def _stop_heartbeat(self, infilename):
+        heartbeat = self._heartbeats.pop(infilename, None)
+        if heartbeat is not None:
+            heartbeat[0].set()
+            heartbeat[1].join()
+
+    def finish(self, infilename, outputs, **fields):
+        self._stop_heartbeat(infilename)
+        if not self.owns(infilename):
+            print(f'*** The claim of {infilename} was taken over by another node. It is not marked done here.')
+            return
+        os.replace(self._name(infilename, '.claim'), self._name(infilename, '.done'))
+
+    def fail(self, infilename, error):
+        self._stop_heartbeat(infilename)
+        if not self.owns(infilename):
+            return
+        try:
+            os.remove(self._name(infilename, '.claim'))
+        except FileNotFoundError:
+            pass
+
+
+class RecordAll():
+    """
+    Forward start, finish and fail to each of a list of records (e.g. a RunManifest and WorkClaims).
+    """
+
+    def __init__(self, records):
+        self.records = [r for r in records if r is not None]
+
+    def start(self, infilename):
+        for r in self.records:
+            r.start(infilename)
+
+    def finish(self, infilename, outputs, **fields):
+        for r in self.records:
+            r.finish(infilename, outputs, **fields)
+
+    def fail(self, infilename, error):
+        for r in self.records:
+            r.fail(infilename, error)
+
+
+if __name__ == '__main__':
+    import tempfile
+    import concurrent.futures
+
+    files = [f'mic_{k:03d}.mrc' for k in range(10)]
+    shards = [shard_files(files, f'{i}/3') for i in range(3)]
+    assert sorted(sum(shards, [])) == files
+    print(shards)
+
+    # Several processes claim the same files: each file is claimed once
+    claim_dir = tempfile.mkdtemp()
+
+    def claim_all(k):
+        claims = WorkClaims(claim_dir)
+        return [f for f in files if claims.claim(f)]
+
+    with concurrent.futures.ProcessPoolExecutor(4) as executor:
+        claimed = list(executor.map(claim_all, range(4)))
+    assert sorted(sum(claimed, [])) == files
+    print([len(c) for c in claimed])
+
+    # A stale claim is taken over
+    claims = WorkClaims(claim_dir, timeout=0.1)
+    assert not claims.claim(files[0])
+    time.sleep(0.2)
+    assert claims.claim(files[0])
+    claims.finish(files[0], [])
+    assert claims.is_done(files[0]) and not claims.claim(files[0])
+
+    # A claim is kept fresh while its micrograph is processed
+    assert claims.claim(files[1])  # the claims of the processes above are stale
+    claims.start(files[1])
+    time.sleep(0.3)
+    assert not WorkClaims(claim_dir, timeout=0.1).claim(files[1])
+
+    # A claim taken over by another node is not changed by the node that lost it
+    other = WorkClaims(claim_dir, timeout=0.1)
+    other.owner = 'other-node 1'
+    assert claims.claim(files[2])
+    time.sleep(0.2)
+    assert other.claim(files[2])
+    claims.fail(files[2], '')
+    claims.finish(files[2], [])
+    assert other.owns(files[2]) and not claims.is_done(files[2])
+    other.finish(files[2], [])
+    claims.finish(files[1], [])
+    assert claims.is_done(files[1]) and claims.is_done(files[2])
@@ -1,7 +1,160 @@
 #!/usr/bin/env python3
 
+import os
 import numpy as np
-import struct
+from read_mrc import mrc_header_dtype, mrc_mode_dtype, read_mrc_header
+
+
+class MrcStackWriter():
+    """
+    Write a mrc file slice by slice.
+
+    Each slice is written to the file when it is given, and the statistics in the header (min, max,
+    mean and the standard deviation with ddof=1) are accumulated slice by slice (Chan's parallel
+    form of Welford's algorithm). The header is written again with the final number of slices and
+    statistics by close. A stack can be opened again to append more slices.
+
+    The slices are nx x ny arrays in the matlab convention of read_mrc/write_mrc.
+
+    methods:
+        write: append slices
+        close: finish the header and close the file
+    """
+
+    def __init__(self, filename, pixel_size, mode=2, flag_relion_center=0, flag_append=0):
+        """
+        args:
+            filename: a string
+            pixel_size: pixel size in unit of angstrom/pixel, or an array of 3 (x, y, z) or 2 (xy, z)
+            mode: an integer (0: int8, 1: int16, 2: float32, 6: uint16, 12: float16)
+            flag_relion_center: write the center of the volume using Relion convention
+            flag_append: 1 to append to the stack in filename if it exists. Its mode and size must be the same.
+        """
+        if mode not in mrc_mode_dtype:
+            raise ValueError('WriteMRC: unknown data mode: ' + str(mode))
+        self.filename = filename
+        self.pixel_size = pixel_size
+        self.mode = mode
+        self.flag_relion_center = flag_relion_center
+        self.dtype = mrc_mode_dtype[mode]
+
+        self.nx = None
+        self.ny = None
+        self.nz = 0
+        self._min = np.inf
+        self._max = -np.inf
+        self._mean = 0.0
+        self._m2 = 0.0  # sum of squared differences from the mean
+
+        if flag_append and os.path.exists(filename):
+            s, hdr, __ = read_mrc_header(filename)
+            if s.err or s.mode != mode or int(hdr['nsymbt']) != 0:
+                raise ValueError('WriteMRC: can not append to ' + filename)
+            self.nx = s.nx
+            self.ny = s.ny
+            self.nz = s.nz
+            n = s.nx * s.ny * s.nz
+            if n > 0:
+                self._min = float(s.mi)
+                self._max = float(s.ma)
+                self._mean = float(s.av)
+                self._m2 = float(hdr['rms']) ** 2 * (n - 1)
+            self._f = open(filename, 'r+b')
+            self._f.seek(1024 + n * self.dtype.itemsize)
+            self._f.truncate()
+        else:
+            self._f = open(filename, 'wb')
+            self._f.write(self._header().tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, vol):
+        """
+        Append slices.
+
+        args:
+            vol: a nx x ny slice or a nx x ny x nz stack
+        """
+        vol = np.asarray(vol)
+        if vol.ndim == 2:
+            vol = vol[:, :, None]
+        if self.nx is None:
+            self.nx, self.ny = vol.shape[0], vol.shape[1]
+        elif vol.shape[:2] != (self.nx, self.ny):
+            raise ValueError(f'WriteMRC: slice of {vol.shape[:2]} in a stack of {(self.nx, self.ny)}')
+
+        for k in range(vol.shape[2]):
+            data = np.asarray(vol[:, :, k], dtype=self.dtype)
+
+            # Statistics of the slice in float64, combined with the ones before
+            n_a = self.nx * self.ny * self.nz
+            n_b = data.size
+            mean_b = np.mean(data, dtype=np.float64)
+            m2_b = np.sum((data - mean_b) ** 2)
+            delta = mean_b - self._mean
+            self._mean += delta * n_b / (n_a + n_b)
+            self._m2 += m2_b + delta ** 2 * n_a * n_b / (n_a + n_b)
+            self._min = min(self._min, float(np.min(data)))
+            self._max = max(self._max, float(np.max(data)))
+
+            # The file is column first: x is the fastest index
+            data.T.tofile(self._f)
+            self.nz += 1
+
+    def _header(self):
+        """
+        The header for the slices written so far, as a mrc_header_dtype array of one element.
+        """
+        nx = self.nx if self.nx is not None else 0
+        ny = self.ny if self.ny is not None else 0
+        nz = self.nz
+        hdr = np.zeros(1, dtype=mrc_header_dtype)
+        h = hdr[0]
+        h['nx'], h['ny'], h['nz'], h['mode'] = nx, ny, nz, self.mode
+        if self.flag_relion_center:
+            h['nxstart'], h['nystart'], h['nzstart'] = 0, 0, 0
+        else:
+            h['nxstart'], h['nystart'], h['nzstart'] = int(-nx / 2), int(-ny / 2), int(-nz / 2)
+        h['mx'], h['my'], h['mz'] = nx, ny, nz
+
+        # the pixelsize might be a list where the scale in different dimensions is different
+        pixel_size = np.ravel(self.pixel_size)
+        if pixel_size.size == 3:
+            h['cella'] = [nx * pixel_size[0], ny * pixel_size[1], nz * pixel_size[2]]
+        elif pixel_size.size == 2:
+            h['cella'] = [nx * pixel_size[0], ny * pixel_size[0], nz * pixel_size[1]]
+        else:
+            h['cella'] = [nx * pixel_size[0], ny * pixel_size[0], nz * pixel_size[0]]
+        h['cellb'] = [90, 90, 90]
+        h['mapc'], h['mapr'], h['maps'] = 1, 2, 3
+
+        n = nx * ny * nz
+        if n > 0:
+            h['dmin'], h['dmax'], h['dmean'] = self._min, self._max, self._mean
+        if n > 1:
+            h['rms'] = np.sqrt(self._m2 / (n - 1))
+
+        # Always little Endian
+        h['map'] = b'MAP '
+        h['machst'] = [68, 65, 0, 0]
+        h['nlabl'] = 10
+        h['label'] = [b'#' + b'.' * 78 + b'#'] * 10
+        return hdr
+
+    def close(self):
+        """
+        Write the final header and close the file.
+        """
+        if self._f is None:
+            return
+        self._f.seek(0)
+        self._f.write(self._header().tobytes())
+        self._f.close()
+        self._f = None
 
 
 def write_mrc(vol, pixel_size, filename, mode=2, flag_relion_center=0):
@@ -18,18 +171,12 @@ def write_mrc(vol, pixel_size, filename, mode=2, flag_relion_center=0):
     returns:
         None, but a new mrc file will be generate
 
+    note:
+        The data are written slice by slice with MrcStackWriter, without copies of the whole volume.
     """
 
     # Detect the mode to write the binary file
-    if mode == 0:
-        format_string = 'b'  # ''int8'
-    elif mode == 1:
-        format_string = 'h'  # 'int16'
-    elif mode == 2:
-        format_string = 'f'  # 'float32'
-    elif mode == 6:
-        format_string = 'H'  # 'uint16'
-    else:
+    if mode not in mrc_mode_dtype:
         print('ReadMRC: unknown data mode')
         print('Nothing is done.')
         return
@@ -37,107 +184,37 @@ def write_mrc(vol, pixel_size, filename, mode=2, flag_relion_center=0):
     # add .mrc if not provided in the filename
     tt1 = filename.find('mrc')
     if tt1 == -1:
-        filename = [filename, '.mrc']
-
-    # open the file in a binary mode
-    fd = open(filename, 'wb')  # binary mode
-
-    # The first ten integers
-    shape = np.shape(vol)
-    nx = shape[0]
-    ny = shape[1]
-    if len(shape) > 2:
-        nz = shape[2]
-    else:
-        nz = 1
-
-    if flag_relion_center:
-        a = [nx, ny, nz, mode, 0, 0, 0, nx, ny, nz]
-    else:
-        a = [nx, ny, nz, mode, -nx / 2, -ny / 2, -nz / 2, nx, ny, nz]
-    a = np.int32(a)
-
-    fd.write(struct.pack('<iiiiiiiiii', *a))
-
-    # The next 12 float32 parameters
-    amin = np.amin(vol)
-    amax = np.amax(vol)
-    amean = np.mean(vol)
-
-    # the pixelsize might be a list where the scale in different dimensions is different
-    if type(pixel_size) == np.ndarray:
-        if pixel_size.size == 3:
-            b = np.array([nx * pixel_size[0], ny * pixel_size[1], nz * pixel_size[2], 90, 90, 90,
-                          1, 2, 3, amin, amax, amean])
-        elif pixel_size.size == 3:
-            b = np.array([nx * pixel_size[0], ny * pixel_size[0], nz * pixel_size[1], 90, 90, 90,
-                          1, 2, 3, amin, amax, amean])
-    else:
-        b = np.array([nx * pixel_size, ny * pixel_size, nz * pixel_size, 90, 90, 90,
-                      1, 2, 3, amin, amax, amean])
-
-    b = np.float32(b)
-    fd.write(struct.pack('<ffffffffffff', *b))
-
-    # The next 30 entries (23-52)
-    # c = []
-    for i in range(0, 30):
-        fd.write(struct.pack('<i', 0))
-
-    # The next two entries (53,54)
-
-    q = np.array([1], dtype='int32')
-    q.dtype = np.uint8
-    machine_le = (q[0] == 1)
-    # stamp = []
-    if machine_le:
-        temp = 'MAP '
-        temp2 = [68, 65, 0, 0]
-
-    else:
-        temp = ' PAM'
-        temp2 = [0, 0, 65, 68]
-
-    temp2 = np.uint8(temp2)
-    fd.write(temp.encode('ascii'))  # string in python 3.x
-    fd.write(struct.pack('<BBBB', *temp2))
-
-    # Two more entries (55,56)
-    try:
-        astd = np.std(np.single(vol[:]), ddof=1)
-    except MemoryError:
-        print('*** Standard deviation can not be calculated due to large map.')
-        print('*** So set it to the first one slice')
-        tt = np.single(vol[0, :, :])
-        astd = np.std(tt[:])
-
-    astd = np.float32(astd)
-    fd.write(struct.pack('<f', astd))
-    fd.write(struct.pack('<i', 10))  # number of labels
-
-    # Ten more labels
-    for i in range(0, 10):
-        label = '#' + '.'*78 + '#'
-        fd.write(label.encode('ascii'))  # string in python 3.x
-
-    # Now write the data
-
-    out = []  # out array
-    for kk in range(nz):
-        for jj in range(ny):
-            if nz > 1:
-                out.append(vol[:, jj, kk])
-            else:
-                out.append(vol[:, jj])
-
-    out2 = np.reshape(out, (np.size(out),))
-    fd.write(struct.pack('<'+format_string*out2.size, *out2))
-
-    fd.close()
+        filename = filename + '.mrc'
+
+    with MrcStackWriter(filename, pixel_size, mode, flag_relion_center) as writer:
+        writer.write(vol)
 
 
 if __name__ == '__main__':
+    import time
+    import tempfile
     from read_mrc import read_mrc
     img, s, hdr, extra_header = read_mrc('data/3dstack.mrc', 3)
 
     write_mrc(img, s.pixa, 'test_output/stack0_n.mrc', 2)
+
+    # Written slice by slice or at once, the files are the same
+    folder = tempfile.mkdtemp()
+    write_mrc(img, s.pixa, os.path.join(folder, 'all.mrc'), 1)
+    with MrcStackWriter(os.path.join(folder, 'slices.mrc'), s.pixa, 1) as writer:
+        writer.write(img[:, :, 0:3])
+    with MrcStackWriter(os.path.join(folder, 'slices.mrc'), s.pixa, 1, flag_append=1) as writer:
+        for k in range(3, img.shape[2]):
+            writer.write(img[:, :, k])
+    with open(os.path.join(folder, 'all.mrc'), 'rb') as f1, open(os.path.join(folder, 'slices.mrc'), 'rb') as f2:
+        assert f1.read() == f2.read()
+    img2, s2, hdr2, __ = read_mrc(os.path.join(folder, 'all.mrc'))
+    assert np.array_equal(img, img2)
+    print('std', hdr2['rms'], np.std(img, ddof=1), 'mean', hdr2['dmean'], np.mean(img))
+
+    im = np.random.RandomState(0).normal(size=(3838, 3710))
+    t0 = time.time()
+    write_mrc(im, 1.056, os.path.join(folder, 'micrograph.mrc'), 2)
+    print(f'{im.shape} micrograph written in {time.time() - t0:.2f} s')
+    im2, __, __, __ = read_mrc(os.path.join(folder, 'micrograph.mrc'))
+    assert np.array_equal(im2, np.float32(im))